@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""Benchmark the gen-img pipeline against synthetic ESXi installer ISOs.
+
+The ISOs are generated with pycdlib and shaped like the real installer
+media: a couple of hundred small modules, a few large .v00/.b00 modules,
+the EFI loader and both BOOT.CFG files. No ESXi media is needed.
+
+Every stage is run --repeat times and the fastest wall time is kept. The
+results can be saved as a baseline and later runs are compared against
+it, any stage slower than the baseline by more than --threshold is
+reported as a regression and the exit status is non-zero.
+
+Usage::
+
+    python benchmarks/bench.py --scale small --save
+    python benchmarks/bench.py --scale small
+"""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from collections.abc import Callable
+from pathlib import Path
+
+import pycdlib
+
+from esxi_img import cmd
+from esxi_img import profiling
+from esxi_img import sizing
+
+MiB = 1024 * 1024
+
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+
+# number of small modules, their size range and the size of each large one
+SCALES = {
+    "tiny": (20, (1024, 64 * 1024), [2 * MiB, 4 * MiB]),
+    "small": (200, (4 * 1024, 256 * 1024), [16 * MiB] * 4),
+    "medium": (300, (4 * 1024, 512 * 1024), [64 * MiB] * 6),
+    "large": (400, (4 * 1024, 1024 * 1024), [128 * MiB] * 8),
+}
+
+BOOT_CFG = """bootstate=0
+title=Loading ESXi installer
+timeout=5
+prefix=
+kernel=/b.b00
+kernelopt=runweasel cdromBoot
+modules={modules}
+build=8.0.3-0.0.00000000
+updated=0
+"""
+
+
+def _write_random(path: Path, size: int, rng: random.Random) -> None:
+    with path.open("wb") as f:
+        # modules on the media are compressed so random data is realistic
+        remaining = size
+        while remaining:
+            chunk = min(remaining, 8 * MiB)
+            f.write(rng.randbytes(chunk))
+            remaining -= chunk
+
+
+def make_iso(path: Path, scale: str, seed: int = 0) -> int:
+    """Write a synthetic ESXi installer ISO.
+
+    Returns:
+        int: the number of bytes of file data on the ISO
+    """
+    small_count, (small_min, small_max), large_sizes = SCALES[scale]
+    rng = random.Random(seed)  # noqa: S311
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=3, joliet=3)
+
+    total = 0
+    modules = []
+    with tempfile.TemporaryDirectory(dir=path.parent) as temp_dir:
+        staging = Path(temp_dir)
+
+        def add(name: str, size: int | None = None, data: bytes | None = None):
+            nonlocal total
+            source = staging / name.replace("/", "_")
+            if data is None:
+                _write_random(source, size, rng)
+            else:
+                source.write_bytes(data)
+            total += source.stat().st_size
+            iso.add_file(
+                str(source),
+                iso_path=f"/{name.upper()};1",
+                joliet_path=f"/{name.lower()}",
+            )
+
+        for n, size in enumerate(large_sizes):
+            name = "b.b00" if n == 0 else f"s{n:x}.v00"
+            add(name, size)
+            modules.append(name)
+        for n in range(small_count):
+            name = f"m{n:04x}.v00"
+            add(name, rng.randint(small_min, small_max))
+            modules.append(name)
+
+        iso.add_directory("/EFI", joliet_path="/efi")
+        iso.add_directory("/EFI/BOOT", joliet_path="/efi/boot")
+        add("efi/boot/bootx64.efi", 1 * MiB)
+        boot_cfg = BOOT_CFG.format(
+            modules=" --- ".join(f"/{name}" for name in modules[1:])
+        ).encode()
+        add("boot.cfg", data=boot_cfg)
+        add("efi/boot/boot.cfg", data=boot_cfg)
+
+        iso.write(str(path))
+        iso.close()
+    return total
+
+
+def _time(
+    profiler: profiling.Profiler,
+    name: str,
+    repeat: int,
+    func: Callable[[Path], None],
+    scratch: Path,
+) -> dict:
+    """Run func repeat times in a fresh directory and keep the fastest run."""
+    runs = []
+    for n in range(repeat):
+        work = scratch / f"{name}-{n}"
+        work.mkdir()
+        with profiler.stage(name):
+            func(work)
+        runs.append(profiler.stages[-1])
+        shutil.rmtree(work)
+    best = min(runs, key=lambda stage: stage.wall_seconds)
+    return {
+        "wall_seconds": best.wall_seconds,
+        "cpu_seconds": best.user_seconds
+        + best.system_seconds
+        + best.children_user_seconds
+        + best.children_system_seconds,
+        "peak_rss_bytes": best.peak_rss_bytes,
+    }
+
+
+def run_scale(scale: str, repeat: int, jobs: int | None) -> dict:
+    """Benchmark every stage of the pipeline for one ISO scale."""
+    profiler = profiling.Profiler()
+    with tempfile.TemporaryDirectory(prefix="esxi-img-bench-") as temp_dir:
+        scratch = Path(temp_dir)
+        iso_path = scratch / "esxi.iso"
+        data_bytes = make_iso(iso_path, scale)
+        iso = str(iso_path)
+
+        # inputs shared by the image stages
+        extracted = scratch / "extracted"
+        extracted.mkdir()
+        cmd.extract_iso(iso, extracted, jobs)
+        helper = scratch / "ESXIIMG.TGZ"
+        cmd.generate_installer_helper(None, helper)
+        shutil.copy(helper, extracted / "ESXIIMG.TGZ")
+        layout = cmd.Fat32Builder()
+        layout.add_tree(extracted)
+        esp_size = sizing.compute(layout, sizing.Slack.parse(sizing.DEFAULT_SLACK))
+        raw_image = scratch / "reference.raw"
+        cmd._create_disk_img(extracted, {"raw": raw_image}, esp_size)
+
+        stages = {
+            "extract_iso": lambda work: cmd.extract_iso(iso, work, jobs),
+            "generate_installer_helper": lambda work: cmd.generate_installer_helper(
+                None, work / "ESXIIMG.TGZ"
+            ),
+            "create_disk_img": lambda work: cmd._create_disk_img(
+                extracted, {"raw": work / "disk.raw"}, esp_size
+            ),
+            "stream_disk_img": lambda work: cmd._stream_disk_img(
+                iso, helper, {"raw": work / "disk.raw"}
+            ),
+            "stream_disk_img_qcow2": lambda work: cmd._stream_disk_img(
+                iso, helper, {"qcow2": work / "disk.qcow2"}
+            ),
+        }
+        if shutil.which("qemu-img"):
+            stages["convert_img_qcow2"] = lambda work: cmd._convert_img(
+                raw_image, work / "disk.qcow2", "qcow2"
+            )
+
+        results = {
+            name: _time(profiler, name, repeat, func, scratch)
+            for name, func in stages.items()
+        }
+    for name, result in results.items():
+        # the helper doesn't depend on the ISO so has no throughput
+        result["mib_per_second"] = (
+            None
+            if name == "generate_installer_helper"
+            else data_bytes / MiB / result["wall_seconds"]
+        )
+    return {"data_bytes": data_bytes, "stages": results}
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """List the stages slower than their baseline by more than threshold.
+
+    Differences under 50ms are ignored as noise.
+    """
+    regressions = []
+    for scale, result in current.items():
+        base_stages = baseline.get(scale, {}).get("stages", {})
+        for name, stage in result["stages"].items():
+            base = base_stages.get(name)
+            if base is None:
+                continue
+            before = base["wall_seconds"]
+            after = stage["wall_seconds"]
+            if after > before * (1 + threshold) and after - before > 0.05:
+                regressions.append(
+                    f"{scale}/{name}: {after:.3f}s vs {before:.3f}s baseline "
+                    f"(+{(after / before - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def _print_results(results: dict, baseline: dict) -> None:
+    print(f"{'STAGE':<32} {'SECONDS':>9} {'BASELINE':>9} {'MiB/s':>9}")
+    for scale, result in results.items():
+        base_stages = baseline.get(scale, {}).get("stages", {})
+        for name, stage in result["stages"].items():
+            base = base_stages.get(name, {}).get("wall_seconds")
+            rate = stage["mib_per_second"]
+            print(
+                f"{scale + '/' + name:<32} {stage['wall_seconds']:9.3f} "
+                f"{'-' if base is None else f'{base:.3f}':>9} "
+                f"{'-' if rate is None else f'{rate:.1f}':>9}"
+            )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scale",
+        action="append",
+        choices=list(SCALES),
+        help="ISO sizes to benchmark, may be repeated (default: small)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs of each stage (default: 3)"
+    )
+    parser.add_argument("--jobs", "-j", type=int, default=None)
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=DEFAULT_BASELINE,
+        help="Baseline results to compare with (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="Store the results in the baseline file",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20.0,
+        help="Percent slowdown reported as a regression (default: %(default)s)",
+    )
+    parser.add_argument("--json", type=Path, help="Also write the results here")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {
+        scale: run_scale(scale, args.repeat, args.jobs)
+        for scale in args.scale or ["small"]
+    }
+    host = {"machine": platform.machine(), "python": platform.python_version()}
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text()).get("results", {})
+    _print_results(results, baseline)
+
+    if args.json:
+        args.json.write_text(
+            json.dumps({"host": host, "results": results}, indent=2) + "\n"
+        )
+    if args.save:
+        args.baseline.write_text(
+            json.dumps({"host": host, "results": {**baseline, **results}}, indent=2)
+            + "\n"
+        )
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold / 100)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,7 @@
+from importlib.metadata import PackageNotFoundError
+from importlib.metadata import version
+
+try:
+    __version__ = version("esxi-img")
+except PackageNotFoundError:
+    __version__ = "0+unknown"
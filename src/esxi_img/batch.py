@@ -0,0 +1,316 @@
+"""Build many images from a manifest on a pool of worker processes.
+
+A manifest lists builds, each with the options of ``esxi-img gen-img``,
+and an optional table of defaults shared by all of them. In TOML::
+
+    [defaults]
+    format = "qcow2"
+
+    [[build]]
+    name = "esxi8-dell"
+    iso = "VMware-VMvisor-Installer-8.0U3.iso"
+    ks_template = "dell.cfg"
+    output = "esxi8-dell.qcow2"
+
+JSON manifests have the same shape with a "build" list. Relative paths
+are taken relative to the manifest. Variants of one ISO can share a
+``backing`` qcow2 image and are then written as thin overlays of it.
+
+Work common to several builds is done once up front: every distinct ISO
+is extracted into a shared cache and every distinct installer helper is
+generated once, the builds then only lay out their disk images.
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tomllib
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
+from pathlib import Path
+
+from esxi_img import cache
+from esxi_img import cmd
+from esxi_img import reproducible
+from esxi_img import sizing
+
+logger = logging.getLogger(__name__)
+
+_BUILD_KEYS = {
+    "name",
+    "iso",
+    "output",
+    "format",
+    "ks_template",
+    "esxiimg",
+    "builder",
+    "slack",
+    "compress",
+    "backing",
+}
+
+
+@dataclass(frozen=True)
+class BuildSpec:
+    """One image build from a manifest."""
+
+    name: str
+    iso: str
+    outputs: list[str]
+    formats: list[str]
+    ks_template: str | None = None
+    esxiimg: str | None = None
+    builder: str = "python"
+    slack: str = sizing.DEFAULT_SLACK
+    compress: bool = False
+    backing: str | None = None
+
+    def options(self, **overrides) -> cmd.BuildOptions:
+        """The options of generate_image() for the build."""
+        return replace(
+            cmd.BuildOptions(
+                ks_template_path=self.ks_template,
+                esxiimg_path=self.esxiimg,
+                builder=self.builder,
+                slack=self.slack,
+                compress=self.compress,
+                backing_path=self.backing,
+            ),
+            **overrides,
+        )
+
+
+@dataclass
+class BuildResult:
+    name: str
+    ok: bool
+    seconds: float
+    outputs: list[str] = field(default_factory=list)
+    error: str | None = None
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _resolve(base: Path, path: str | None) -> str | None:
+    if path is None:
+        return None
+    return str((base / Path(path).expanduser()).resolve())
+
+
+def build_spec(options: dict, base: Path, label: str = "build") -> BuildSpec:
+    """Make a build from its options with paths relative to base.
+
+    Raises:
+        ValueError: If an option is unknown or the iso or output is missing
+    """
+    unknown = options.keys() - _BUILD_KEYS
+    if unknown:
+        raise ValueError(f"{label}: unknown build options {sorted(unknown)}")
+    if "iso" not in options or "output" not in options:
+        raise ValueError(f"{label} needs an iso and an output")
+
+    outputs = [_resolve(base, out) for out in _as_list(options["output"])]
+    try:
+        formats = cmd.output_formats(outputs, _as_list(options.get("format")))
+    except ValueError as e:
+        raise ValueError(f"{label}: {e}") from None
+    return BuildSpec(
+        name=options.get("name") or Path(outputs[0]).stem,
+        iso=_resolve(base, options["iso"]),
+        outputs=outputs,
+        formats=formats,
+        ks_template=_resolve(base, options.get("ks_template")),
+        esxiimg=_resolve(base, options.get("esxiimg")),
+        builder=options.get("builder", "python"),
+        slack=str(options.get("slack", sizing.DEFAULT_SLACK)),
+        compress=bool(options.get("compress", False)),
+        backing=_resolve(base, options.get("backing")),
+    )
+
+
+def load_manifest(path: str | Path) -> list[BuildSpec]:
+    """Read the builds from a JSON or TOML manifest.
+
+    Raises:
+        ValueError: If the manifest is malformed
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".toml":
+        with path.open("rb") as f:
+            manifest = tomllib.load(f)
+    else:
+        with path.open() as f:
+            manifest = json.load(f)
+
+    base = path.parent
+    defaults = manifest.get("defaults", {})
+    builds = manifest.get("build")
+    if not builds:
+        raise ValueError(f"{path}: no builds listed")
+
+    specs = [
+        build_spec({**defaults, **entry}, base, f"{path}: build {n}")
+        for n, entry in enumerate(builds)
+    ]
+
+    names = [spec.name for spec in specs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"{path}: duplicate build names {duplicates}")
+    return specs
+
+
+def _extract(cache_dir: str, cache_max_size: int, iso: str, jobs: int | None) -> None:
+    iso_cache = cache.IsoCache(Path(cache_dir), cache_max_size)
+    index = iso_cache.index(iso)
+    with iso_cache.tree(iso, lambda tree: cmd.extract_iso(iso, tree, jobs, index)):
+        pass
+
+
+def _helper(ks_template: str | None, output_path: str) -> None:
+    mtime = reproducible.source_date_epoch()
+    if cmd.generate_installer_helper(ks_template, output_path, mtime) != 0:
+        raise RuntimeError(f"failed to generate installer helper {output_path}")
+
+
+def _build(
+    spec: BuildSpec,
+    helper: str,
+    cache_dir: str,
+    cache_max_size: int,
+    jobs: int | None,
+    force: bool = False,
+) -> BuildResult:
+    start = time.monotonic()
+    logger.info("Starting build %s", spec.name)
+    rc = cmd.generate_image(
+        spec.iso,
+        spec.outputs,
+        spec.formats,
+        spec.options(
+            esxiimg_path=helper,
+            jobs=jobs,
+            cache_dir=cache_dir,
+            cache_max_size=cache_max_size,
+            force=force,
+        ),
+    )
+    return BuildResult(
+        spec.name,
+        rc == 0,
+        time.monotonic() - start,
+        spec.outputs,
+        None if rc == 0 else f"gen-img exited with {rc}",
+    )
+
+
+def run_batch(
+    specs: list[BuildSpec],
+    workers: int | None = None,
+    cache_dir: str | None = None,
+    cache_max_size: int | None = None,
+    force: bool = False,
+) -> list[BuildResult]:
+    """Run the builds on a pool of processes.
+
+    Args:
+        specs: the builds to run
+        workers: Number of builds to run at once, defaults to the CPU count
+                 but never more than there are builds
+        cache_dir: Directory to cache the extracted ISOs in, a temporary
+                   cache is used for the batch when not given
+        cache_max_size: Size in bytes the ISO cache is trimmed down to,
+                        unlimited for a temporary cache
+        force: Rebuild images even if they are up to date
+
+    Returns:
+        list[BuildResult]: the result of each build in manifest order
+    """
+    workers = max(1, min(workers or os.cpu_count() or 1, len(specs)))
+    # the builds share the CPUs for extracting ISOs
+    jobs = max(1, (os.cpu_count() or 1) // workers)
+
+    with tempfile.TemporaryDirectory(prefix="esxi-img-batch-") as temp_dir:
+        temp_path = Path(temp_dir)
+        if cache_dir is None:
+            cache_dir = str(temp_path / "cache")
+            cache_max_size = cache_max_size or sys.maxsize
+        elif cache_max_size is None:
+            cache_max_size = cache.DEFAULT_MAX_SIZE
+
+        results: dict[str, BuildResult] = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            isos = sorted({spec.iso for spec in specs})
+            ks_templates = sorted(
+                {spec.ks_template for spec in specs if not spec.esxiimg},
+                key=lambda ks: ks or "",
+            )
+            helpers = {
+                ks: str(temp_path / f"helper-{n}.tgz")
+                for n, ks in enumerate(ks_templates)
+            }
+            logger.info(
+                "Preparing %d ISOs and %d installer helpers for %d builds",
+                len(isos),
+                len(helpers),
+                len(specs),
+            )
+            extracted: dict[str, Future] = {
+                iso: pool.submit(_extract, cache_dir, cache_max_size, iso, jobs)
+                for iso in isos
+            }
+            generated: dict[str | None, Future] = {
+                ks: pool.submit(_helper, ks, helper) for ks, helper in helpers.items()
+            }
+
+            builds = {}
+            for spec in specs:
+                prepared = [extracted[spec.iso]]
+                if not spec.esxiimg:
+                    prepared.append(generated[spec.ks_template])
+                failed = [str(f.exception()) for f in prepared if f.exception()]
+                if failed:
+                    results[spec.name] = BuildResult(
+                        spec.name, False, 0.0, spec.outputs, "; ".join(failed)
+                    )
+                    continue
+                helper = spec.esxiimg or helpers[spec.ks_template]
+                builds[spec.name] = pool.submit(
+                    _build, spec, helper, cache_dir, cache_max_size, jobs, force
+                )
+
+            for name, future in builds.items():
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    results[name] = BuildResult(name, False, 0.0, error=str(e))
+
+    return [results[spec.name] for spec in specs]
+
+
+def format_summary(results: list[BuildResult]) -> str:
+    """Render the build results as a table."""
+    width = max(len("BUILD"), *(len(result.name) for result in results))
+    lines = [f"{'BUILD':<{width}}  STATUS  SECONDS  OUTPUT"]
+    for result in results:
+        status = "ok" if result.ok else "FAILED"
+        detail = ", ".join(result.outputs) if result.ok else result.error
+        lines.append(
+            f"{result.name:<{width}}  {status:<6}  {result.seconds:7.1f}  {detail}"
+        )
+    return "\n".join(lines)
+
+
+def summary_json(results: list[BuildResult]) -> str:
+    return json.dumps([asdict(result) for result in results], indent=2)
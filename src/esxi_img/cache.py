@@ -0,0 +1,277 @@
+"""Content addressed cache of extracted ISO trees.
+
+Entries are keyed by the SHA-256 of the ISO and hold its extracted
+contents. Builds materialize an entry into their own scratch directory
+with hardlinks (or reflinks or copies when hardlinks are not possible)
+so the cached files are never modified. Access is coordinated between
+processes with flock(2): readers hold a shared lock on an entry while
+they use it and population and eviction take exclusive locks.
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from collections.abc import Iterator
+from pathlib import Path
+
+from esxi_img import isoindex
+from esxi_img import sparse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024 * 1024
+HASH_BUFSIZE = 1024 * 1024
+# indexes kept in memory by processes building several images, like the
+# workers of the build service, most recently used last
+MEMORY_INDEXES = 16
+
+_indexes: OrderedDict[str, isoindex.IsoIndex] = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def default_cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "esxi-img"
+
+
+def file_digest(path: str | Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _recall_index(digest: str) -> isoindex.IsoIndex | None:
+    with _indexes_lock:
+        index = _indexes.get(digest)
+        if index is not None:
+            _indexes.move_to_end(digest)
+        return index
+
+
+def _keep_index(index: isoindex.IsoIndex) -> None:
+    with _indexes_lock:
+        _indexes[index.sha256] = index
+        _indexes.move_to_end(index.sha256)
+        while len(_indexes) > MEMORY_INDEXES:
+            _indexes.popitem(last=False)
+
+
+@contextlib.contextmanager
+def _flock(path: Path, operation: int) -> Iterator[int]:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, operation)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _clone(src: Path, dst: Path) -> None:
+    """Share a file's data with a new path, falling back to a copy."""
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), sparse.FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(fsrc, fdst, HASH_BUFSIZE)
+
+
+def materialize(tree: Path, dest: Path) -> None:
+    """Recreate a cached tree at dest without copying the file data."""
+    for dirpath, _dirnames, filenames in os.walk(tree):
+        rel = Path(dirpath).relative_to(tree)
+        (dest / rel).mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            _clone(Path(dirpath) / filename, dest / rel / filename)
+
+
+def _tree_size(tree: Path) -> int:
+    return sum(
+        (Path(dirpath) / filename).stat().st_size
+        for dirpath, _dirnames, filenames in os.walk(tree)
+        for filename in filenames
+    )
+
+
+class IsoCache:
+    """An on-disk cache of extracted ISOs with a size cap and LRU eviction.
+
+    Layout of the cache directory::
+
+        digests/<dev>-<ino>-<size>-<mtime>  SHA-256 of a previously seen ISO
+        indexes/<sha256>.json               index of the files on an ISO
+        isos/<sha256>/tree/                 the extracted ISO
+        isos/<sha256>/size                  bytes used by tree
+        isos/<sha256>.lock                  flock coordinating the entry
+        tmp/                                in-progress extractions
+        lock                                flock serializing eviction
+    """
+
+    def __init__(self, root: Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.root = Path(root)
+        self.max_size = max_size
+        for sub in ("digests", "indexes", "isos", "tmp"):
+            (self.root / sub).mkdir(parents=True, exist_ok=True)
+
+    def _digest_memo(self, iso_path: str | Path) -> Path:
+        st = os.stat(iso_path)
+        return (
+            self.root
+            / "digests"
+            / f"{st.st_dev}-{st.st_ino}-{st.st_size}-{st.st_mtime_ns}"
+        )
+
+    @staticmethod
+    def _remember(memo: Path, digest: str) -> None:
+        tmp = memo.with_suffix(f".{os.getpid()}")
+        tmp.write_text(digest)
+        tmp.replace(memo)
+
+    def digest(self, iso_path: str | Path) -> str:
+        """SHA-256 of the ISO, remembered for unchanged files."""
+        memo = self._digest_memo(iso_path)
+        try:
+            return memo.read_text().strip()
+        except FileNotFoundError:
+            pass
+        digest = file_digest(iso_path)
+        self._remember(memo, digest)
+        return digest
+
+    def index(self, iso_path: str | Path) -> isoindex.IsoIndex:
+        """The index of the ISO, built the first time the ISO is seen.
+
+        The digest of an ISO seen for the first time is computed while it
+        is indexed rather than in a pass of its own. Indexes are kept in
+        memory by their digest too, so a long-running process only reads
+        each one from the cache directory once.
+        """
+        memo = self._digest_memo(iso_path)
+        try:
+            digest = memo.read_text().strip()
+        except FileNotFoundError:
+            digest = None
+        if digest is not None:
+            index = _recall_index(digest)
+            if index is not None:
+                return index
+            path = self.root / "indexes" / f"{digest}.json"
+            try:
+                index = isoindex.IsoIndex.from_json(path.read_text())
+                _keep_index(index)
+                return index
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logger.info("Rebuilding index of %s: %s", iso_path, e)
+        logger.info("Indexing %s", iso_path)
+        index = isoindex.IsoIndex.from_iso(iso_path, digest)
+        if digest is None:
+            self._remember(memo, index.sha256)
+        path = self.root / "indexes" / f"{index.sha256}.json"
+        tmp = path.with_suffix(f".{os.getpid()}")
+        tmp.write_text(index.to_json())
+        tmp.replace(path)
+        _keep_index(index)
+        return index
+
+    def _entry(self, digest: str) -> Path:
+        return self.root / "isos" / digest
+
+    def _lock_path(self, digest: str) -> Path:
+        return self.root / "isos" / f"{digest}.lock"
+
+    def _populate(self, digest: str, extract: Callable[[Path], None]) -> None:
+        entry = self._entry(digest)
+        staging = Path(tempfile.mkdtemp(dir=self.root / "tmp"))
+        try:
+            tree = staging / "tree"
+            tree.mkdir()
+            extract(tree)
+            # protect the cached files against builds writing through links
+            for dirpath, _dirnames, filenames in os.walk(tree):
+                for filename in filenames:
+                    os.chmod(Path(dirpath) / filename, 0o444)
+            (staging / "size").write_text(str(_tree_size(tree)))
+            staging.rename(entry)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    @contextlib.contextmanager
+    def tree(
+        self, iso_path: str | Path, extract: Callable[[Path], None]
+    ) -> Iterator[Path]:
+        """Provide the extracted tree of an ISO, extracting it on a miss.
+
+        The entry is protected from eviction while the context is held.
+
+        Args:
+            iso_path: Path to the ISO
+            extract: callable extracting the ISO into the directory given
+        """
+        digest = self.digest(iso_path)
+        entry = self._entry(digest)
+        lock = self._lock_path(digest)
+
+        with _flock(lock, fcntl.LOCK_EX) as fd:
+            if entry.exists():
+                logger.info("Using cached extraction of %s (%s)", iso_path, digest)
+            else:
+                logger.info("Caching extraction of %s (%s)", iso_path, digest)
+                self._populate(digest, extract)
+            os.utime(entry)
+            # keep holding the entry but let other builds share it
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            yield entry / "tree"
+
+        self.evict()
+
+    def entries(self) -> list[tuple[str, float, int]]:
+        """List cached ISOs as (digest, last used, size) oldest first."""
+        found = []
+        for entry in (self.root / "isos").iterdir():
+            if not entry.is_dir():
+                continue
+            try:
+                size = int((entry / "size").read_text())
+                found.append((entry.name, entry.stat().st_mtime, size))
+            except (FileNotFoundError, ValueError):
+                continue
+        return sorted(found, key=lambda item: item[1])
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until under the size cap.
+
+        Entries currently in use by another build are skipped.
+        """
+        with _flock(self.root / "lock", fcntl.LOCK_EX):
+            entries = self.entries()
+            total = sum(size for _digest, _used, size in entries)
+            for digest, _used, size in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    with _flock(self._lock_path(digest), fcntl.LOCK_EX | fcntl.LOCK_NB):
+                        logger.info("Evicting cached ISO %s", digest)
+                        doomed = self.root / "tmp" / f"{digest}.{time.time_ns()}"
+                        self._entry(digest).rename(doomed)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(doomed, ignore_errors=True)
+                total -= size
@@ -0,0 +1,204 @@
+"""Persistent work directories letting an interrupted build resume.
+
+A build given a work directory keeps its intermediate files there instead
+of in a temporary directory. Each stage records a marker once its outputs
+are complete, holding the SHA-256 of every file it produced, or only the
+size and mtime of the disk images which would take a read of their own
+to hash. A re-run of the same build checks the markers against the files
+and only runs the stages which are missing, were left incomplete or
+whose outputs changed since, along with every stage depending on them.
+
+Layout of a work directory::
+
+    key                 fingerprint of the build the directory belongs to
+    lock                flock held by the build using the directory
+    stages/<name>.json  marker of a completed stage
+    ...                 the intermediate files of the build
+
+A work directory holding the files of a different build is emptied
+before it is used. The directory is emptied once the build succeeds.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from esxi_img import cache
+from esxi_img import checksums
+
+logger = logging.getLogger(__name__)
+
+# the stages a stage's outputs are made from
+DEPENDS = {
+    "extract": (),
+    "helper": (),
+    "config": (),
+    "image": ("extract", "helper", "config"),
+    "convert": ("image",),
+}
+
+
+def _digest(path: Path) -> str | dict | None:
+    """SHA-256 of a file or of every file below a directory."""
+    if path.is_dir():
+        return {
+            str((Path(dirpath) / filename).relative_to(path)): cache.file_digest(
+                Path(dirpath) / filename
+            )
+            for dirpath, _dirnames, filenames in os.walk(path)
+            for filename in filenames
+        }
+    if path.is_file():
+        # images are sparse, their holes are hashed without being read
+        return checksums.file_checksums(path)["sha256"]
+    return None
+
+
+def _stamp(path: Path) -> list[int] | None:
+    """Size and mtime of a file, standing in for its digest."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _unchanged(path: Path, recorded: str | dict | list) -> bool:
+    if isinstance(recorded, list):
+        return _stamp(path) == recorded
+    return _digest(path) == recorded
+
+
+class WorkDir:
+    """A work directory with a marker for each completed stage.
+
+    Args:
+        root: the directory, created if needed
+        key: fingerprint of the build, a directory holding the files of
+             another build is emptied. Without a key the directory is a
+             scratch directory which never records stages.
+
+    Raises:
+        ValueError: If root isn't empty and isn't a work directory
+        BlockingIOError: If another build is using the directory
+    """
+
+    def __init__(self, root: Path, key: str | None = None) -> None:
+        self.root = Path(root)
+        self.enabled = key is not None
+        self._lock = None
+        if not self.enabled:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        key_path = self.root / "key"
+        if not key_path.exists() and any(
+            entry.name != "lock" for entry in self.root.iterdir()
+        ):
+            raise ValueError(f"{self.root} is not empty and not a work directory")
+
+        self._lock = os.open(self.root / "lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._lock)
+            raise
+
+        try:
+            previous = key_path.read_text().strip()
+        except FileNotFoundError:
+            previous = None
+        if previous != key:
+            if previous is not None:
+                logger.info("Discarding the work of another build in %s", self.root)
+            self.clear()
+            key_path.write_text(f"{key}\n")
+        (self.root / "stages").mkdir(exist_ok=True)
+
+    def close(self) -> None:
+        """Let other builds use the directory."""
+        if self._lock is not None:
+            os.close(self._lock)
+            self._lock = None
+
+    def clear(self) -> None:
+        """Remove everything but the lock."""
+        for entry in self.root.iterdir():
+            if entry.name == "lock":
+                continue
+            if entry.is_dir() and not entry.is_symlink():
+                shutil.rmtree(entry)
+            else:
+                entry.unlink()
+
+    def _marker(self, name: str) -> Path:
+        return self.root / "stages" / f"{name}.json"
+
+    def _invalidate(self, name: str) -> None:
+        self._marker(name).unlink(missing_ok=True)
+        for stage, depends in DEPENDS.items():
+            if name in depends:
+                self._invalidate(stage)
+
+    def done(self, name: str) -> dict | None:
+        """Check whether a stage is complete and its outputs are unchanged.
+
+        When it isn't, the markers of the stage and of every stage
+        depending on it are removed as the stage is about to be run again.
+
+        Returns:
+            dict: the data recorded with the stage, None when it has to run
+        """
+        if not self.enabled:
+            return None
+        try:
+            marker = json.loads(self._marker(name).read_text())
+            outputs = marker["outputs"]
+            for path, recorded in outputs.items():
+                if not _unchanged(self.root / path, recorded):
+                    raise ValueError(f"{path} changed")
+        except (OSError, ValueError, KeyError) as e:
+            if self._marker(name).exists():
+                logger.info("Running stage %s again: %s", name, e)
+            self._invalidate(name)
+            return None
+        logger.info("Resuming after completed stage %s", name)
+        return marker.get("data", {})
+
+    def complete(
+        self,
+        name: str,
+        paths: list[Path],
+        data: dict | None = None,
+        digests: dict[Path, str] | None = None,
+        stamp: bool = False,
+    ) -> None:
+        """Record a stage as complete with the files or trees it produced.
+
+        Args:
+            name: the stage
+            paths: its outputs, in the work directory or outside of it
+            data: anything else to record with the stage
+            digests: SHA-256 of outputs the stage hashed already, they
+                     aren't read again
+            stamp: record the size and mtime of the outputs instead of
+                   hashing them
+        """
+        if not self.enabled:
+            return
+        digests = digests or {}
+        outputs = {}
+        for path in paths:
+            if Path(path) in digests:
+                recorded = digests[Path(path)]
+            elif stamp:
+                recorded = _stamp(Path(path))
+            else:
+                recorded = _digest(Path(path))
+            outputs[os.path.relpath(path, self.root)] = recorded
+        marker = self._marker(name)
+        tmp = marker.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"outputs": outputs, "data": data or {}}))
+        tmp.replace(marker)
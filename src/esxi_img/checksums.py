@@ -0,0 +1,204 @@
+"""Checksums of the ISO and the images built from it.
+
+The ISO is hashed from the chunks the build streams off it, see
+OrderedHasher, anything the build doesn't read through Python is read
+once more after it, out of the page cache.
+Images are hashed once as they are put in place, SHA-256 and the MD5
+Glance records are computed in the same pass and the holes of sparse
+images are hashed as zeros without being read.
+
+Each output gets a manifest, ``<image>.manifest.json``, recording the
+digests along with the ISO it was built from and a fingerprint of every
+input of the build, which tells whether the image is up to date.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib.resources.abc import Traversable
+from pathlib import Path
+
+import esxi_img
+from esxi_img import cache
+from esxi_img import sparse
+
+HASH_BUFSIZE = 4 * 1024 * 1024
+_ZEROS = bytes(HASH_BUFSIZE)
+
+
+class OrderedHasher:
+    """SHA-256 of a file computed from the reads of whoever streams it.
+
+    Data fed in file order is hashed without being read again, whatever
+    the feeder skips is read by the hasher when it is passed and the rest
+    of the file in finish(). Data fed behind what was already hashed is
+    ignored, so feeding in any other order costs extra reads but still
+    gives the digest of the file.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self._fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self._fd).st_size
+        self._sha = hashlib.sha256()
+        self._pos = 0
+        # bytes hashed from fed data rather than read by the hasher
+        self.fed = 0
+        self._lock = threading.Lock()
+
+    def _read_up_to(self, offset: int) -> None:
+        while self._pos < offset:
+            chunk = os.pread(self._fd, min(HASH_BUFSIZE, offset - self._pos), self._pos)
+            if not chunk:
+                raise OSError("unexpected end of file")
+            self._sha.update(chunk)
+            self._pos += len(chunk)
+
+    def feed(self, offset: int, data) -> None:
+        """Hash data read from offset by someone else."""
+        with self._lock:
+            end = offset + len(data)
+            if end <= self._pos or self._fd < 0:
+                return
+            self._read_up_to(offset)
+            with memoryview(data) as view:
+                self._sha.update(view[self._pos - offset :])
+            self.fed += end - self._pos
+            self._pos = end
+
+    def finish(self) -> str:
+        """Hash what hasn't been fed and return the digest."""
+        with self._lock:
+            self._read_up_to(self.size)
+            self.close()
+            return self._sha.hexdigest()
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _chunks(fd: int, size: int):
+    """Yield the contents of a file in order, holes as views of zeros."""
+    offset = 0
+    for start, length in sparse.data_segments(fd, size):
+        while offset < start:
+            count = min(HASH_BUFSIZE, start - offset)
+            yield memoryview(_ZEROS)[:count]
+            offset += count
+        end = start + length
+        while offset < end:
+            chunk = os.pread(fd, min(HASH_BUFSIZE, end - offset), offset)
+            if not chunk:
+                raise OSError("unexpected end of file")
+            yield chunk
+            offset += len(chunk)
+    while offset < size:
+        count = min(HASH_BUFSIZE, size - offset)
+        yield memoryview(_ZEROS)[:count]
+        offset += count
+
+
+def file_checksums(path: str | Path) -> dict:
+    """Size, SHA-256 and MD5 of a file from a single read of its data."""
+    sha = hashlib.sha256()
+    # what Glance records, not for security
+    md5 = hashlib.md5(usedforsecurity=False)
+    with open(path, "rb") as f, ThreadPoolExecutor(max_workers=1) as pool:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        for chunk in _chunks(fd, size):
+            # both release the GIL so the two digests run side by side
+            pending = pool.submit(md5.update, chunk)
+            sha.update(chunk)
+            pending.result()
+    return {"size": size, "sha256": sha.hexdigest(), "md5": md5.hexdigest()}
+
+
+def helper_digest(path: str | Path) -> str:
+    """SHA-256 of an installer helper's tar stream.
+
+    The gzip header carries a timestamp so the tarball is hashed
+    decompressed, helpers with the same contents have the same digest.
+    """
+    try:
+        with gzip.open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    except gzip.BadGzipFile:
+        return cache.file_digest(path)
+
+
+def resources_digest(root: Traversable) -> str:
+    """SHA-256 over the names and contents of a package's files."""
+    digest = hashlib.sha256()
+    pending = [(root, "")]
+    while pending:
+        node, prefix = pending.pop()
+        for entry in sorted(node.iterdir(), key=lambda entry: entry.name):
+            name = f"{prefix}{entry.name}"
+            if entry.is_dir():
+                if entry.name != "__pycache__":
+                    pending.append((entry, f"{name}/"))
+            elif not entry.name.endswith(".pyc"):
+                data = entry.read_bytes()
+                digest.update(f"{name}\0{len(data)}\0".encode())
+                digest.update(data)
+    return digest.hexdigest()
+
+
+def fingerprint(inputs: dict) -> str:
+    """Digest of the inputs of a build, which must be JSON serializable."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def manifest_path(image_path: str | Path) -> Path:
+    return Path(f"{image_path}.manifest.json")
+
+
+def read_manifest(image_path: str | Path) -> dict | None:
+    """The manifest of an image, None when it has none or it's unreadable."""
+    try:
+        manifest = json.loads(manifest_path(image_path).read_text())
+    except (OSError, ValueError):
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+def write_manifest(
+    image_path: str | Path,
+    fmt: str,
+    image: dict,
+    iso_path: str | Path,
+    iso_sha256: str,
+    fingerprint: str | None = None,
+) -> Path:
+    """Write the manifest of a built image next to it.
+
+    Args:
+        image_path: the image the manifest describes
+        fmt: disk image format of the image
+        image: its checksums as returned by file_checksums()
+        iso_path: the ISO it was built from
+        iso_sha256: digest of the ISO
+        fingerprint: optional fingerprint of the build's inputs
+
+    Returns:
+        Path: where the manifest was written
+    """
+    path = manifest_path(image_path)
+    manifest = {
+        "esxi_img": esxi_img.__version__,
+        "iso": {
+            "name": Path(iso_path).name,
+            "size": os.stat(iso_path).st_size,
+            "sha256": iso_sha256,
+        },
+        "image": {"name": Path(image_path).name, "format": fmt, **image},
+    }
+    if fingerprint:
+        manifest["fingerprint"] = fingerprint
+    path.write_text(json.dumps(manifest, indent=2) + "\n")
+    return path
@@ -2,8 +2,13 @@
 """esxi-img: A utility to repackage VMware ESXi installer ISO as an OpenStack image."""
 
 import argparse
+import contextlib
+import fcntl
+import functools
+import gzip
 import importlib.resources
 import io
+import json
 import logging
 import os
 import platform
@@ -14,13 +19,34 @@ import subprocess
 import sys
 import tarfile
 import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from pathlib import PurePath
+from pathlib import PurePosixPath
 
 import esxi_netinit
 import pycdlib
 
 import esxi_img
+from esxi_img import cache
+from esxi_img import checkpoint
+from esxi_img import checksums
+from esxi_img import diff as esxi_diff
+from esxi_img import fat32
+from esxi_img import fscopy
+from esxi_img import gpt
+from esxi_img import imginfo
+from esxi_img import isofs
+from esxi_img import isoindex
+from esxi_img import isoinfo
+from esxi_img import profiling
+from esxi_img import qcow2
+from esxi_img import reproducible
+from esxi_img import sizing
+from esxi_img import sparse
+from esxi_img.fat32 import Fat32Builder
 from esxi_img.tarball import Tarball
 
 BLOCKDEV_MODE = stat.S_IFBLK + stat.S_IRUSR + stat.S_IWUSR + stat.S_IRGRP + stat.S_IWGRP
@@ -31,6 +57,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger("esxi-img")
 
+IMAGE_FORMATS = ("raw", "qcow2", "vmdk")
+
+# boot configs which get patched to load our installer helper and kickstart
+BOOT_CFG_PATHS = (PurePosixPath("BOOT.CFG"), PurePosixPath("EFI/BOOT/BOOT.CFG"))
+
 
 def _read_ks_template() -> str:
     return (
@@ -117,11 +148,15 @@ def generate_ks_template(output_path: str) -> int:
         return 1
 
 
-def generate_installer_helper(ks_template_path: str | None, output_path: str) -> int:
+def generate_installer_helper(
+    ks_template_path: str | None, output_path: str, mtime: int | None = None
+) -> int:
     """Generate an installer helper tarball.
 
     Args:
         output_path: Path to write the installer helper tarball to
+        mtime: Optional fixed time for the tar entries and gzip header,
+               the gzip header gets the current time otherwise
 
     Returns:
         int: Exit code (0 for success, non-zero for failure)
@@ -153,8 +188,13 @@ def generate_installer_helper(ks_template_path: str | None, output_path: str) ->
     try:
         # Add files and directories to the tarball
 
-        # ESXi's VisorFSTar wants "old" GNU format
-        with tarfile.open(output_path, "w:gz", format=tarfile.GNU_FORMAT) as tar:
+        # ESXi's VisorFSTar wants "old" GNU format. The gzip stream is set
+        # up here so its header doesn't carry the name of the output file
+        with (
+            open(output_path, "wb") as raw,
+            gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=mtime) as gz,
+            tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT) as tar,
+        ):
             # Add all files from the list
             for path, ftype, content in tarball.iter_files():
                 if ftype == tarfile.DIRTYPE:
@@ -165,6 +205,7 @@ def generate_installer_helper(ks_template_path: str | None, output_path: str) ->
                 tar_info = tarfile.TarInfo(name=arcname)
                 tar_info.uid = 0
                 tar_info.gid = 0
+                tar_info.mtime = mtime or 0
                 tar_info.type = ftype
                 if ftype == tarfile.DIRTYPE:
                     tar_info.mode = 0o0755
@@ -187,11 +228,9 @@ def generate_installer_helper(ks_template_path: str | None, output_path: str) ->
         return 1
 
 
-def update_esxi_config(file_path: Path):
-    lines = file_path.read_text().splitlines()
-
+def _patch_esxi_config(text: str) -> str:
     updated_lines = []
-    for line in lines:
+    for line in text.splitlines():
         if line.startswith("modules="):
             if not line.strip().endswith("--- /esxiimg.tgz"):
                 line = line.strip() + " --- /esxiimg.tgz"
@@ -202,33 +241,136 @@ def update_esxi_config(file_path: Path):
             line += " ks=file:///esxiimg/KS.CFG"
         updated_lines.append(line)
 
-    file_path.write_text("\n".join(updated_lines) + "\n")
+    return "\n".join(updated_lines) + "\n"
+
+
+def _replace_text(file_path: Path, text: str) -> None:
+    # replace rather than rewrite the file so a hardlink into the cache
+    # is broken instead of written through
+    file_path.unlink()
+    file_path.write_text(text)
+
+
+def update_esxi_config(file_path: Path):
+    _replace_text(file_path, _patch_esxi_config(file_path.read_text()))
+
+
+def _installer_helper(
+    work: checkpoint.WorkDir,
+    ks_template_path: str | None,
+    esxiimg_path: str | None,
+    helper_path: Path,
+    mtime: int | None,
+    profiler: profiling.Profiler,
+) -> str:
+    """Put the installer helper for an image at helper_path.
+
+    Returns:
+        str: the SHA-256 of the helper
+    """
+    if work.done("helper") is not None:
+        return cache.file_digest(helper_path)
+    if esxiimg_path:
+        logger.info("Using installer helper from %s", esxiimg_path)
+        shutil.copy(esxiimg_path, helper_path)
+    else:
+        if ks_template_path:
+            logger.info("Using kickstart template from %s", ks_template_path)
+        with profiler.stage("generate_installer_helper"):
+            if generate_installer_helper(ks_template_path, helper_path, mtime) != 0:
+                raise RuntimeError("Failed to generate installer helper")
+    work.complete("helper", [helper_path])
+    return cache.file_digest(helper_path)
+
+
+@dataclass(frozen=True)
+class BuildOptions:
+    """How generate_image() builds images from an ISO.
+
+    Attributes:
+        ks_template_path: Optional path to a kickstart template
+        esxiimg_path: Optional path to an installer helper tarball
+        builder: How to build the disk image, "python" writes it in-process
+                 while "host" uses the operating system's disk tools
+        jobs: Maximum number of files to extract from the ISO concurrently
+        cache_dir: Optional directory to cache extracted ISOs in
+        cache_max_size: Size in bytes the ISO cache is trimmed down to
+        slack: Free space to leave in the ESP, a percentage or a size
+        compress: Compress the clusters of qcow2 images
+        profile_path: Optional path to write a JSON report of the time and
+                      resources each stage took to
+        base_path: Optional raw image previously built from the same ISO,
+                   only its installer helper and boot configs are replaced
+        backing_path: Optional qcow2 image shared by every image of the ISO,
+                      built first if it doesn't exist yet. qcow2 outputs
+                      are written as overlays holding only what differs
+        manifest: Write the checksums of each output and of the ISO to a
+                  JSON manifest next to it
+        source_date_epoch: Optional UNIX time to build a reproducible image
+                           with, defaults to $SOURCE_DATE_EPOCH
+        force: Rebuild and overwrite the outputs even if they are up to date
+        work_dir: Optional directory to keep the intermediate files in, a
+                  build interrupted or failing part way is resumed from
+                  its first incomplete stage when run again
+    """
+
+    ks_template_path: str | None = None
+    esxiimg_path: str | None = None
+    builder: str = "python"
+    jobs: int | None = None
+    cache_dir: str | None = None
+    cache_max_size: int = cache.DEFAULT_MAX_SIZE
+    slack: str = sizing.DEFAULT_SLACK
+    compress: bool = False
+    profile_path: str | None = None
+    base_path: str | None = None
+    backing_path: str | None = None
+    manifest: bool = True
+    source_date_epoch: int | None = None
+    force: bool = False
+    work_dir: str | None = None
 
 
 def generate_image(
     iso_path: str,
-    output_path: str,
-    fmt: str,
-    ks_template_path: str | None = None,
-    esxiimg_path: str | None = None,
+    output_path: str | list[str],
+    fmt: str | list[str],
+    options: BuildOptions | None = None,
 ) -> int:
     """Generate an OpenStack image from an ESXi ISO.
 
+    Existing outputs are only rebuilt when the fingerprint of the inputs
+    recorded in their manifests no longer matches, outputs without a
+    manifest are never overwritten unless force is set.
+
     Args:
         iso_path: Path to the ESXi installer ISO
-        output_path: Path to write the output disk image to
-        fmt: Disk image format
-        ks_template_path: Optional path to a kickstart template
-        esxiimg_path: Optional path to an installer helper tarball
+        output_path: Path to write the output disk image to, or a list of
+                     paths to build several images from one disk
+        fmt: Disk image format, or a list with one per output path
+        options: How to build the images, the defaults when not given
 
     Returns:
         int: Exit code (0 for success, non-zero for failure)
     """
-    logger.info("Generating OpenStack image from %s to %s", iso_path, output_path)
+    options = options or BuildOptions()
+    output_paths = [output_path] if isinstance(output_path, str) else output_path
+    fmts = [fmt] * len(output_paths) if isinstance(fmt, str) else fmt
+    if len(fmts) != len(output_paths):
+        logger.error("Expected one format for each of the %d images", len(fmts))
+        return 1
+    outputs = [
+        (Path(path).resolve(), out_fmt)
+        for path, out_fmt in zip(output_paths, fmts, strict=True)
+    ]
+    logger.info(
+        "Generating OpenStack image from %s to %s",
+        iso_path,
+        ", ".join(str(path) for path in output_paths),
+    )
 
-    out_path = Path(output_path).resolve()
-    if out_path.exists():
-        logger.error("%s already exists, remove it first", out_path)
+    if len({out_path for out_path, _out_fmt in outputs}) != len(outputs):
+        logger.error("The same output path was given more than once")
         return 1
 
     # Validate ISO path
@@ -237,111 +379,1010 @@ def generate_image(
         logger.error("ISO file not found: %s", iso_path)
         return 1
 
-    try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_path = Path(temp_dir)
-            iso_extract_dir = temp_path / "iso_contents"
-            iso_extract_dir.mkdir()
-
-            # Extract ISO contents using pycdlib
-            logger.info("Extracting ISO contents to %s", iso_extract_dir)
-            _extract_iso(iso_path, iso_extract_dir)
+    if options.base_path and not Path(options.base_path).exists():
+        logger.error("Base image not found: %s", options.base_path)
+        return 1
 
-            # Copy kickstart template if provided
-            if ks_template_path:
-                ks_file = Path(ks_template_path)
-                if not ks_file.exists():
-                    logger.error("Kickstart template not found: %s", ks_template_path)
-                    return 1
+    if options.compress and "qcow2" not in fmts:
+        logger.error("Compression is only supported for qcow2 images")
+        return 1
 
-                logger.info("Using kickstart template from %s", ks_template_path)
+    overlay_dirs = set()
+    if options.backing_path:
+        if options.base_path:
+            logger.error("A base image and a backing image can't both be used")
+            return 1
+        overlay_dirs = {
+            out_path.parent for out_path, out_fmt in outputs if out_fmt == "qcow2"
+        }
+        if not overlay_dirs:
+            logger.error("A backing image is only used by qcow2 images")
+            return 1
+        if len(overlay_dirs) > 1:
+            # the backing file is recorded relative to the overlay
+            logger.error("qcow2 images with a backing image must share a directory")
+            return 1
 
-            # Extract installer helper tarball if provided
-            if esxiimg_path:
-                esxiimg_file = Path(esxiimg_path)
-                if not esxiimg_file.exists():
-                    logger.error("Installer helper tarball not found: %s", esxiimg_path)
-                    return 1
+    if options.ks_template_path and not Path(options.ks_template_path).exists():
+        logger.error("Kickstart template not found: %s", options.ks_template_path)
+        return 1
 
-                logger.info("Using installer helper from %s", esxiimg_path)
-                shutil.copy(esxiimg_path, iso_extract_dir / "ESXIIMG.TGZ")
-            else:
-                generate_installer_helper(
-                    ks_template_path, iso_extract_dir / "ESXIIMG.TGZ"
-                )
+    if options.esxiimg_path and not Path(options.esxiimg_path).exists():
+        logger.error("Installer helper tarball not found: %s", options.esxiimg_path)
+        return 1
 
-            update_esxi_config(iso_extract_dir / "BOOT.CFG")
-            update_esxi_config(iso_extract_dir / "EFI" / "BOOT" / "BOOT.CFG")
+    profiler = profiling.Profiler(enabled=options.profile_path is not None)
+    iso_sha256 = None
+    try:
+        slack_policy = sizing.Slack.parse(options.slack)
+        epoch = reproducible.source_date_epoch(options.source_date_epoch)
+        inputs = _build_inputs(
+            options.ks_template_path,
+            options.esxiimg_path,
+            options.builder,
+            options.slack,
+            options.compress,
+            options.base_path,
+            options.backing_path,
+            epoch,
+        )
 
-            # Calculate required size (e.g., ISO size + 200MB)
-            size_mb = (
-                sum(
-                    f.stat().st_size
-                    for f in iso_extract_dir.glob("**/*")
-                    if f.is_file()
+        existing = [out_path for out_path, _out_fmt in outputs if out_path.exists()]
+        if existing and not options.force:
+            manifests = [checksums.read_manifest(out_path) for out_path in existing]
+            for out_path, recorded in zip(existing, manifests, strict=True):
+                if not recorded or "fingerprint" not in recorded:
+                    logger.error(
+                        "%s already exists, remove it first or use --force", out_path
+                    )
+                    return 1
+            # an overlay is rebuilt along with its missing backing image
+            backing_lost = (
+                options.backing_path is not None
+                and not Path(options.backing_path).exists()
+            )
+            if len(existing) == len(outputs) and not backing_lost:
+                known = _recorded_iso_sha256(iso_file, existing, manifests)
+                iso_sha256 = known or _iso_sha256(
+                    iso_path, options.cache_dir, options.cache_max_size
                 )
-                // (1024 * 1024)
-                + 200
+                if all(
+                    recorded["fingerprint"]
+                    == checksums.fingerprint(
+                        {**inputs, "iso": iso_sha256, "format": out_fmt}
+                    )
+                    for (_out_path, out_fmt), recorded in zip(
+                        outputs, manifests, strict=True
+                    )
+                ):
+                    logger.info("%s up to date", ", ".join(map(str, existing)))
+                    return 0
+        if existing:
+            logger.info("Rebuilding %s", ", ".join(map(str, existing)))
+            # an interrupted rebuild mustn't leave outputs looking up to date
+            for out_path in existing:
+                checksums.manifest_path(out_path).unlink(missing_ok=True)
+
+        if epoch is not None and (options.builder == "host" or "vmdk" in fmts):
+            logger.warning(
+                "The host builder and qemu-img's vmdk images aren't reproducible"
             )
 
-            # Create raw disk image
-            disk_img_path = temp_path / "disk.img"
-            logger.info("Creating disk image (%dmb) at %s", size_mb, disk_img_path)
-            if _create_disk_img(iso_extract_dir, disk_img_path, size_mb) != 0:
-                return 1
+        if options.work_dir:
+            # the work directory belongs to this exact build
+            iso_sha256 = iso_sha256 or _iso_sha256(
+                iso_path, options.cache_dir, options.cache_max_size
+            )
+            key = checksums.fingerprint(
+                {
+                    **inputs,
+                    "iso": iso_sha256,
+                    "outputs": [[str(path), out_fmt] for path, out_fmt in outputs],
+                }
+            )
 
-            if fmt != "raw":
-                _convert_img(disk_img_path, out_path, fmt)
+        with contextlib.ExitStack() as stack:
+            if options.work_dir:
+                work = checkpoint.WorkDir(Path(options.work_dir), key)
+                stack.callback(work.close)
+                logger.info("Keeping intermediate files in %s", options.work_dir)
             else:
-                disk_img_path.rename(out_path)
-
-            logger.info("Successfully created image at %s", out_path)
+                temp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                work = checkpoint.WorkDir(Path(temp_dir))
+            # the pool is shut down before the work directory is released
+            background = stack.enter_context(ThreadPoolExecutor(max_workers=2))
+            temp_path = work.root
+            if epoch is not None and iso_sha256 is None:
+                # the identifiers of the image are derived from the ISO
+                with profiler.stage("hash_iso"):
+                    iso_sha256 = _iso_sha256(
+                        iso_path, options.cache_dir, options.cache_max_size
+                    )
+            # the cache knows the digest of the ISO, otherwise it is hashed
+            # from what the build reads of it
+            iso_hasher = None
+            if options.manifest and not options.cache_dir and iso_sha256 is None:
+                iso_hasher = checksums.OrderedHasher(iso_path)
+                stack.callback(iso_hasher.close)
+
+            # the in-process builder writes raw and qcow2 images directly and
+            # all of them at once, anything else is converted from a raw image
+            native = ("raw", "qcow2") if options.builder == "python" else ("raw",)
+            image_fmts = {out_fmt for _out_path, out_fmt in outputs}
+            images = {
+                image_fmt: temp_path / f"disk.{image_fmt}"
+                for image_fmt in sorted(image_fmts & set(native))
+            }
+            if image_fmts - images.keys() or options.base_path or options.backing_path:
+                images.setdefault("raw", temp_path / "disk.raw")
+
+            published = work.done("convert")
+            if published is None and work.done("image") is None:
+                if _build_images(
+                    work,
+                    background,
+                    profiler,
+                    iso_path,
+                    images,
+                    overlay_dirs,
+                    options,
+                    slack_policy,
+                    epoch,
+                    iso_sha256,
+                    iso_hasher,
+                ):
+                    return 1
+                # hashing the images would read them once more
+                work.complete("image", list(images.values()), stamp=True)
+            if iso_hasher is not None:
+                # whatever the build didn't stream is still in the page cache
+                with profiler.stage("hash_iso"):
+                    iso_sha256 = iso_hasher.finish()
+
+            if published is None:
+                with profiler.stage("convert_img"):
+                    sums = _publish_images(images, outputs, options.compress)
+                work.complete(
+                    "convert",
+                    [out_path for out_path, _out_fmt in outputs],
+                    {"sums": {str(path): value for path, value in sums.items()}},
+                    {path: value["sha256"] for path, value in sums.items()},
+                )
+            else:
+                sums = {Path(path): value for path, value in published["sums"].items()}
+
+            if options.manifest:
+                if options.backing_path:
+                    # the backing image may only have been built just now
+                    inputs["backing"] = _file_stamp(options.backing_path)
+                with profiler.stage("write_manifest"):
+                    if iso_sha256 is None:
+                        iso_sha256 = _iso_sha256(
+                            iso_path, options.cache_dir, options.cache_max_size
+                        )
+                    for out_path, out_fmt in outputs:
+                        written = checksums.write_manifest(
+                            out_path,
+                            out_fmt,
+                            sums[out_path],
+                            iso_path,
+                            iso_sha256,
+                            checksums.fingerprint(
+                                {**inputs, "iso": iso_sha256, "format": out_fmt}
+                            ),
+                        )
+                        logger.info("Wrote image manifest to %s", written)
+
+            for out_path, _out_fmt in outputs:
+                logger.info(
+                    "Successfully created image at %s (%d bytes, %d bytes allocated)",
+                    out_path,
+                    sparse.apparent_size(out_path),
+                    sparse.allocated_size(out_path),
+                )
+            if options.work_dir:
+                work.clear()
             return 0
     except Exception:
         logger.exception("Failed to generate image")
         return 1
+    finally:
+        if options.profile_path:
+            profiler.write(
+                options.profile_path,
+                iso=str(iso_path),
+                outputs=[
+                    {"path": str(out_path), "format": out_fmt}
+                    for out_path, out_fmt in outputs
+                ],
+                builder=options.builder,
+            )
+            logger.info("Wrote build profile to %s", options.profile_path)
+
+
+def _build_images(
+    work: checkpoint.WorkDir,
+    background: ThreadPoolExecutor,
+    profiler: profiling.Profiler,
+    iso_path: str,
+    images: dict[str, Path],
+    overlay_dirs: set[Path],
+    options: BuildOptions,
+    slack_policy: sizing.Slack,
+    epoch: int | None,
+    iso_sha256: str | None = None,
+    iso_hasher: checksums.OrderedHasher | None = None,
+) -> int:
+    """Build the disk images of generate_image() in the work directory.
+
+    The identifiers of a reproducible build, with an epoch, are derived
+    from the digest of the ISO so it has to be known up front.
+
+    Returns:
+        int: Exit code (0 for success, non-zero for failure)
+    """
+    temp_path = work.root
+    # replaced by the expanded backing image when there is one
+    base_path = options.base_path
+    # left behind by an interrupted build
+    for path in images.values():
+        path.unlink(missing_ok=True)
+
+    # The installer helper doesn't depend on the ISO so it is built while
+    # the ISO is read and only waited for once the disk image is laid out
+    helper_path = temp_path / "ESXIIMG.TGZ"
+    helper = background.submit(
+        _installer_helper,
+        work,
+        options.ks_template_path,
+        options.esxiimg_path,
+        helper_path,
+        epoch,
+        profiler,
+    )
+
+    def wait_for_helper() -> reproducible.Identity | None:
+        helper_sha256 = helper.result()
+        if epoch is None:
+            return None
+        return reproducible.Identity.derive(epoch, helper_sha256, iso_sha256)
+
+    if options.backing_path:
+        with profiler.stage("build_backing_img"):
+            _ensure_backing_img(
+                options.backing_path,
+                iso_path,
+                options.builder,
+                options.jobs,
+                options.cache_dir,
+                options.cache_max_size,
+                options.slack,
+                options.compress,
+                epoch,
+            )
+        base_path = str(temp_path / "backing.raw")
+        Path(base_path).unlink(missing_ok=True)
+        with profiler.stage("expand_backing_img"):
+            qcow2.expand(options.backing_path, base_path)
+
+    if base_path:
+        raw_path = images["raw"]
+        identity = wait_for_helper()
+        logger.info("Patching base image %s into %s", base_path, raw_path)
+        with profiler.stage("patch_base_img"):
+            written = _patch_base_img(
+                base_path, iso_path, helper_path, raw_path, identity
+            )
+        logger.info("Rewrote %d bytes of the base image", written)
+        if "qcow2" in images and options.backing_path:
+            backing_file = os.path.relpath(
+                Path(options.backing_path).resolve(), next(iter(overlay_dirs))
+            )
+            with profiler.stage("write_qcow2"):
+                stored = qcow2.overlay(
+                    raw_path,
+                    base_path,
+                    images["qcow2"],
+                    backing_file,
+                    options.compress,
+                )
+            logger.info(
+                "Wrote %d clusters on top of backing image %s",
+                stored,
+                backing_file,
+            )
+        elif "qcow2" in images:
+            with profiler.stage("write_qcow2"):
+                qcow2.convert(raw_path, images["qcow2"], options.compress)
+        return 0
+
+    if options.builder == "python" and not options.cache_dir:
+        # Write the ISO contents straight into the disk images
+        logger.info(
+            "Streaming ISO contents into disk image %s",
+            ", ".join(str(path) for path in images.values()),
+        )
+        identity = wait_for_helper()
+        with profiler.stage("stream_disk_img"):
+            _stream_disk_img(
+                iso_path,
+                helper_path,
+                images,
+                slack_policy,
+                options.compress,
+                identity,
+                iso_hasher,
+            )
+        return 0
+
+    # the cache keeps an index of the ISO so its directory records
+    # don't need to be walked again
+    index = None
+    if options.cache_dir:
+        iso_cache = cache.IsoCache(Path(options.cache_dir), options.cache_max_size)
+        with profiler.stage("index_iso"):
+            index = iso_cache.index(iso_path)
+
+    # the boot configs are patched while the rest is extracted
+    config_dir = temp_path / "boot_configs"
+    configs = background.submit(_write_boot_configs, work, iso_path, config_dir, index)
+
+    # the files of the ESP are linked from the extracted ISO, which stays
+    # untouched so it can be reused by a later build
+    esp_dir = temp_path / "esp"
+    if esp_dir.exists():
+        shutil.rmtree(esp_dir)
+    if options.cache_dir:
+        with (
+            profiler.stage("extract_iso"),
+            iso_cache.tree(
+                iso_path, lambda tree: extract_iso(iso_path, tree, options.jobs, index)
+            ) as tree,
+        ):
+            logger.info("Linking cached ISO contents to %s", esp_dir)
+            cache.materialize(tree, esp_dir)
+    else:
+        iso_extract_dir = temp_path / "iso_contents"
+        if work.done("extract") is None:
+            if iso_extract_dir.exists():
+                shutil.rmtree(iso_extract_dir)
+            iso_extract_dir.mkdir()
 
+            # Extract ISO contents using pycdlib
+            logger.info("Extracting ISO contents to %s", iso_extract_dir)
+            with profiler.stage("extract_iso"):
+                extract_iso(iso_path, iso_extract_dir, options.jobs)
+            work.complete("extract", [iso_extract_dir])
+        cache.materialize(iso_extract_dir, esp_dir)
+
+    with profiler.stage("update_esxi_config"):
+        configs.result()
+        for config in sorted(config_dir.rglob("*")):
+            if config.is_file():
+                _replace_text(
+                    esp_dir / config.relative_to(config_dir), config.read_text()
+                )
+
+    identity = wait_for_helper()
+    shutil.copy(helper_path, esp_dir / "ESXIIMG.TGZ")
+
+    with profiler.stage("size_esp"):
+        layout = Fat32Builder()
+        layout.add_tree(esp_dir)
+        esp_size = sizing.compute(layout, slack_policy)
+    _log_esp_size(esp_size)
+
+    # Create raw disk image
+    logger.info(
+        "Creating disk image (%dmb) at %s",
+        esp_size.size_mb,
+        ", ".join(str(path) for path in images.values()),
+    )
+    with profiler.stage("create_disk_img"):
+        if (
+            _create_disk_img(
+                esp_dir,
+                images,
+                esp_size,
+                options.builder,
+                options.compress,
+                identity,
+            )
+            != 0
+        ):
+            return 1
+
+    # mkfs and the copy may have written out blocks of zeros
+    if "raw" in images:
+        with profiler.stage("punch_zero_holes"):
+            punched = sparse.punch_zero_holes(images["raw"])
+        if punched:
+            logger.info("Deallocated %d bytes of zeros", punched)
+    return 0
 
-def _extract_iso(iso_path: str, output_dir: Path) -> None:
+
+def _build_inputs(
+    ks_template_path: str | None,
+    esxiimg_path: str | None,
+    builder: str,
+    slack: str,
+    compress: bool,
+    base_path: str | None,
+    backing_path: str | None,
+    epoch: int | None,
+) -> dict:
+    """Everything other than the ISO and format which shapes an image."""
+    if esxiimg_path:
+        helper = {"tarball": checksums.helper_digest(esxiimg_path)}
+    else:
+        helper = {
+            "kickstart": (
+                cache.file_digest(ks_template_path) if ks_template_path else None
+            ),
+            "data": checksums.resources_digest(
+                importlib.resources.files(esxi_img).joinpath("data")
+            ),
+            "netinit": checksums.resources_digest(
+                importlib.resources.files(esxi_netinit)
+            ),
+        }
+    inputs = {
+        "esxi_img": esxi_img.__version__,
+        "helper": helper,
+        "builder": builder,
+        "slack": slack,
+        "compress": compress,
+        "source_date_epoch": epoch,
+        "backing": _file_stamp(backing_path) if backing_path else None,
+        "base": _file_stamp(base_path) if base_path else None,
+    }
+    return inputs
+
+
+def _file_stamp(path: str) -> list:
+    """Identify an image other builds start from by its path, size and mtime.
+
+    An image which doesn't exist (yet) has neither.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return [str(Path(path).resolve()), None, None]
+    return [str(Path(path).resolve()), st.st_size, st.st_mtime_ns]
+
+
+def _iso_sha256(iso_path: str, cache_dir: str | None, cache_max_size: int) -> str:
+    if cache_dir:
+        return cache.IsoCache(Path(cache_dir), cache_max_size).digest(iso_path)
+    return cache.file_digest(iso_path)
+
+
+def _recorded_iso_sha256(
+    iso_file: Path, images: list[Path], manifests: list[dict]
+) -> str | None:
+    """The ISO digest recorded with images built after it last changed.
+
+    Like make, an ISO no newer than the images which has the size they
+    recorded is taken to be the one they were built from and isn't read.
+    """
+    st = iso_file.stat()
+    recorded = {
+        (manifest.get("iso") or {}).get("sha256")
+        for manifest in manifests
+        if (manifest.get("iso") or {}).get("size") == st.st_size
+    }
+    if len(recorded) != 1 or len(manifests) != len(images):
+        return None
+    newest_iso = st.st_mtime_ns
+    if any(
+        checksums.manifest_path(image).stat().st_mtime_ns < newest_iso
+        for image in images
+    ):
+        return None
+    return recorded.pop()
+
+
+def _publish_images(
+    images: dict[str, Path],
+    outputs: list[tuple[Path, str]],
+    compress: bool = False,
+) -> dict[Path, dict]:
+    """Put the built disk images in place as the requested outputs.
+
+    Formats which weren't built directly are converted from the raw image
+    concurrently, each built image is then moved to its last output and
+    copied to any other output of the same format. Every distinct image
+    is hashed once while the others are converted.
+
+    Args:
+        images: the built disk images by format
+        outputs: output paths and their formats
+        compress: Compress the clusters of qcow2 images
+
+    Returns:
+        dict[Path, dict]: the checksums of each output
+    """
+
+    def _convert(out_path: Path, out_fmt: str) -> dict:
+        _convert_img(images["raw"], out_path, out_fmt, compress and out_fmt == "qcow2")
+        # hash the image while it is still in the page cache
+        return checksums.file_checksums(out_path)
+
+    conversions = [
+        (out_path, out_fmt) for out_path, out_fmt in outputs if out_fmt not in images
+    ]
+    direct = [(out_path, out_fmt) for out_path, out_fmt in outputs if out_fmt in images]
+    direct_fmts = sorted({out_fmt for _out_path, out_fmt in direct})
+    with ThreadPoolExecutor(max_workers=len(conversions) + len(direct_fmts)) as pool:
+        converted = {
+            out_path: pool.submit(_convert, out_path, out_fmt)
+            for out_path, out_fmt in conversions
+        }
+        hashed = {
+            out_fmt: pool.submit(checksums.file_checksums, images[out_fmt])
+            for out_fmt in direct_fmts
+        }
+        sums = {out_path: future.result() for out_path, future in converted.items()}
+        for out_path, out_fmt in direct:
+            sums[out_path] = hashed[out_fmt].result()
+
+    for n, (out_path, out_fmt) in enumerate(direct):
+        if any(later_fmt == out_fmt for _later, later_fmt in direct[n + 1 :]):
+            sparse.copy(images[out_fmt], out_path)
+        else:
+            sparse.move(images[out_fmt], out_path)
+    return sums
+
+
+def extract_iso(
+    iso_path: str,
+    output_dir: Path,
+    workers: int | None = None,
+    index: isoindex.IsoIndex | None = None,
+) -> None:
     """Extract ISO contents using pycdlib.
 
+    The file list is built up front and the file data is then copied
+    by a pool of workers using positioned reads against the ISO.
+
     Args:
         iso_path: Path to the ISO file
         output_dir: Directory to extract contents to
+        workers: Maximum number of files to copy concurrently
+        index: Optional index of the ISO, its directory records are only
+               walked without one
 
     Raises:
         Exception: If extraction fails
     """
+    if index is not None:
+        dirs, files = index.tree()
+    else:
+        iso = pycdlib.PyCdlib()
+        iso.open(iso_path)
+        try:
+            dirs, files = isofs.list_tree(iso)
+        finally:
+            iso.close()
+    for dirname in dirs:
+        (output_dir / dirname).mkdir(parents=True, exist_ok=True)
+
+    # anything pycdlib has to assemble itself is copied through it
+    assembled = [file for file in files if file.offset is None]
+    if assembled:
+        iso = pycdlib.PyCdlib()
+        iso.open(iso_path)
+        try:
+            for file in assembled:
+                logger.info("Copying %s to %s", file.iso_path, file.path)
+                with open(output_dir / file.path, "wb") as f:
+                    iso.get_file_from_iso_fp(f, iso_path=file.iso_path)
+        finally:
+            iso.close()
+
+    direct = [file for file in files if file.offset is not None]
+    total_bytes = sum(file.size for file in direct)
+    step = max(len(direct) // 10, 1)
+
+    def _progress(done_files: int, done_bytes: int) -> None:
+        if done_files % step == 0 or done_files == len(direct):
+            logger.info(
+                "Extracted %d/%d files (%d/%d MiB)",
+                done_files,
+                len(direct),
+                done_bytes // (1024 * 1024),
+                total_bytes // (1024 * 1024),
+            )
+
+    isofs.copy_extents(iso_path, direct, output_dir, workers, _progress)
+
+
+def _log_esp_size(esp_size: sizing.EspSize) -> None:
+    logger.info(
+        "Sizing: %d bytes of files in %d clusters of %d bytes, "
+        "%d bytes of FATs, %d bytes of slack, %d bytes of GPT and alignment "
+        "for a %d byte image",
+        esp_size.data_bytes,
+        esp_size.used_clusters,
+        esp_size.cluster_size,
+        esp_size.fat_bytes,
+        esp_size.slack_bytes,
+        esp_size.gpt_bytes,
+        esp_size.disk_size,
+    )
+
+
+def _stream_disk_img(
+    iso_path: str,
+    helper_path: Path,
+    images: dict[str, Path],
+    slack: sizing.Slack | None = None,
+    compress: bool = False,
+    identity: reproducible.Identity | None = None,
+    iso_hasher: checksums.OrderedHasher | None = None,
+) -> None:
+    """Create a disk image directly from the files on the ISO.
+
+    Every file is read from the ISO once and written straight to its
+    place in the EFI System Partition from a memory map of the ISO. Only
+    the BOOT.CFG files, which need to be patched, are held in memory.
+
+    Args:
+        iso_path: Path to the ESXi installer ISO
+        helper_path: Path to the installer helper tarball to include
+        images: Paths to write the disk image to by format, raw or qcow2
+        slack: Free space to leave in the ESP
+        compress: Compress the clusters of qcow2 images
+        identity: Optional fixed timestamp and identifiers for the disk
+        iso_hasher: Optional hasher of the ISO fed what is streamed off it
+    """
+    observe = iso_hasher.feed if iso_hasher else None
     iso = pycdlib.PyCdlib()
     iso.open(iso_path)
+    try:
+        with isofs.mapped(iso_path) as iso_map:
+            dirs, files = isofs.list_tree(iso)
+
+            fs = _new_fat32(identity)
+            for dirname in dirs:
+                fs.add_dir(dirname)
+            # add the files in the order Fat32Builder.add_tree() would add an
+            # extracted copy so either way of building lays the disk out alike
+            helper = isofs.IsoFile("", PurePosixPath("ESXIIMG.TGZ"), 0)
+            for file in sorted(
+                [*files, helper],
+                key=lambda file: (file.path.parent.parts, file.path.name),
+            ):
+                if file is helper:
+                    fs.add_file(file.path, helper_path)
+                elif file.path in BOOT_CFG_PATHS:
+                    with io.BytesIO() as buf:
+                        iso.get_file_from_iso_fp(buf, iso_path=file.iso_path)
+                        config = _patch_esxi_config(buf.getvalue().decode())
+                    fs.add_bytes(file.path, config.encode())
+                elif file.offset is not None:
+                    fs.add_stream(
+                        file.path,
+                        file.size,
+                        isofs.extent_writer(iso_map, file, observe),
+                    )
+                else:
+                    fs.add_stream(
+                        file.path,
+                        file.size,
+                        functools.partial(
+                            iso.get_file_from_iso_fp,
+                            iso_path=file.iso_path,
+                            blocksize=fat32.COPY_BUFSIZE,
+                        ),
+                    )
+
+            esp_size = sizing.compute(fs, slack)
+            _log_esp_size(esp_size)
+            logger.info("Creating disk image (%dmb)", esp_size.size_mb)
+            _write_disk_img(fs, images, esp_size, compress, identity)
+    finally:
+        iso.close()
 
-    # Extract all files
-    for dirname, _dirlist, filelist in iso.walk(iso_path="/"):
-        # Create directories
-        current_dir = output_dir / dirname[1:] if dirname != "/" else output_dir
-        current_dir.mkdir(exist_ok=True)
 
-        # Extract files
-        for file in filelist:
-            new_file = file.rsplit(";", 1)[0]
-            file_path = current_dir / new_file
-            logger.info("Copying %s/%s to %s/%s", dirname, file, current_dir, new_file)
-            with open(file_path, "wb") as f:
-                iso.get_file_from_iso_fp(f, iso_path=os.path.join(dirname, file))
+def _boot_configs(iso: pycdlib.PyCdlib, files: list[isofs.IsoFile]) -> dict:
+    """Read and patch the boot configs on the ISO."""
+    configs = {}
+    for file in files:
+        if file.path in BOOT_CFG_PATHS:
+            with io.BytesIO() as buf:
+                iso.get_file_from_iso_fp(buf, iso_path=file.iso_path)
+                configs[file.path] = _patch_esxi_config(buf.getvalue().decode())
+    return configs
+
+
+def _write_boot_configs(
+    work: checkpoint.WorkDir,
+    iso_path: str,
+    config_dir: Path,
+    index: isoindex.IsoIndex | None = None,
+) -> None:
+    """Read and patch the boot configs of an ISO into config_dir."""
+    if work.done("config") is not None:
+        return
+    if index is not None:
+        configs = {
+            path: _patch_esxi_config(index.read(iso_path, file).decode())
+            for path in BOOT_CFG_PATHS
+            if (file := index.lookup(path)) is not None
+        }
+    else:
+        iso = pycdlib.PyCdlib()
+        iso.open(iso_path)
+        try:
+            _dirs, files = isofs.list_tree(iso)
+            configs = _boot_configs(iso, files)
+        finally:
+            iso.close()
+    if config_dir.exists():
+        shutil.rmtree(config_dir)
+    for path, config in configs.items():
+        (config_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (config_dir / path).write_text(config)
+    work.complete("config", [config_dir])
+
+
+def _ensure_backing_img(
+    backing_path: str,
+    iso_path: str,
+    builder: str,
+    jobs: int | None,
+    cache_dir: str | None,
+    cache_max_size: int,
+    slack: str,
+    compress: bool,
+    source_date_epoch: int | None = None,
+) -> None:
+    """Build the shared backing image of an ISO unless it already exists.
+
+    The backing image holds the ISO with the default installer helper.
+    Concurrent builds wait on a lock next to it so it is only built once.
+    """
+    backing = Path(backing_path)
+    lock_path = backing.with_name(backing.name + ".lock")
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if backing.exists():
+            return
+        logger.info("Building backing image %s", backing)
+        partial = backing.with_name(backing.name + ".partial")
+        partial.unlink(missing_ok=True)
+        rc = generate_image(
+            iso_path,
+            str(partial),
+            "qcow2",
+            BuildOptions(
+                builder=builder,
+                jobs=jobs,
+                cache_dir=cache_dir,
+                cache_max_size=cache_max_size,
+                slack=slack,
+                compress=compress,
+                manifest=False,
+                source_date_epoch=source_date_epoch,
+            ),
+        )
+        if rc != 0:
+            partial.unlink(missing_ok=True)
+            raise RuntimeError(f"failed to build backing image {backing}")
+        os.replace(partial, backing)
+    finally:
+        os.close(fd)
+
+
+def _patch_base_img(
+    base_path: str,
+    iso_path: str,
+    helper_path: Path,
+    image_path: Path,
+    identity: reproducible.Identity | None = None,
+) -> int:
+    """Create a disk image by patching one built earlier from the same ISO.
+
+    The base image is cloned and only the installer helper and the boot
+    configs are replaced inside its ESP, the clusters of every other file
+    are left untouched.
+
+    Args:
+        base_path: Path to the raw image to start from
+        iso_path: Path to the ESXi installer ISO the base was built from
+        helper_path: Path to the installer helper tarball to include
+        image_path: Path to write the disk image to
+        identity: Optional fixed timestamp for the replaced files
+
+    Returns:
+        int: the number of bytes rewritten
+
+    Raises:
+        ValueError: If the base image isn't a raw esxi-img image of the ISO
+    """
+    with open(base_path, "rb") as f:
+        if f.read(len(qcow2.MAGIC)) == qcow2.MAGIC:
+            raise ValueError(f"{base_path} must be a raw image")
+
+    iso = pycdlib.PyCdlib()
+    iso.open(iso_path)
+    try:
+        _dirs, files = isofs.list_tree(iso)
+        configs = _boot_configs(iso, files)
+    finally:
+        iso.close()
+
+    sparse.clone(base_path, image_path)
+    with open(image_path, "r+b") as f:
+        esp = gpt.find_esp(f)
+        volume = fat32.Fat32Volume(f, esp.offset)
+
+        # every other file has to be there already, unchanged in size
+        listings = {}
+        for file in files:
+            if file.path in configs:
+                continue
+            parent = file.path.parent
+            if parent not in listings:
+                try:
+                    listings[parent] = {
+                        entry.name.upper(): entry.size
+                        for entry in volume.listdir(parent)
+                    }
+                except (FileNotFoundError, NotADirectoryError):
+                    listings[parent] = {}
+            if listings[parent].get(file.path.name.upper()) != file.size:
+                raise ValueError(
+                    f"{base_path} was not built from {iso_path}: "
+                    f"{file.path} is missing or differs"
+                )
+
+        timestamp = identity.timestamp if identity else None
+        written = 0
+        for path, config in configs.items():
+            written += volume.replace(path, config.encode(), timestamp)
+        written += volume.replace(
+            PurePosixPath("ESXIIMG.TGZ"), helper_path.read_bytes(), timestamp
+        )
+        volume.flush()
+    return written
 
-    iso.close()
 
+def _create_disk_img(
+    source_dir: Path,
+    images: dict[str, Path],
+    esp_size: sizing.EspSize,
+    builder: str = "python",
+    compress: bool = False,
+    identity: reproducible.Identity | None = None,
+) -> int:
+    if builder == "python":
+        return _create_disk_img_python(source_dir, images, esp_size, compress, identity)
+    elif builder != "host":
+        raise ValueError(f"Unknown disk image builder: {builder}")
+    if images.keys() != {"raw"}:
+        raise ValueError("The host builder only creates raw images")
+    image_path = images["raw"]
 
-def _create_disk_img(source_dir: Path, image_path: str, size_mb: int) -> int:
     system = platform.system().lower()
     if system == "darwin":
-        return _create_disk_img_macos(source_dir, image_path, size_mb)
+        return _create_disk_img_macos(source_dir, image_path, esp_size.size_mb)
     elif system == "linux":
-        return _create_disk_img_linux(source_dir, image_path, size_mb)
+        return _create_disk_img_linux(
+            source_dir, image_path, esp_size.size_mb, esp_size.sectors_per_cluster
+        )
     else:
         raise RuntimeError(f"Unsupported OS: {system}")
 
 
+def _create_disk_img_python(
+    source_dir: Path,
+    images: dict[str, Path],
+    esp_size: sizing.EspSize,
+    compress: bool = False,
+    identity: reproducible.Identity | None = None,
+) -> int:
+    """Create a disk image without any external tools or privileges.
+
+    Writes the GPT and a FAT32 EFI System Partition holding the contents
+    of source_dir directly into the image file.
+
+    Args:
+        source_dir: Directory containing the extracted ISO contents
+        images: Paths to write the disk image to by format, raw or qcow2
+        esp_size: Size and cluster size of the disk image
+        compress: Compress the clusters of qcow2 images
+        identity: Optional fixed timestamp and identifiers for the disk
+    """
+    fs = _new_fat32(identity)
+    fs.add_tree(source_dir)
+    _write_disk_img(fs, images, esp_size, compress, identity)
+    return 0
+
+
+def _new_fat32(identity: reproducible.Identity | None) -> Fat32Builder:
+    if identity is None:
+        return Fat32Builder()
+    return Fat32Builder(volume_id=identity.volume_id, timestamp=identity.timestamp)
+
+
+def _open_disk_img(
+    image_path: Path, disk_size: int, fmt: str = "raw", compress: bool = False
+):
+    if fmt == "qcow2":
+        return qcow2.Qcow2Writer(image_path, disk_size, compress)
+    if fmt != "raw":
+        raise ValueError(f"Cannot write {fmt} images directly")
+    f = open(image_path, "wb")
+    # leave the image sparse, only metadata and file data get written
+    f.truncate(disk_size)
+    return f
+
+
+class _TeeWriter:
+    """Send the writes of the disk image builders to several images."""
+
+    def __init__(self, files: list) -> None:
+        self.files = files
+        self._pos = 0
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        for f in self.files:
+            self._pos = f.seek(offset, whence)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def write(self, data) -> int:
+        for f in self.files:
+            f.write(data)
+        self._pos += len(data)
+        return len(data)
+
+
+def _write_disk_img(
+    fs: Fat32Builder,
+    images: dict[str, Path],
+    esp_size: sizing.EspSize,
+    compress: bool = False,
+    identity: reproducible.Identity | None = None,
+) -> None:
+    disk_size = esp_size.disk_size
+    first_lba, last_lba = gpt.partition_bounds(disk_size)
+
+    with contextlib.ExitStack() as stack:
+        files = [
+            stack.enter_context(_open_disk_img(path, disk_size, fmt, compress))
+            for fmt, path in images.items()
+        ]
+        f = files[0] if len(files) == 1 else _TeeWriter(files)
+        gpt.write_gpt(
+            f,
+            disk_size,
+            first_lba,
+            last_lba,
+            identity.disk_guid if identity else None,
+            identity.part_guid if identity else None,
+        )
+        fs.write(
+            f,
+            first_lba * gpt.SECTOR_SIZE,
+            last_lba - first_lba + 1,
+            hidden_sectors=first_lba,
+            sectors_per_cluster=esp_size.sectors_per_cluster,
+        )
+
+
+def _copy_to_esp(source_dir: Path, mount_dir: Path) -> None:
+    """Copy the ISO contents into the mounted ESP."""
+    logger.info("Copying %s into the ESP mounted at %s", source_dir, mount_dir)
+    copied = fscopy.copy_tree(source_dir, mount_dir)
+    logger.info("Copied %d MiB into the ESP", copied // (1024 * 1024))
+
+
 def _create_disk_img_macos(source_dir: Path, image_path: str, size_mb: int) -> int:
     image_path = Path(image_path).resolve()
     img_dmg_path = image_path.with_suffix("".join(image_path.suffixes) + ".dmg")
@@ -401,12 +1442,7 @@ def _create_disk_img_macos(source_dir: Path, image_path: str, size_mb: int) -> i
     logger.info("Mounted temp disk to %s", mount_path)
     try:
         # Step 6: Copy files into the mounted EFI partition
-        for file in source_dir.iterdir():
-            dest = Path(mount_path) / file.name
-            if file.is_file():
-                shutil.copy(file, dest)
-            elif file.is_dir():
-                shutil.copytree(file, dest)
+        _copy_to_esp(source_dir, Path(mount_path))
 
         subprocess.run(["diskutil", "unmount", mount_dev], check=True)
 
@@ -437,12 +1473,19 @@ def _create_disk_img_macos(source_dir: Path, image_path: str, size_mb: int) -> i
     return 0
 
 
-def _create_disk_img_linux(source_dir: Path, output_path: Path, size_mb: int) -> int:
+def _create_disk_img_linux(
+    source_dir: Path,
+    output_path: Path,
+    size_mb: int,
+    sectors_per_cluster: int | None = None,
+) -> int:
     """Create a disk image from the extracted ISO contents.
 
     Args:
         source_dir: Directory containing the extracted ISO contents
         output_path: Path to write the disk image to
+        size_mb: Size of the whole disk image in MiB
+        sectors_per_cluster: Cluster size the image was sized for
 
     Raises:
         Exception: If disk image creation fails
@@ -508,17 +1551,14 @@ def _create_disk_img_linux(source_dir: Path, output_path: Path, size_mb: int) ->
                     mode=BLOCKDEV_MODE,
                     device=os.makedev(int(major), int(minor)),
                 )
-            subprocess.run(["mkfs.vfat", "-F", "32", partdev], check=True)
+            mkfs_cmd = ["mkfs.vfat", "-F", "32"]
+            if sectors_per_cluster:
+                mkfs_cmd += ["-s", str(sectors_per_cluster)]
+            subprocess.run([*mkfs_cmd, partdev], check=True)
             mount_dir = tempfile.mkdtemp()
             subprocess.run(["mount", partdev, mount_dir], check=True)
 
-            for item in os.listdir(source_dir):
-                src = os.path.join(source_dir, item)
-                dst = os.path.join(mount_dir, item)
-                if os.path.isdir(src):
-                    shutil.copytree(src, dst, dirs_exist_ok=True)
-                else:
-                    shutil.copy(src, dst)
+            _copy_to_esp(source_dir, Path(mount_dir))
 
             subprocess.run(["umount", mount_dir], check=True)
         finally:
@@ -537,22 +1577,23 @@ def _create_disk_img_linux(source_dir: Path, output_path: Path, size_mb: int) ->
         ) from None
 
 
-def _convert_img(raw_path: Path, out_path: Path, fmt: str):
+def _convert_img(raw_path: Path, out_path: Path, fmt: str, compress: bool = False):
+    cmd = [
+        "qemu-img",
+        "convert",
+        "-f",
+        "raw",
+        "-O",
+        fmt,
+        # never allocate runs of zeros in the output
+        "-S",
+        "4k",
+    ]
+    if compress:
+        cmd.append("-c")
     try:
         # Convert raw disk to VMDK
-        subprocess.run(
-            [
-                "qemu-img",
-                "convert",
-                "-f",
-                "raw",
-                "-O",
-                fmt,
-                str(raw_path),
-                str(out_path),
-            ],
-            check=True,
-        )
+        subprocess.run([*cmd, str(raw_path), str(out_path)], check=True)
     except subprocess.CalledProcessError as e:
         raise Exception(
             f"Failed to convert image: {e.cmd}\nstdout:\n{e.stdout}"
@@ -560,6 +1601,39 @@ def _convert_img(raw_path: Path, out_path: Path, fmt: str):
         ) from None
 
 
+def output_formats(paths: list[str], formats: list[str] | None) -> list[str]:
+    """Work out the format of each output disk image.
+
+    Args:
+        paths: the output disk image paths
+        formats: the --format arguments, each may list several formats
+                 separated by commas
+
+    Returns:
+        list[str]: the format for each path
+    """
+    fmts = [
+        fmt.strip() for arg in formats or [] for fmt in arg.split(",") if fmt.strip()
+    ]
+    if not fmts:
+        # outputs are told apart by their extensions, anything else is raw
+        fmts = [Path(path).suffix.lstrip(".").lower() for path in paths]
+        fmts = [fmt if fmt in IMAGE_FORMATS else "raw" for fmt in fmts]
+    elif len(fmts) == 1:
+        fmts = fmts * len(paths)
+    elif len(fmts) != len(paths):
+        raise ValueError(
+            f"{len(fmts)} formats given for {len(paths)} disk images, "
+            "give one format or one for each"
+        )
+    for fmt in fmts:
+        if fmt not in IMAGE_FORMATS:
+            raise ValueError(
+                f"unsupported format {fmt!r}, choose from {', '.join(IMAGE_FORMATS)}"
+            )
+    return fmts
+
+
 def _create_argument_parser() -> argparse.ArgumentParser:
     """Create the command line argument parser.
 
@@ -606,20 +1680,380 @@ def _create_argument_parser() -> argparse.ArgumentParser:
     img_parser.add_argument(
         "--format",
         type=str,
-        choices=["raw", "qcow2", "vmdk"],
-        default="raw",
-        help="Format of the generated disk image (default: %(default)s)",
+        action="append",
+        help="Format of the generated disk image, one of "
+        f"{', '.join(IMAGE_FORMATS)}. Give one for each DISKIMG, repeated "
+        "or comma separated, to build several formats at once (default: "
+        "the file extension of each DISKIMG, raw for other extensions. A "
+        "single DISKIMG used to always be raw, give --format raw to keep that "
+        "for .qcow2 and .vmdk names)",
+    )
+    img_parser.add_argument(
+        "--builder",
+        type=str,
+        choices=["python", "host"],
+        default="python",
+        help="Write the disk image in-process without root (python) or with "
+        "the host's loop device and mkfs tools (host) (default: %(default)s)",
+    )
+    img_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        help="Number of files to extract from the ISO concurrently "
+        "(default: based on the CPU count)",
+    )
+    img_parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"Reuse extracted ISOs cached in {cache.default_cache_dir()}",
+    )
+    img_parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Reuse extracted ISOs cached in this directory (implies --cache)",
+    )
+    img_parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="Maximum size of the ISO cache in MiB (default: %(default)s)",
+    )
+    img_parser.add_argument(
+        "--slack",
+        type=str,
+        default=sizing.DEFAULT_SLACK,
+        help="Free space to leave in the ESP on top of what the files need, "
+        "a percentage (10%%) or a size (64M) (default: %(default)s)",
+    )
+    img_parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Compress the clusters of qcow2 images",
+    )
+    img_parser.add_argument(
+        "--base",
+        type=str,
+        metavar="IMAGE",
+        help="Raw image previously built from the same ISO, only the installer "
+        "helper and boot configs in it are replaced",
+    )
+    img_parser.add_argument(
+        "--backing",
+        type=str,
+        metavar="IMAGE",
+        help="qcow2 image shared by the images of the ISO, built if missing. "
+        "qcow2 DISKIMGs are written as overlays holding only their changes",
+    )
+    img_parser.add_argument(
+        "--source-date-epoch",
+        type=int,
+        metavar="SECONDS",
+        help="Build a byte-for-byte reproducible image with all timestamps set "
+        "to this UNIX time (default: $SOURCE_DATE_EPOCH)",
+    )
+    img_parser.add_argument(
+        "--work-dir",
+        type=str,
+        help="Keep intermediate files in this directory so a failed or "
+        "interrupted build resumes where it stopped when run again",
+    )
+    img_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild even if the DISKIMGs are up to date and overwrite them",
+    )
+    img_parser.add_argument(
+        "--no-manifest",
+        dest="manifest",
+        action="store_false",
+        help="Don't write the SHA-256 and MD5 of each DISKIMG and of the ISO "
+        "to DISKIMG.manifest.json",
+    )
+    img_parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="REPORT",
+        help="Write the wall time, CPU time, I/O and peak memory of each "
+        "stage as JSON to this file",
     )
     img_parser.add_argument("ISO", type=str, help="Path to ESXi installer ISO")
     img_parser.add_argument(
         "DISKIMG",
         type=str,
-        help="Output disk image filename",
+        nargs="+",
+        help="Output disk image filename, several can be given to build "
+        "each format from a single disk image",
+    )
+
+    # gen-img-batch subcommand
+    batch_parser = subparsers.add_parser(
+        "gen-img-batch", help="Generate many OpenStack images from a manifest"
+    )
+    batch_parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="Number of images to build at once (default: the CPU count)",
+    )
+    batch_parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Keep the extracted ISOs in this cache directory instead of a "
+        "temporary one for the batch",
+    )
+    batch_parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="Maximum size of the ISO cache in MiB (default: %(default)s)",
+    )
+    batch_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild images even if they are up to date",
+    )
+    batch_parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the build summary as JSON",
+    )
+    batch_parser.add_argument(
+        "MANIFEST",
+        type=str,
+        help="JSON or TOML manifest listing the builds",
+    )
+
+    # inspect-iso subcommand
+    inspect_iso_parser = subparsers.add_parser(
+        "inspect-iso",
+        help="Print the ESXi release, boot modules and VIBs of an ISO as JSON",
+    )
+    inspect_iso_parser.add_argument(
+        "ISO",
+        type=str,
+        help="VMware ESXi installer ISO",
+    )
+
+    # inspect-img subcommand
+    inspect_img_parser = subparsers.add_parser(
+        "inspect-img",
+        help="Print the files and boot configs on an image's ESP as JSON and "
+        "check the installer helper is set up",
+    )
+    inspect_img_parser.add_argument(
+        "IMAGE",
+        type=str,
+        help="Raw or qcow2 disk image built by esxi-img",
+    )
+    inspect_img_parser.add_argument(
+        "--extract",
+        metavar="DIR",
+        type=str,
+        help="Write BOOT.CFG, EFI/BOOT/BOOT.CFG, ESXIIMG.TGZ and the KS.CFG "
+        "it holds to DIR",
+    )
+
+    # diff subcommand
+    diff_parser = subparsers.add_parser(
+        "diff",
+        help="Print the files added, removed and changed between two ISOs or "
+        "two images as JSON, exits 1 when they differ",
+    )
+    diff_parser.add_argument(
+        "OLD",
+        type=str,
+        help="VMware ESXi installer ISO or disk image built by esxi-img",
+    )
+    diff_parser.add_argument(
+        "NEW",
+        type=str,
+        help="ISO or disk image to compare with OLD",
+    )
+    diff_parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=str(cache.default_cache_dir()),
+        help="Keep the indexes of the compared ISOs in this directory "
+        "(default: %(default)s)",
+    )
+    diff_parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="Maximum size of the ISO cache in MiB (default: %(default)s)",
+    )
+
+    # serve subcommand
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run a local service building images submitted as jobs",
+        description="Run a local service building images submitted as jobs. "
+        "Jobs aren't authenticated: whoever can connect can have the service "
+        "read and write any file it can.",
+    )
+    listen_group = serve_parser.add_mutually_exclusive_group()
+    listen_group.add_argument(
+        "--socket",
+        type=str,
+        help="UNIX socket to listen on, accessible to the user and group of "
+        "the service (default: esxi-img.sock in $XDG_RUNTIME_DIR, or else in "
+        "the cache directory)",
+    )
+    listen_group.add_argument(
+        "--listen",
+        type=str,
+        help="[HOST:]PORT on localhost to listen on instead of a UNIX socket. "
+        "UNAUTHENTICATED: every local user and process can submit jobs, "
+        "which read and write files with the permissions of the service",
+    )
+    serve_parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="Number of images to build at once (default: the CPU count)",
+    )
+    serve_parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=str(cache.default_cache_dir()),
+        help="Keep the extracted ISOs and installer helpers in this directory "
+        "(default: %(default)s)",
+    )
+    serve_parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="Maximum size of the ISO cache in MiB (default: %(default)s)",
     )
 
     return parser
 
 
+def generate_image_batch(
+    manifest_path: str,
+    workers: int | None = None,
+    cache_dir: str | None = None,
+    cache_max_size: int | None = None,
+    as_json: bool = False,
+    force: bool = False,
+) -> int:
+    """Generate every image listed in a manifest.
+
+    Args:
+        manifest_path: Path to the JSON or TOML manifest
+        workers: Number of images to build at once
+        cache_dir: Optional directory to cache extracted ISOs in
+        cache_max_size: Size in bytes the ISO cache is trimmed down to
+        as_json: Print the summary as JSON instead of a table
+        force: Rebuild images even if they are up to date
+
+    Returns:
+        int: Exit code (0 when every build succeeded, non-zero otherwise)
+    """
+    # the batch runner builds on this module, only load it when needed
+    from esxi_img import batch
+
+    try:
+        specs = batch.load_manifest(manifest_path)
+    except (OSError, ValueError) as e:
+        logger.error("Invalid manifest: %s", e)
+        return 1
+
+    results = batch.run_batch(specs, workers, cache_dir, cache_max_size, force)
+    if as_json:
+        print(batch.summary_json(results))
+    else:
+        print(batch.format_summary(results))
+    return 0 if all(result.ok for result in results) else 1
+
+
+def inspect_iso(iso_path: str) -> int:
+    """Print a description of an ESXi installer ISO as JSON.
+
+    Args:
+        iso_path: Path to the ESXi installer ISO
+
+    Returns:
+        int: Exit code (0 for success, non-zero for failure)
+    """
+    try:
+        info = isoinfo.inspect_iso(iso_path)
+    except (OSError, ValueError, pycdlib.pycdlibexception.PyCdlibException) as e:
+        logger.error("Can't inspect %s: %s", iso_path, e)
+        return 1
+    print(json.dumps(info, indent=2))
+    return 0
+
+
+def inspect_img(image_path: str, extract_dir: str | None = None) -> int:
+    """Print what is on the ESP of an image built by esxi-img as JSON.
+
+    Args:
+        image_path: Path to the raw or qcow2 disk image
+        extract_dir: Optional directory to write the boot configs, the
+                     installer helper and its kickstart file to
+
+    Returns:
+        int: Exit code (0 for success, non-zero when the image can't be
+        read or wasn't set up to install with the helper)
+    """
+    try:
+        info = imginfo.inspect_image(
+            image_path, Path(extract_dir) if extract_dir else None
+        )
+    except (OSError, ValueError, zlib.error) as e:
+        logger.error("Can't inspect %s: %s", image_path, e)
+        return 1
+    print(json.dumps(info, indent=2))
+    for problem in info["problems"]:
+        logger.error("%s: %s", image_path, problem)
+    return 1 if info["problems"] else 0
+
+
+def diff(
+    old_path: str,
+    new_path: str,
+    cache_dir: str | None = None,
+    cache_max_size: int = cache.DEFAULT_MAX_SIZE,
+) -> int:
+    """Print the files added, removed and changed between two ISOs or images.
+
+    Args:
+        old_path: Path to the older ISO or image
+        new_path: Path to the newer ISO or image
+        cache_dir: Directory keeping the ISO indexes, defaults to the user's
+        cache_max_size: Size in bytes the ISO cache is trimmed down to
+
+    Returns:
+        int: Exit code (0 if they hold the same files, 1 if they differ and
+        2 if they can't be compared)
+    """
+    iso_cache = cache.IsoCache(
+        Path(cache_dir) if cache_dir else cache.default_cache_dir(), cache_max_size
+    )
+    try:
+        differences = esxi_diff.diff(old_path, new_path, iso_cache)
+    except (
+        OSError,
+        ValueError,
+        zlib.error,
+        pycdlib.pycdlibexception.PyCdlibException,
+    ) as e:
+        logger.error("Can't compare %s and %s: %s", old_path, new_path, e)
+        return 2
+    finally:
+        iso_cache.evict()
+    print(json.dumps(differences, indent=2))
+    changes = [differences["added"], differences["removed"], differences["changed"]]
+    if "vibs" in differences:
+        changes += differences["vibs"].values()
+    return 1 if any(changes) else 0
+
+
 def main() -> int:
     """Main entry point for the esxi-img utility.
 
@@ -629,14 +2063,80 @@ def main() -> int:
     parser = _create_argument_parser()
     args = parser.parse_args()
 
+    if getattr(args, "cache", False) and not args.cache_dir:
+        args.cache_dir = str(cache.default_cache_dir())
+    if args.command == "gen-img":
+        guessed = not args.format
+        try:
+            args.format = output_formats(args.DISKIMG, args.format)
+        except ValueError as e:
+            parser.error(str(e))
+        if guessed and len(args.DISKIMG) == 1 and args.format != ["raw"]:
+            # a single image used to be raw whatever its name
+            logger.warning(
+                "Writing %s as %s after its extension, use --format raw for a "
+                "raw image",
+                args.DISKIMG[0],
+                args.format[0],
+            )
+
     try:
         if args.command == "ks-template":
             return generate_ks_template(args.KICKSTART)
         elif args.command == "installer-helper":
-            return generate_installer_helper(args.ks_template, args.TARBALL)
+            return generate_installer_helper(
+                args.ks_template, args.TARBALL, reproducible.source_date_epoch()
+            )
         elif args.command == "gen-img":
             return generate_image(
-                args.ISO, args.DISKIMG, args.format, args.ks_template, args.esxiimg
+                args.ISO,
+                args.DISKIMG,
+                args.format,
+                BuildOptions(
+                    ks_template_path=args.ks_template,
+                    esxiimg_path=args.esxiimg,
+                    builder=args.builder,
+                    jobs=args.jobs,
+                    cache_dir=args.cache_dir,
+                    cache_max_size=args.cache_max_size * 1024 * 1024,
+                    slack=args.slack,
+                    compress=args.compress,
+                    profile_path=args.profile,
+                    base_path=args.base,
+                    backing_path=args.backing,
+                    manifest=args.manifest,
+                    source_date_epoch=args.source_date_epoch,
+                    force=args.force,
+                    work_dir=args.work_dir,
+                ),
+            )
+        elif args.command == "gen-img-batch":
+            return generate_image_batch(
+                args.MANIFEST,
+                args.workers,
+                args.cache_dir,
+                args.cache_max_size * 1024 * 1024 if args.cache_dir else None,
+                args.json,
+                args.force,
+            )
+        elif args.command == "inspect-iso":
+            return inspect_iso(args.ISO)
+        elif args.command == "inspect-img":
+            return inspect_img(args.IMAGE, args.extract)
+        elif args.command == "diff":
+            return diff(
+                args.OLD, args.NEW, args.cache_dir, args.cache_max_size * 1024 * 1024
+            )
+        elif args.command == "serve":
+            # the service builds on this module, only load it when serving
+            from esxi_img import serve
+
+            return serve.serve(
+                args.socket,
+                args.listen,
+                args.workers,
+                args.cache_dir,
+                args.cache_max_size * 1024 * 1024,
             )
         else:
             logger.error("Unknown command: %s", args.command)
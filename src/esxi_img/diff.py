@@ -0,0 +1,209 @@
+"""Compare two ESXi ISOs or two images built by esxi-img file by file.
+
+ISOs are compared through their indexes in the ISO cache, which hold the
+SHA-256 of every file: an ISO seen before isn't read again and a new one
+is read once to index it. The VIBs in the image databases of the two
+ISOs are compared too.
+
+Images are compared by listing the files on their ESPs. Only files of
+the same size in both are read, to compare their contents. When both
+images are qcow2 overlays of the same backing file and a file is at the
+same location in both, only the clusters the overlays hold themselves
+are read, the rest of the file is the same backing data in both.
+"""
+
+import hashlib
+import os
+from collections.abc import Callable
+from pathlib import Path
+from typing import BinaryIO
+
+from esxi_img import cache
+from esxi_img import fat32
+from esxi_img import gpt
+from esxi_img import isoindex
+from esxi_img import isoinfo
+from esxi_img import qcow2
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _is_image(path: str | Path) -> bool:
+    """Whether a file is a disk image rather than an ISO."""
+    with open(path, "rb") as f:
+        if f.read(len(qcow2.MAGIC)) == qcow2.MAGIC:
+            return True
+        f.seek(gpt.SECTOR_SIZE)
+        return f.read(8) == b"EFI PART"
+
+
+def _compare(
+    old: dict[str, int], new: dict[str, int], same: Callable[[str], bool]
+) -> dict:
+    """Sort files by their paths and sizes into added, removed and changed.
+
+    same is only asked about files of the same size in both.
+    """
+    return {
+        "added": [
+            {"path": path, "size": new[path]} for path in sorted(new - old.keys())
+        ],
+        "removed": [
+            {"path": path, "size": old[path]} for path in sorted(old - new.keys())
+        ],
+        "changed": [
+            {"path": path, "old_size": old[path], "new_size": new[path]}
+            for path in sorted(old.keys() & new.keys())
+            if old[path] != new[path] or not same(path)
+        ],
+    }
+
+
+def _vibs(iso_path: str | Path, index: isoindex.IsoIndex) -> dict[str, str | None]:
+    imgdb = index.lookup(isoinfo.IMGDB)
+    if imgdb is None:
+        return {}
+    _profile, vibs = isoinfo.vib_inventory(index.read(iso_path, imgdb))
+    return {vib["name"]: vib["version"] for vib in vibs}
+
+
+def _compare_vibs(old: dict[str, str | None], new: dict[str, str | None]) -> dict:
+    return {
+        "added": [
+            {"name": name, "version": new[name]} for name in sorted(new - old.keys())
+        ],
+        "removed": [
+            {"name": name, "version": old[name]} for name in sorted(old - new.keys())
+        ],
+        "changed": [
+            {"name": name, "old_version": old[name], "new_version": new[name]}
+            for name in sorted(old.keys() & new.keys())
+            if old[name] != new[name]
+        ],
+    }
+
+
+def diff_isos(
+    old_path: str | Path, new_path: str | Path, iso_cache: cache.IsoCache
+) -> dict:
+    """Compare the files and VIBs on two ESXi installer ISOs.
+
+    Raises:
+        ValueError: If the image database of either ISO can't be read
+    """
+    old = iso_cache.index(old_path)
+    new = iso_cache.index(new_path)
+    old_files = {file.path: file for file in old.files}
+    new_files = {file.path: file for file in new.files}
+    return {
+        "old": {
+            "name": Path(old_path).name,
+            "version": old.version,
+            "build": old.build,
+        },
+        "new": {
+            "name": Path(new_path).name,
+            "version": new.version,
+            "build": new.build,
+        },
+        **_compare(
+            {path: file.size for path, file in old_files.items()},
+            {path: file.size for path, file in new_files.items()},
+            lambda path: old_files[path].sha256 == new_files[path].sha256,
+        ),
+        "vibs": _compare_vibs(_vibs(old_path, old), _vibs(new_path, new)),
+    }
+
+
+def _extents_digest(fp: BinaryIO, extents: list[tuple[int, int]]) -> str:
+    digest = hashlib.sha256()
+    for offset, length in extents:
+        fp.seek(offset)
+        while length:
+            chunk = fp.read(min(length, CHUNK_SIZE))
+            if not chunk:
+                raise ValueError("unexpected end of the disk image")
+            digest.update(chunk)
+            length -= len(chunk)
+    return digest.hexdigest()
+
+
+def _shared_backing(old: BinaryIO, new: BinaryIO) -> bool:
+    """Whether both images are overlays of the same backing file."""
+    if not isinstance(old, qcow2.Qcow2Reader) or not isinstance(new, qcow2.Qcow2Reader):
+        return False
+    if old.backing_path is None or new.backing_path is None:
+        return False
+    return os.path.samefile(old.backing_path, new.backing_path)
+
+
+def _held(
+    images: tuple[qcow2.Qcow2Reader, ...], extents: list[tuple[int, int]]
+) -> list[tuple[int, int]]:
+    """The parts of extents held by any of the images themselves."""
+    step = min(image.cluster_size for image in images)
+    held: list[tuple[int, int]] = []
+    for offset, length in extents:
+        end = offset + length
+        while offset < end:
+            piece = min(end, (offset // step + 1) * step) - offset
+            if any(image.holds(offset, piece) for image in images):
+                if held and sum(held[-1]) == offset:
+                    held[-1] = (held[-1][0], held[-1][1] + piece)
+                else:
+                    held.append((offset, piece))
+            offset += piece
+    return held
+
+
+def diff_images(old_path: str | Path, new_path: str | Path) -> dict:
+    """Compare the files on the ESPs of two raw or qcow2 images.
+
+    Raises:
+        ValueError: If either image has no ESP with a FAT32 file system
+    """
+    with (
+        qcow2.open_image(old_path) as old_fp,
+        qcow2.open_image(new_path) as new_fp,
+    ):
+        old_volume = fat32.Fat32Volume(old_fp, gpt.find_esp(old_fp).offset)
+        new_volume = fat32.Fat32Volume(new_fp, gpt.find_esp(new_fp).offset)
+        old_files = {str(path): entry for path, entry in old_volume.walk()}
+        new_files = {str(path): entry for path, entry in new_volume.walk()}
+        shared = _shared_backing(old_fp, new_fp)
+
+        def same(path: str) -> bool:
+            old_extents = old_volume.extents(old_files[path])
+            new_extents = new_volume.extents(new_files[path])
+            if shared and old_extents == new_extents:
+                # what neither image holds is read from the same backing file
+                held = _held((old_fp, new_fp), old_extents)
+                return _extents_digest(old_fp, held) == _extents_digest(new_fp, held)
+            return _extents_digest(old_fp, old_extents) == _extents_digest(
+                new_fp, new_extents
+            )
+
+        return {
+            "old": {"name": Path(old_path).name},
+            "new": {"name": Path(new_path).name},
+            **_compare(
+                {path: entry.size for path, entry in old_files.items()},
+                {path: entry.size for path, entry in new_files.items()},
+                same,
+            ),
+        }
+
+
+def diff(old_path: str | Path, new_path: str | Path, iso_cache: cache.IsoCache) -> dict:
+    """Compare two ISOs or two images, whichever the files are.
+
+    Raises:
+        ValueError: If an ISO is compared with an image or either can't be
+                    read
+    """
+    old_is_image = _is_image(old_path)
+    if old_is_image != _is_image(new_path):
+        raise ValueError("an ISO can only be compared with another ISO")
+    if old_is_image:
+        return diff_images(old_path, new_path)
+    return diff_isos(old_path, new_path, iso_cache)
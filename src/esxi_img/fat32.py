@@ -0,0 +1,909 @@
+"""In-process FAT32 filesystem writer.
+
+Lays out a FAT32 filesystem for a known set of files and writes it
+directly into a (zeroed) disk image so no loop device, mkfs or mount
+is necessary. Every file and directory is allocated a contiguous run
+of clusters and all writes happen in increasing offset order.
+
+Existing filesystems can be opened with Fat32Volume to read files and
+replace the contents of individual files in place.
+"""
+
+import math
+import os
+import shutil
+import struct
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+from pathlib import PurePosixPath
+from typing import BinaryIO
+
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 32
+NUM_FATS = 2
+FSINFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+ROOT_CLUSTER = 2
+# FAT32 volumes must have at least this many clusters to be detected as FAT32
+MIN_CLUSTERS = 65525
+MAX_CLUSTERS = 0x0FFFFFF5
+DIR_ENTRY_SIZE = 32
+EOC = 0x0FFFFFFF
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0F
+
+# NTRes bits used by Windows NT and Linux for all lowercase 8.3 names
+_LOWER_BASE = 0x08
+_LOWER_EXT = 0x10
+
+_SHORT_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%'-_@~`!(){}^#&")
+_LFN_CHARS = 13
+
+COPY_BUFSIZE = 1024 * 1024
+
+# writes the contents of a file to the supplied file object
+FileWriter = Callable[[BinaryIO], None]
+
+
+def cluster_sectors(total_sectors: int) -> int:
+    """Pick sectors per cluster for a volume using the Microsoft defaults."""
+    size_mb = total_sectors * SECTOR_SIZE // (1024 * 1024)
+    if size_mb <= 260:
+        return 1
+    if size_mb <= 8 * 1024:
+        return 8
+    if size_mb <= 16 * 1024:
+        return 16
+    if size_mb <= 32 * 1024:
+        return 32
+    return 64
+
+
+def fat_sectors(total_sectors: int, sectors_per_cluster: int) -> int:
+    """Number of sectors for each FAT on a volume of the given size."""
+    fat_size = 1
+    while True:
+        data_sectors = total_sectors - RESERVED_SECTORS - NUM_FATS * fat_size
+        clusters = data_sectors // sectors_per_cluster
+        needed = math.ceil((clusters + 2) * 4 / SECTOR_SIZE)
+        if needed <= fat_size:
+            return fat_size
+        fat_size = needed
+
+
+@dataclass
+class Geometry:
+    """On-disk geometry of a FAT32 volume."""
+
+    total_sectors: int
+    sectors_per_cluster: int
+    fat_sectors: int
+    reserved_sectors: int = RESERVED_SECTORS
+    num_fats: int = NUM_FATS
+
+    @classmethod
+    def for_volume(
+        cls, total_sectors: int, sectors_per_cluster: int | None = None
+    ) -> "Geometry":
+        spc = sectors_per_cluster or cluster_sectors(total_sectors)
+        return cls(total_sectors, spc, fat_sectors(total_sectors, spc))
+
+    @property
+    def cluster_size(self) -> int:
+        return self.sectors_per_cluster * SECTOR_SIZE
+
+    @property
+    def data_start(self) -> int:
+        """First sector of the data region."""
+        return self.reserved_sectors + self.num_fats * self.fat_sectors
+
+    @property
+    def cluster_count(self) -> int:
+        return (self.total_sectors - self.data_start) // self.sectors_per_cluster
+
+    def cluster_offset(self, cluster: int) -> int:
+        """Byte offset of a cluster from the start of the volume."""
+        return (
+            self.data_start + (cluster - ROOT_CLUSTER) * self.sectors_per_cluster
+        ) * SECTOR_SIZE
+
+
+@dataclass
+class _File:
+    name: str
+    size: int
+    writer: FileWriter
+    cluster: int = 0
+
+
+@dataclass
+class _Dir:
+    name: str
+    children: dict[str, "_File | _Dir"] = field(default_factory=dict)
+    cluster: int = 0
+
+
+def _is_short_char(c: str) -> bool:
+    return c in _SHORT_CHARS
+
+
+def _short_form(name: str) -> tuple[bytes, int] | None:
+    """Return the 8.3 entry name and case flags if name fits without an LFN."""
+    if name in (".", ".."):
+        return None
+    base, dot, ext = name.partition(".")
+    if not base or len(base) > 8 or len(ext) > 3 or "." in ext or (dot and not ext):
+        return None
+    flags = 0
+    for part, lower_flag in ((base, _LOWER_BASE), (ext, _LOWER_EXT)):
+        if part.upper() != part:
+            if part.lower() != part:
+                # mixed case needs an LFN to be preserved
+                return None
+            flags |= lower_flag
+        if not all(_is_short_char(c) for c in part.upper()):
+            return None
+    return (base.upper().ljust(8) + ext.upper().ljust(3)).encode("ascii"), flags
+
+
+def _short_alias(name: str, taken: set[bytes]) -> bytes:
+    """Generate a unique numeric-tail 8.3 alias for a long name."""
+
+    def clean(part: str) -> str:
+        part = part.upper().replace(" ", "").replace(".", "")
+        return "".join(c if _is_short_char(c) else "_" for c in part)
+
+    stripped = name.lstrip(".")
+    base, dot, ext = stripped.rpartition(".")
+    if not dot:
+        base, ext = stripped, ""
+    base = clean(base) or "_"
+    ext = clean(ext)[:3]
+    for n in range(1, 1000000):
+        tail = f"~{n}"
+        alias = (base[: 8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+        encoded = alias.encode("ascii")
+        if encoded not in taken:
+            return encoded
+    raise ValueError(f"unable to generate a short name for {name}")
+
+
+def _lfn_checksum(short_name: bytes) -> int:
+    csum = 0
+    for b in short_name:
+        csum = (((csum & 1) << 7) + (csum >> 1) + b) & 0xFF
+    return csum
+
+
+def _lfn_entries(name: str, short_name: bytes) -> list[bytes]:
+    encoded = name.encode("utf-16-le")
+    chars = [encoded[i : i + 2] for i in range(0, len(encoded), 2)]
+    if len(chars) > 255:
+        raise ValueError(f"file name too long: {name}")
+    if len(chars) % _LFN_CHARS:
+        chars.append(b"\x00\x00")
+    while len(chars) % _LFN_CHARS:
+        chars.append(b"\xff\xff")
+
+    csum = _lfn_checksum(short_name)
+    count = len(chars) // _LFN_CHARS
+    entries = []
+    for seq in range(count, 0, -1):
+        part = chars[(seq - 1) * _LFN_CHARS : seq * _LFN_CHARS]
+        order = seq | 0x40 if seq == count else seq
+        entries.append(
+            struct.pack(
+                "<B10sBBB12sH4s",
+                order,
+                b"".join(part[0:5]),
+                ATTR_LFN,
+                0,
+                csum,
+                b"".join(part[5:11]),
+                0,
+                b"".join(part[11:13]),
+            )
+        )
+    return entries
+
+
+def fat_datetime(timestamp: float) -> tuple[int, int]:
+    """Convert a UNIX timestamp into FAT (date, time) values."""
+    tm = time.gmtime(max(timestamp, 315532800))
+    date = ((tm.tm_year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    tod = (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2)
+    return date, tod
+
+
+def _dir_entry(
+    short_name: bytes, attr: int, flags: int, cluster: int, size: int, stamp
+) -> bytes:
+    date, tod = stamp
+    return struct.pack(
+        "<11sBBBHHHHHHHI",
+        short_name,
+        attr,
+        flags,
+        0,
+        tod,
+        date,
+        date,
+        cluster >> 16,
+        tod,
+        date,
+        cluster & 0xFFFF,
+        size,
+    )
+
+
+class Fat32Builder:
+    """Collects files and writes them out as a FAT32 filesystem.
+
+    Files are added with their path inside the filesystem. Parent
+    directories are created automatically. Once all the files are
+    present the filesystem can be written into a disk image at the
+    offset of its partition.
+    """
+
+    def __init__(
+        self,
+        label: str = "NO NAME",
+        volume_id: int | None = None,
+        timestamp: float | None = None,
+    ) -> None:
+        self.label = label
+        self.volume_id = (
+            volume_id if volume_id is not None else int.from_bytes(os.urandom(4))
+        )
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self._root = _Dir("")
+
+    def _parent(self, path: PurePosixPath) -> _Dir:
+        node = self._root
+        for part in path.parent.parts:
+            if part == "/":
+                continue
+            child = node.children.get(part.upper())
+            if child is None:
+                child = _Dir(part)
+                node.children[part.upper()] = child
+            elif not isinstance(child, _Dir):
+                raise ValueError(f"{path}: {part} is a file")
+            node = child
+        return node
+
+    def _add(self, path: PurePosixPath, node: "_File | _Dir") -> None:
+        parent = self._parent(path)
+        # FAT is case insensitive so names must be unique ignoring case
+        if node.name.upper() in parent.children:
+            raise ValueError(f"{path} already exists")
+        parent.children[node.name.upper()] = node
+
+    def add_dir(self, path: PurePosixPath) -> None:
+        parent = self._parent(path)
+        existing = parent.children.get(path.name.upper())
+        if existing is None:
+            parent.children[path.name.upper()] = _Dir(path.name)
+        elif not isinstance(existing, _Dir):
+            raise ValueError(f"{path} already exists as a file")
+
+    def add_stream(self, path: PurePosixPath, size: int, writer: FileWriter) -> None:
+        """Add a file whose contents are produced by a callable.
+
+        Args:
+            path: path of the file inside the filesystem
+            size: exact size of the file in bytes
+            writer: callable which writes exactly size bytes to the
+                    file object it is handed
+        """
+        self._add(path, _File(path.name, size, writer))
+
+    def add_bytes(self, path: PurePosixPath, data: bytes) -> None:
+        self.add_stream(path, len(data), lambda fp: fp.write(data))
+
+    def add_file(self, path: PurePosixPath, file: Path) -> None:
+        def _copy(fp: BinaryIO) -> None:
+            with file.open("rb") as src:
+                shutil.copyfileobj(src, fp, COPY_BUFSIZE)
+
+        self.add_stream(path, file.stat().st_size, _copy)
+
+    def add_tree(self, source_dir: Path) -> None:
+        """Add every file and directory below source_dir to the filesystem."""
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            dirnames.sort()
+            rel = PurePosixPath(Path(dirpath).relative_to(source_dir).as_posix())
+            for dirname in dirnames:
+                self.add_dir(rel / dirname)
+            for filename in sorted(filenames):
+                self.add_file(rel / filename, Path(dirpath) / filename)
+
+    def _walk(self, node: _Dir):
+        yield node
+        for child in node.children.values():
+            if isinstance(child, _Dir):
+                yield from self._walk(child)
+
+    def _files(self):
+        for directory in self._walk(self._root):
+            for child in directory.children.values():
+                if isinstance(child, _File):
+                    yield child
+
+    @staticmethod
+    def _names(directory: _Dir) -> list[tuple["_File | _Dir", bytes, int, bool]]:
+        """Resolve the 8.3 name of each child and whether it needs an LFN."""
+        forms = {
+            key: _short_form(child.name) for key, child in directory.children.items()
+        }
+        taken = {form[0] for form in forms.values() if form is not None}
+        names = []
+        for key, child in directory.children.items():
+            form = forms[key]
+            if form is None:
+                alias = _short_alias(child.name, taken)
+                taken.add(alias)
+                names.append((child, alias, 0, True))
+            else:
+                names.append((child, form[0], form[1], False))
+        return names
+
+    def _entry_count(self, directory: _Dir) -> int:
+        # "." and ".." are present in every directory except the root
+        count = 0 if directory is self._root else 2
+        for child, short_name, _flags, lfn in self._names(directory):
+            if lfn:
+                count += len(_lfn_entries(child.name, short_name))
+            count += 1
+        return count
+
+    def _dir_clusters(self, directory: _Dir, cluster_size: int) -> int:
+        size = self._entry_count(directory) * DIR_ENTRY_SIZE
+        return max(1, math.ceil(size / cluster_size))
+
+    def clusters_needed(self, cluster_size: int) -> int:
+        """Number of data clusters the content needs with this cluster size."""
+        total = sum(
+            self._dir_clusters(directory, cluster_size)
+            for directory in self._walk(self._root)
+        )
+        total += sum(math.ceil(f.size / cluster_size) for f in self._files())
+        return total
+
+    def data_size(self) -> int:
+        """Total number of bytes of file content."""
+        return sum(f.size for f in self._files())
+
+    def _allocate(self, geometry: Geometry) -> tuple[list[int], list]:
+        """Assign contiguous cluster runs and build the FAT.
+
+        Returns:
+            the FAT and the list of (node, first cluster, cluster count)
+            in allocation order.
+        """
+        needed = self.clusters_needed(geometry.cluster_size)
+        if needed > geometry.cluster_count:
+            raise ValueError(
+                f"filesystem needs {needed} clusters but the volume only "
+                f"has {geometry.cluster_count}"
+            )
+
+        fat = [0] * (needed + ROOT_CLUSTER)
+        fat[0] = 0x0FFFFF00 | 0xF8
+        fat[1] = EOC
+        runs = []
+        next_cluster = ROOT_CLUSTER
+
+        def assign(node, count):
+            nonlocal next_cluster
+            if count == 0:
+                node.cluster = 0
+                return
+            node.cluster = next_cluster
+            for c in range(next_cluster, next_cluster + count - 1):
+                fat[c] = c + 1
+            fat[next_cluster + count - 1] = EOC
+            runs.append((node, next_cluster, count))
+            next_cluster += count
+
+        # directories first, starting with the root at cluster 2
+        for directory in self._walk(self._root):
+            assign(directory, self._dir_clusters(directory, geometry.cluster_size))
+        for f in self._files():
+            assign(f, math.ceil(f.size / geometry.cluster_size))
+        return fat, runs
+
+    def _dir_entries(self, directory: _Dir, parent: _Dir | None) -> bytes:
+        stamp = fat_datetime(self.timestamp)
+        out = []
+        if parent is not None:
+            out.append(
+                _dir_entry(
+                    b".          ", ATTR_DIRECTORY, 0, directory.cluster, 0, stamp
+                )
+            )
+            # ".." referring to the root directory uses cluster 0
+            parent_cluster = 0 if parent is self._root else parent.cluster
+            out.append(
+                _dir_entry(b"..         ", ATTR_DIRECTORY, 0, parent_cluster, 0, stamp)
+            )
+        for child, short_name, flags, lfn in self._names(directory):
+            if isinstance(child, _Dir):
+                attr, size = ATTR_DIRECTORY, 0
+            else:
+                attr, size = ATTR_ARCHIVE, child.size
+            if lfn:
+                out.extend(_lfn_entries(child.name, short_name))
+            out.append(_dir_entry(short_name, attr, flags, child.cluster, size, stamp))
+        return b"".join(out)
+
+    def _boot_sector(self, geometry: Geometry, hidden_sectors: int) -> bytes:
+        boot = bytearray(SECTOR_SIZE)
+        boot[0:3] = b"\xeb\x58\x90"
+        boot[3:90] = struct.pack(
+            "<8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s",
+            b"MSWIN4.1",
+            SECTOR_SIZE,
+            geometry.sectors_per_cluster,
+            RESERVED_SECTORS,
+            NUM_FATS,
+            0,
+            0,
+            0xF8,
+            0,
+            63,
+            255,
+            hidden_sectors,
+            geometry.total_sectors,
+            geometry.fat_sectors,
+            0,
+            0,
+            ROOT_CLUSTER,
+            FSINFO_SECTOR,
+            BACKUP_BOOT_SECTOR,
+            b"",
+            0x80,
+            0,
+            0x29,
+            self.volume_id,
+            self.label.upper().encode("ascii")[:11].ljust(11),
+            b"FAT32   ",
+        )
+        # not bootable via BIOS, hand control to the next boot device
+        boot[90:92] = b"\xcd\x18"
+        boot[510:512] = b"\x55\xaa"
+        return bytes(boot)
+
+    @staticmethod
+    def _fsinfo(free_clusters: int, next_free: int) -> bytes:
+        info = bytearray(SECTOR_SIZE)
+        info[0:4] = struct.pack("<I", 0x41615252)
+        info[484:496] = struct.pack("<III", 0x61417272, free_clusters, next_free)
+        info[508:512] = struct.pack("<I", 0xAA550000)
+        return bytes(info)
+
+    def write(
+        self,
+        fp: BinaryIO,
+        offset: int,
+        total_sectors: int,
+        hidden_sectors: int = 0,
+        sectors_per_cluster: int | None = None,
+    ) -> Geometry:
+        """Write the filesystem into a zero filled disk image.
+
+        Only sectors holding metadata or file data are written, everything
+        else is expected to already read back as zeros.
+
+        Args:
+            fp: seekable file object for the disk image
+            offset: byte offset of the partition within the image
+            total_sectors: size of the partition in sectors
+            hidden_sectors: LBA of the partition recorded in the boot sector
+            sectors_per_cluster: cluster size, picked from the volume size
+                                 when not supplied
+
+        Returns:
+            Geometry: the geometry of the written filesystem
+        """
+        geometry = Geometry.for_volume(total_sectors, sectors_per_cluster)
+        if geometry.cluster_count < MIN_CLUSTERS:
+            raise ValueError(
+                f"volume of {total_sectors} sectors is too small for FAT32"
+            )
+        if geometry.cluster_count > MAX_CLUSTERS:
+            raise ValueError(f"volume of {total_sectors} sectors is too large")
+        fat, runs = self._allocate(geometry)
+
+        boot = self._boot_sector(geometry, hidden_sectors)
+        used = len(fat) - ROOT_CLUSTER
+        fsinfo = self._fsinfo(geometry.cluster_count - used, len(fat))
+
+        fp.seek(offset)
+        fp.write(boot)
+        fp.write(fsinfo)
+        fp.seek(offset + BACKUP_BOOT_SECTOR * SECTOR_SIZE)
+        fp.write(boot)
+        fp.write(fsinfo)
+
+        fat_bytes = struct.pack(f"<{len(fat)}I", *fat)
+        for n in range(NUM_FATS):
+            fat_start = RESERVED_SECTORS + n * geometry.fat_sectors
+            fp.seek(offset + fat_start * SECTOR_SIZE)
+            fp.write(fat_bytes)
+
+        parents = {id(self._root): None}
+        for directory in self._walk(self._root):
+            for child in directory.children.values():
+                parents[id(child)] = directory
+
+        for node, cluster, _count in runs:
+            fp.seek(offset + geometry.cluster_offset(cluster))
+            if isinstance(node, _Dir):
+                fp.write(self._dir_entries(node, parents[id(node)]))
+            else:
+                start = fp.tell()
+                node.writer(fp)
+                written = fp.tell() - start
+                if written != node.size:
+                    raise ValueError(
+                        f"{node.name}: expected {node.size} bytes, wrote {written}"
+                    )
+        return geometry
+
+
+@dataclass
+class DirEntry:
+    """A file or directory found in a directory of an existing volume."""
+
+    name: str
+    short_name: bytes
+    attr: int
+    cluster: int
+    size: int
+    # byte offset of the 8.3 entry from the start of the volume
+    entry_offset: int
+
+    @property
+    def is_dir(self) -> bool:
+        return bool(self.attr & ATTR_DIRECTORY)
+
+
+def _display_short_name(short_name: bytes, flags: int) -> str:
+    if short_name[0] == 0x05:
+        # 0xE5 as the first character is stored as 0x05
+        short_name = b"\xe5" + short_name[1:]
+    base = short_name[:8].decode("cp437").rstrip()
+    ext = short_name[8:].decode("cp437").rstrip()
+    if flags & _LOWER_BASE:
+        base = base.lower()
+    if flags & _LOWER_EXT:
+        ext = ext.lower()
+    return f"{base}.{ext}" if ext else base
+
+
+def _lfn_part(entry: bytes) -> bytes:
+    return entry[1:11] + entry[14:26] + entry[28:32]
+
+
+class Fat32Volume:
+    """An existing FAT32 filesystem in a disk image.
+
+    Files can be read and have their contents replaced in place. Changes
+    to the FAT are held in memory until flush() is called.
+
+    Args:
+        fp: seekable file object for the disk image, it has to be writable
+            too for files to be replaced
+        offset: byte offset of the partition within the image
+    """
+
+    def __init__(self, fp: BinaryIO, offset: int = 0) -> None:
+        self.fp = fp
+        self.offset = offset
+
+        boot = self._read(0, SECTOR_SIZE)
+        if boot[510:512] != b"\x55\xaa":
+            raise ValueError("no FAT boot sector found")
+        (
+            bytes_per_sector,
+            sectors_per_cluster,
+            reserved,
+            num_fats,
+            root_entries,
+            total16,
+            _media,
+            fat16_sectors,
+        ) = struct.unpack_from("<HBHBHHBH", boot, 11)
+        total32, fat_size = struct.unpack_from("<II", boot, 32)
+        if (
+            bytes_per_sector != SECTOR_SIZE
+            or root_entries
+            or fat16_sectors
+            or not fat_size
+        ):
+            raise ValueError("not a FAT32 filesystem with 512 byte sectors")
+        self.root_cluster, self.fsinfo_sector, self.backup_boot_sector = (
+            struct.unpack_from("<IHH", boot, 44)
+        )
+        self.geometry = Geometry(
+            total16 or total32, sectors_per_cluster, fat_size, reserved, num_fats
+        )
+
+        fat_bytes = self._read(reserved * SECTOR_SIZE, fat_size * SECTOR_SIZE)
+        self.fat = list(struct.unpack(f"<{len(fat_bytes) // 4}I", fat_bytes))
+        self._dirty: set[int] = set()
+        # clusters freed minus clusters allocated since opening
+        self._freed = 0
+
+    def _read(self, offset: int, size: int) -> bytes:
+        self.fp.seek(self.offset + offset)
+        data = self.fp.read(size)
+        if len(data) != size:
+            raise ValueError("unexpected end of the disk image")
+        return data
+
+    def _write(self, offset: int, data: bytes) -> None:
+        self.fp.seek(self.offset + offset)
+        self.fp.write(data)
+
+    def _next(self, cluster: int) -> int:
+        return self.fat[cluster] & 0x0FFFFFFF
+
+    def _set_next(self, cluster: int, value: int) -> None:
+        if self._next(cluster) == value:
+            return
+        # the top four bits are reserved and have to be preserved
+        self.fat[cluster] = (self.fat[cluster] & 0xF0000000) | value
+        self._dirty.add(cluster * 4 // SECTOR_SIZE)
+
+    def chain(self, cluster: int) -> list[int]:
+        """The clusters of a file or directory starting at cluster."""
+        clusters = []
+        last = self.geometry.cluster_count + ROOT_CLUSTER
+        while ROOT_CLUSTER <= cluster < last:
+            clusters.append(cluster)
+            if len(clusters) > self.geometry.cluster_count:
+                raise ValueError(f"cluster chain starting at {clusters[0]} loops")
+            cluster = self._next(cluster)
+        return clusters
+
+    def _read_chain(self, cluster: int, size: int | None = None) -> bytes:
+        cluster_size = self.geometry.cluster_size
+        data = b"".join(
+            self._read(self.geometry.cluster_offset(c), cluster_size)
+            for c in self.chain(cluster)
+        )
+        return data if size is None else data[:size]
+
+    def iterdir(self, cluster: int | None = None) -> list[DirEntry]:
+        """List the entries of the directory starting at cluster.
+
+        The "." and ".." entries, deleted entries and the volume label are
+        skipped. The root directory is listed when cluster is not given.
+        """
+        cluster = cluster or self.root_cluster
+        entries = []
+        lfn: dict[int, bytes] = {}
+        checksum = None
+        for c in self.chain(cluster):
+            base = self.geometry.cluster_offset(c)
+            data = self._read(base, self.geometry.cluster_size)
+            for pos in range(0, len(data), DIR_ENTRY_SIZE):
+                raw = data[pos : pos + DIR_ENTRY_SIZE]
+                if raw[0] == 0x00:
+                    return entries
+                if raw[0] == 0xE5:
+                    lfn = {}
+                    continue
+                attr = raw[11]
+                if attr == ATTR_LFN:
+                    if raw[0] & 0x40:
+                        lfn = {}
+                        checksum = raw[13]
+                    lfn[raw[0] & 0x1F] = _lfn_part(raw)
+                    continue
+                short_name = raw[0:11]
+                if attr & ATTR_VOLUME_ID or short_name in (
+                    b".          ",
+                    b"..         ",
+                ):
+                    lfn = {}
+                    continue
+
+                name = _display_short_name(short_name, raw[12])
+                if lfn and checksum == _lfn_checksum(short_name):
+                    encoded = b"".join(lfn[seq] for seq in sorted(lfn))
+                    long_name = encoded.decode("utf-16-le", "replace")
+                    name = long_name.split("\x00", 1)[0]
+                lfn = {}
+                hi, lo, size = struct.unpack_from("<HxxxxHI", raw, 20)
+                entries.append(
+                    DirEntry(name, short_name, attr, hi << 16 | lo, size, base + pos)
+                )
+        return entries
+
+    def lookup(self, path: str | PurePosixPath) -> DirEntry:
+        """Find a file or directory, names are matched ignoring case.
+
+        Raises:
+            FileNotFoundError: If there is nothing at path
+        """
+        parts = [part for part in PurePosixPath(path).parts if part != "/"]
+        if not parts:
+            return DirEntry("", b"", ATTR_DIRECTORY, self.root_cluster, 0, -1)
+        cluster = self.root_cluster
+        for n, part in enumerate(parts):
+            for entry in self.iterdir(cluster):
+                short = _display_short_name(entry.short_name, 0)
+                if part.upper() in (entry.name.upper(), short.upper()):
+                    break
+            else:
+                raise FileNotFoundError(path)
+            if n < len(parts) - 1 and not entry.is_dir:
+                raise NotADirectoryError(path)
+            cluster = entry.cluster
+        return entry
+
+    def listdir(self, path: str | PurePosixPath = "/") -> list[DirEntry]:
+        entry = self.lookup(path)
+        if not entry.is_dir:
+            raise NotADirectoryError(path)
+        return self.iterdir(entry.cluster)
+
+    def walk(
+        self, path: str | PurePosixPath = "/"
+    ) -> list[tuple[PurePosixPath, DirEntry]]:
+        """The files below a directory with their paths, depth first.
+
+        Paths are relative to the directory walked.
+        """
+        entry = self.lookup(path)
+        if not entry.is_dir:
+            raise NotADirectoryError(path)
+        files = []
+        pending = [(PurePosixPath(), entry.cluster)]
+        while pending:
+            parent, cluster = pending.pop()
+            for entry in self.iterdir(cluster):
+                if entry.is_dir:
+                    pending.append((parent / entry.name, entry.cluster))
+                else:
+                    files.append((parent / entry.name, entry))
+        return files
+
+    def extents(self, entry: DirEntry) -> list[tuple[int, int]]:
+        """Where a file's data is in the disk image.
+
+        Returns:
+            the byte offset from the start of the image and the length of
+            each run of consecutive clusters, in file order
+        """
+        cluster_size = self.geometry.cluster_size
+        extents: list[tuple[int, int]] = []
+        remaining = entry.size
+        for cluster in self.chain(entry.cluster) if remaining else []:
+            offset = self.offset + self.geometry.cluster_offset(cluster)
+            length = min(cluster_size, remaining)
+            remaining -= length
+            if extents and sum(extents[-1]) == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((offset, length))
+            if not remaining:
+                break
+        return extents
+
+    def read(self, path: str | PurePosixPath) -> bytes:
+        """Read the contents of a file."""
+        entry = self.lookup(path)
+        if entry.is_dir:
+            raise IsADirectoryError(path)
+        return self._read_chain(entry.cluster, entry.size)
+
+    def _allocate(self, count: int, hint: int) -> list[int]:
+        """Find free clusters, preferring the ones from hint onwards."""
+        last = self.geometry.cluster_count + ROOT_CLUSTER
+        hint = hint if ROOT_CLUSTER <= hint < last else ROOT_CLUSTER
+        found = []
+        for cluster in (*range(hint, last), *range(ROOT_CLUSTER, hint)):
+            if self._next(cluster) == 0:
+                found.append(cluster)
+                if len(found) == count:
+                    return found
+        raise OSError(f"no space left for {count} more clusters")
+
+    def replace(
+        self,
+        path: str | PurePosixPath,
+        data: bytes,
+        timestamp: float | None = None,
+    ) -> int:
+        """Replace the contents of an existing file in place.
+
+        The file keeps the clusters it already has, only clusters whose
+        contents change are written. Clusters are allocated or freed when
+        the size of the file changes.
+
+        Returns:
+            int: the number of bytes written to the data region and
+            directory, the FAT is only written by flush()
+        """
+        entry = self.lookup(path)
+        if entry.is_dir:
+            raise IsADirectoryError(path)
+        cluster_size = self.geometry.cluster_size
+        old = self.chain(entry.cluster) if entry.cluster else []
+        needed = math.ceil(len(data) / cluster_size)
+
+        clusters = old[:needed]
+        if needed > len(clusters):
+            hint = clusters[-1] + 1 if clusters else ROOT_CLUSTER
+            clusters += self._allocate(needed - len(clusters), hint)
+        for cluster in old[needed:]:
+            self._set_next(cluster, 0)
+        for cluster, following in zip(clusters, clusters[1:], strict=False):
+            self._set_next(cluster, following)
+        if clusters:
+            self._set_next(clusters[-1], EOC)
+        self._freed += len(old) - len(clusters)
+
+        written = 0
+        existing = set(old)
+        for n, cluster in enumerate(clusters):
+            chunk = data[n * cluster_size : (n + 1) * cluster_size]
+            chunk = chunk.ljust(cluster_size, b"\x00")
+            pos = self.geometry.cluster_offset(cluster)
+            if cluster in existing and self._read(pos, cluster_size) == chunk:
+                continue
+            self._write(pos, chunk)
+            written += cluster_size
+
+        first = clusters[0] if clusters else 0
+        date, tod = fat_datetime(time.time() if timestamp is None else timestamp)
+        raw = bytearray(self._read(entry.entry_offset, DIR_ENTRY_SIZE))
+        updated = bytearray(raw)
+        struct.pack_into("<HH", updated, 18, date, first >> 16)
+        struct.pack_into("<HHHI", updated, 22, tod, date, first & 0xFFFF, len(data))
+        if updated != raw:
+            self._write(entry.entry_offset, bytes(updated))
+            written += DIR_ENTRY_SIZE
+        return written
+
+    def _update_fsinfo(self, sector: int) -> None:
+        info = bytearray(self._read(sector * SECTOR_SIZE, SECTOR_SIZE))
+        if struct.unpack_from("<I", info, 0)[0] != 0x41615252:
+            return
+        free = struct.unpack_from("<I", info, 488)[0]
+        if free == 0xFFFFFFFF:
+            return
+        struct.pack_into("<I", info, 488, free + self._freed)
+        self._write(sector * SECTOR_SIZE, bytes(info))
+
+    def flush(self) -> None:
+        """Write the FAT sectors changed by replace() to every FAT copy."""
+        per_sector = SECTOR_SIZE // 4
+        for sector in sorted(self._dirty):
+            data = struct.pack(
+                f"<{per_sector}I",
+                *self.fat[sector * per_sector : (sector + 1) * per_sector],
+            )
+            for n in range(self.geometry.num_fats):
+                fat_start = (
+                    self.geometry.reserved_sectors + n * self.geometry.fat_sectors
+                )
+                self._write((fat_start + sector) * SECTOR_SIZE, data)
+        self._dirty.clear()
+
+        if self._freed:
+            if self.fsinfo_sector not in (0, 0xFFFF):
+                self._update_fsinfo(self.fsinfo_sector)
+                if self.backup_boot_sector not in (0, 0xFFFF):
+                    self._update_fsinfo(self.backup_boot_sector + self.fsinfo_sector)
+            self._freed = 0
@@ -0,0 +1,206 @@
+"""Copy files and trees with the kernel doing the data transfer.
+
+Data is moved with copy_file_range(2) or sendfile(2) when the two files
+allow it and written from a read-only memory map of the source when they
+don't, it never passes through Python buffers.
+
+copy_tree() is used to fill a freshly formatted and mounted ESP. FAT
+allocates clusters as files grow so copying several files at once would
+interleave their clusters, instead every file is created and has its
+space reserved in order first and only the data is copied concurrently.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import mmap
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from pathlib import Path
+
+from esxi_img import sparse
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFSIZE = 1024 * 1024
+# bytes handed to the kernel per copy_file_range/sendfile call
+ZERO_COPY_CHUNK = 64 * 1024 * 1024
+
+# errors meaning the kernel can't copy between these two files
+_ZERO_COPY_ERRORS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.ENOTSOCK,
+    errno.EBADF,
+}
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, offset: int, end: int) -> int:
+    """Copy as much of the range as the kernel will without a user buffer.
+
+    Returns:
+        int: the offset copied up to, end unless neither system call can
+        copy between the two files
+    """
+    for name in ("copy_file_range", "sendfile"):
+        if not hasattr(os, name):
+            continue
+        try:
+            while offset < end:
+                count = min(ZERO_COPY_CHUNK, end - offset)
+                if name == "copy_file_range":
+                    copied = os.copy_file_range(src_fd, dst_fd, count, offset)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, count)
+                if not copied:
+                    raise OSError("unexpected end of file")
+                offset += copied
+            return offset
+        except OSError as e:
+            if e.errno not in _ZERO_COPY_ERRORS:
+                raise
+    return offset
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, size: int) -> None:
+    """Copy size bytes from offset in src_fd to the position of dst_fd.
+
+    The kernel copies the data when it can, otherwise it is written from
+    a memory map of the source.
+    """
+    end = offset + size
+    offset = _kernel_copy(src_fd, dst_fd, offset, end)
+    if offset == end:
+        return
+    if os.fstat(src_fd).st_size < end:
+        raise OSError("unexpected end of file")
+    with (
+        mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as src_map,
+        memoryview(src_map) as view,
+    ):
+        while offset < end:
+            offset += os.write(dst_fd, view[offset : min(end, offset + COPY_BUFSIZE)])
+
+
+def _reserve(fd: int, size: int) -> bool:
+    """Allocate the blocks of a file up front.
+
+    The blocks are allocated past the end of the still empty file with
+    FALLOC_FL_KEEP_SIZE. posix_fallocate() would extend the file instead,
+    which vfat can only do by writing zeros over all of it first.
+
+    Returns:
+        bool: False when the platform or filesystem can't
+    """
+    if not size:
+        return True
+    fallocate = sparse.libc_fallocate()
+    if fallocate is None:
+        return False
+    if fallocate(fd, sparse.FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        err = ctypes.get_errno()
+        if err not in (errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err))
+        return False
+    return True
+
+
+def _copy_file(src: Path, dst: Path, size: int) -> int:
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        # the blocks of the file were reserved when it was created
+        dst_fd = os.open(dst, os.O_WRONLY)
+        try:
+            copy_range(src_fd, dst_fd, 0, size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return size
+
+
+def _syncfs(path: Path) -> None:
+    """Flush the filesystem holding path to its device."""
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    syncfs = getattr(libc, "syncfs", None)
+    if syncfs is None:
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+    finally:
+        os.close(fd)
+
+
+def copy_tree(
+    source_dir: Path,
+    dest_dir: Path,
+    workers: int | None = None,
+    progress: Callable[[int, int], None] | None = None,
+) -> int:
+    """Copy the files and directories below source_dir into dest_dir.
+
+    Directories and files are created in sorted order with the space of
+    each file reserved as it is created, so a filesystem handing out
+    blocks in order lays every file out contiguously. The data is then
+    copied by a pool of workers, largest files first, and the destination
+    filesystem is synced once at the end. Permissions and timestamps are
+    not copied.
+
+    Args:
+        source_dir: the tree to copy
+        dest_dir: an existing directory to copy into
+        workers: maximum number of files to copy concurrently, defaults to
+                 the executor's default based on the CPU count
+        progress: called with the files and bytes copied so far each time
+                  a file completes
+
+    Returns:
+        int: the number of bytes copied
+    """
+    files = []
+    reserved = True
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        rel = Path(dirpath).relative_to(source_dir)
+        for dirname in dirnames:
+            (dest_dir / rel / dirname).mkdir(exist_ok=True)
+        for filename in sorted(filenames):
+            src = Path(dirpath) / filename
+            dst = dest_dir / rel / filename
+            size = src.stat().st_size
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                reserved = reserved and _reserve(fd, size)
+            finally:
+                os.close(fd)
+            files.append((src, dst, size))
+
+    if not reserved:
+        # without reserved space the files have to grow one at a time
+        logger.info("Space can't be reserved in %s, copying serially", dest_dir)
+        workers = 1
+    else:
+        files.sort(key=lambda file: file[2], reverse=True)
+
+    done_files = 0
+    done_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_copy_file, *file) for file in files]
+        for future in as_completed(futures):
+            done_bytes += future.result()
+            done_files += 1
+            if progress:
+                progress(done_files, done_bytes)
+
+    _syncfs(dest_dir)
+    return done_bytes
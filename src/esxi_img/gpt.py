@@ -0,0 +1,211 @@
+"""Minimal GUID Partition Table support for single ESP disk images."""
+
+import struct
+import uuid
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO
+
+SECTOR_SIZE = 512
+# partitions start on a 1MiB boundary like fdisk and gdisk place them
+PARTITION_ALIGNMENT = 2048
+ENTRY_COUNT = 128
+ENTRY_SIZE = 128
+ENTRIES_SECTORS = ENTRY_COUNT * ENTRY_SIZE // SECTOR_SIZE
+
+ESP_TYPE_GUID = uuid.UUID("c12a7328-f81f-11d2-ba4b-00a0c93ec93b")
+
+_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+_ENTRY = struct.Struct("<16s16sQQQ72s")
+
+
+@dataclass(frozen=True)
+class Partition:
+    type_guid: uuid.UUID
+    guid: uuid.UUID
+    first_lba: int
+    # inclusive
+    last_lba: int
+    name: str
+
+    @property
+    def offset(self) -> int:
+        return self.first_lba * SECTOR_SIZE
+
+    @property
+    def sectors(self) -> int:
+        return self.last_lba - self.first_lba + 1
+
+
+def partition_bounds(disk_size: int) -> tuple[int, int]:
+    """Return the first and last LBA of a partition filling the disk.
+
+    Args:
+        disk_size: size of the whole disk image in bytes
+
+    Returns:
+        tuple[int, int]: the inclusive first and last LBA of the partition
+    """
+    if disk_size % SECTOR_SIZE:
+        raise ValueError(f"disk size {disk_size} is not a multiple of {SECTOR_SIZE}")
+    total_sectors = disk_size // SECTOR_SIZE
+    last_usable = total_sectors - ENTRIES_SECTORS - 2
+    if last_usable <= PARTITION_ALIGNMENT:
+        raise ValueError(f"disk size {disk_size} is too small for a GPT partition")
+    return PARTITION_ALIGNMENT, last_usable
+
+
+def _protective_mbr(total_sectors: int) -> bytes:
+    mbr = bytearray(SECTOR_SIZE)
+    # a single partition of type 0xEE covering the whole disk
+    mbr[446:462] = struct.pack(
+        "<B3sB3sII",
+        0x00,
+        b"\x00\x02\x00",
+        0xEE,
+        b"\xff\xff\xff",
+        1,
+        min(total_sectors - 1, 0xFFFFFFFF),
+    )
+    mbr[510:512] = b"\x55\xaa"
+    return bytes(mbr)
+
+
+def _header(
+    my_lba: int,
+    alternate_lba: int,
+    entries_lba: int,
+    total_sectors: int,
+    disk_guid: uuid.UUID,
+    entries_crc: int,
+) -> bytes:
+    fields = [
+        b"EFI PART",
+        0x00010000,
+        _HEADER.size,
+        0,
+        0,
+        my_lba,
+        alternate_lba,
+        2 + ENTRIES_SECTORS,
+        total_sectors - ENTRIES_SECTORS - 2,
+        disk_guid.bytes_le,
+        entries_lba,
+        ENTRY_COUNT,
+        ENTRY_SIZE,
+        entries_crc,
+    ]
+    fields[3] = zlib.crc32(_HEADER.pack(*fields))
+    return _HEADER.pack(*fields).ljust(SECTOR_SIZE, b"\x00")
+
+
+def write_gpt(
+    fp: BinaryIO,
+    disk_size: int,
+    first_lba: int,
+    last_lba: int,
+    disk_guid: uuid.UUID | None = None,
+    part_guid: uuid.UUID | None = None,
+    name: str = "EFI System Partition",
+) -> None:
+    """Write a protective MBR and primary and backup GPT with a single ESP.
+
+    Args:
+        fp: seekable file object for the disk image, already disk_size long
+        disk_size: size of the whole disk image in bytes
+        first_lba: first LBA of the EFI System Partition
+        last_lba: last LBA (inclusive) of the EFI System Partition
+        disk_guid: GUID of the disk, random if not supplied
+        part_guid: unique GUID of the partition, random if not supplied
+        name: partition name
+    """
+    total_sectors = disk_size // SECTOR_SIZE
+    disk_guid = disk_guid or uuid.uuid4()
+    part_guid = part_guid or uuid.uuid4()
+
+    entries = bytearray(ENTRY_COUNT * ENTRY_SIZE)
+    entries[0:ENTRY_SIZE] = _ENTRY.pack(
+        ESP_TYPE_GUID.bytes_le,
+        part_guid.bytes_le,
+        first_lba,
+        last_lba,
+        0,
+        name.encode("utf-16-le")[:72],
+    )
+    entries_crc = zlib.crc32(entries)
+
+    backup_lba = total_sectors - 1
+    backup_entries_lba = backup_lba - ENTRIES_SECTORS
+
+    fp.seek(0)
+    fp.write(_protective_mbr(total_sectors))
+    fp.write(_header(1, backup_lba, 2, total_sectors, disk_guid, entries_crc))
+    fp.write(entries)
+
+    fp.seek(backup_entries_lba * SECTOR_SIZE)
+    fp.write(entries)
+    fp.write(
+        _header(
+            backup_lba,
+            1,
+            backup_entries_lba,
+            total_sectors,
+            disk_guid,
+            entries_crc,
+        )
+    )
+
+
+def read_partitions(fp: BinaryIO) -> list[Partition]:
+    """Read the partitions listed in the primary GPT of a disk image.
+
+    Raises:
+        ValueError: If the image has no valid GPT
+    """
+    fp.seek(SECTOR_SIZE)
+    header = fp.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        raise ValueError("disk image is too small to hold a GPT")
+    fields = list(_HEADER.unpack(header))
+    if fields[0] != b"EFI PART":
+        raise ValueError("disk image has no GPT")
+    crc = fields[3]
+    fields[3] = 0
+    if zlib.crc32(_HEADER.pack(*fields)) != crc:
+        raise ValueError("GPT header checksum mismatch")
+    entries_lba, count, size, entries_crc = fields[10:14]
+
+    fp.seek(entries_lba * SECTOR_SIZE)
+    entries = fp.read(count * size)
+    if zlib.crc32(entries) != entries_crc:
+        raise ValueError("GPT partition entries checksum mismatch")
+
+    partitions = []
+    for n in range(count):
+        type_guid, guid, first, last, _attrs, name = _ENTRY.unpack_from(
+            entries, n * size
+        )
+        if type_guid == bytes(16):
+            continue
+        partitions.append(
+            Partition(
+                uuid.UUID(bytes_le=type_guid),
+                uuid.UUID(bytes_le=guid),
+                first,
+                last,
+                name.decode("utf-16-le").rstrip("\x00"),
+            )
+        )
+    return partitions
+
+
+def find_esp(fp: BinaryIO) -> Partition:
+    """Find the EFI System Partition of a disk image.
+
+    Raises:
+        ValueError: If the image has no GPT or no ESP
+    """
+    for partition in read_partitions(fp):
+        if partition.type_guid == ESP_TYPE_GUID:
+            return partition
+    raise ValueError("disk image has no EFI System Partition")
@@ -0,0 +1,141 @@
+"""Check a generated disk image without mounting it.
+
+The GPT and the FAT32 file system of the ESP are read in pure Python,
+through the L1/L2 tables for qcow2 images, so no privileges, loop devices
+or qemu tools are needed. Next to listing the files of the ESP this
+confirms the build went through: the boot configs load the installer
+helper and boot with its kickstart file, the helper holds the kickstart
+file and every module the boot configs load is on the ESP.
+"""
+
+import hashlib
+import io
+import tarfile
+from pathlib import Path
+from pathlib import PurePosixPath
+
+from esxi_img import fat32
+from esxi_img import gpt
+from esxi_img import isoinfo
+from esxi_img import qcow2
+
+HELPER = PurePosixPath("ESXIIMG.TGZ")
+HELPER_MODULE = "esxiimg.tgz"
+KICKSTART = "esxiimg/KS.CFG"
+KICKSTART_OPTION = f"ks=file:///{KICKSTART}"
+
+
+def _read_kickstart(helper: bytes) -> bytes | None:
+    with tarfile.open(fileobj=io.BytesIO(helper), mode="r:*") as tar:
+        for member in tar:
+            if member.isfile() and member.name.removeprefix("./") == KICKSTART:
+                return tar.extractfile(member).read()
+    return None
+
+
+def _check_boot_cfg(name: str, text: str, files: set[str]) -> tuple[dict, list]:
+    settings = isoinfo.parse_boot_cfg(text)
+    modules = isoinfo.boot_modules(settings)
+    options = settings.get("kernelopt", "").split()
+    kickstarts = [option for option in options if option.startswith("ks=")]
+    info = {
+        "kernelopt": settings.get("kernelopt"),
+        "modules": modules,
+        "loads_helper": bool(modules) and modules[-1] == HELPER_MODULE,
+        "kickstart": kickstarts[-1] if kickstarts else None,
+    }
+    problems = []
+    if not info["loads_helper"]:
+        problems.append(f"{name} doesn't load /{HELPER_MODULE}")
+    if kickstarts != [KICKSTART_OPTION]:
+        problems.append(f"{name} doesn't boot with {KICKSTART_OPTION}")
+    problems += [
+        f"{name} loads {module} which isn't on the ESP"
+        for module in modules
+        if module.upper() not in files
+    ]
+    return info, problems
+
+
+def inspect_image(image_path: str | Path, extract_dir: Path | None = None) -> dict:
+    """Describe the ESP of a raw or qcow2 image built by esxi-img.
+
+    Args:
+        image_path: the image, the backing files of a qcow2 image are read
+                    too
+        extract_dir: optional directory to write the boot configs, the
+                     installer helper and its kickstart file to
+
+    Returns:
+        the image, the files on its ESP, what the boot configs and the
+        installer helper hold and the problems found, the image is fine
+        when there are none
+
+    Raises:
+        ValueError: If the image has no ESP with a FAT32 file system
+    """
+    with qcow2.open_image(image_path) as fp:
+        esp = gpt.find_esp(fp)
+        volume = fat32.Fat32Volume(fp, esp.offset)
+        files = volume.walk()
+        names = {str(path).upper() for path, _entry in files}
+
+        def read(path: PurePosixPath) -> bytes | None:
+            return volume.read(path) if str(path).upper() in names else None
+
+        configs = {
+            path: read(path) for path in (isoinfo.BOOT_CFG, isoinfo.EFI_BOOT_CFG)
+        }
+        helper = read(HELPER)
+        image = {
+            "name": Path(image_path).name,
+            "format": "qcow2" if isinstance(fp, qcow2.Qcow2Reader) else "raw",
+            "size": fp.seek(0, io.SEEK_END),
+            "backing_file": getattr(fp, "backing_file", None),
+        }
+
+    problems = []
+    boot_cfgs = {}
+    for path, data in configs.items():
+        if data is None:
+            if path == isoinfo.BOOT_CFG:
+                problems.append(f"{path} is missing")
+            continue
+        boot_cfgs[str(path)], found = _check_boot_cfg(str(path), data.decode(), names)
+        problems += found
+
+    kickstart = None
+    helper_info = None
+    if helper is None:
+        problems.append(f"{HELPER} is missing")
+    else:
+        try:
+            kickstart = _read_kickstart(helper)
+        except tarfile.TarError as e:
+            problems.append(f"{HELPER} can't be read: {e}")
+        else:
+            if kickstart is None:
+                problems.append(f"{HELPER} has no {KICKSTART}")
+        helper_info = {
+            "size": len(helper),
+            "sha256": hashlib.sha256(helper).hexdigest(),
+            "kickstart_size": None if kickstart is None else len(kickstart),
+        }
+
+    if extract_dir is not None:
+        extracted = {**configs, HELPER: helper, PurePosixPath("KS.CFG"): kickstart}
+        for path, data in extracted.items():
+            if data is None:
+                continue
+            target = extract_dir / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(data)
+
+    return {
+        "image": image,
+        "esp": {"offset": esp.offset, "size": esp.sectors * gpt.SECTOR_SIZE},
+        "files": [{"path": str(path), "size": entry.size} for path, entry in files],
+        "boot_cfgs": boot_cfgs,
+        "helper": helper_info,
+        "problems": problems,
+    }
@@ -0,0 +1,196 @@
+"""Helpers for reading the contents of the ESXi installer ISO.
+
+File data stored verbatim on the ISO is copied by the kernel with
+copy_file_range(2) or sendfile(2) straight from the ISO's descriptor, or
+written from a read-only memory map of the ISO, so it never passes
+through Python buffers.
+"""
+
+import contextlib
+import mmap
+import os
+import posixpath
+from collections.abc import Callable
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from pathlib import PurePosixPath
+from typing import BinaryIO
+
+import pycdlib
+
+from esxi_img import fscopy
+
+
+@dataclass(frozen=True)
+class IsoFile:
+    """A regular file on the ISO."""
+
+    # absolute ISO9660 path including the ";1" version suffix
+    iso_path: str
+    # path relative to the root of the ISO without the version suffix
+    path: PurePosixPath
+    size: int
+    # byte offset of the data on the ISO when it can be read directly
+    offset: int | None = None
+
+
+def _record_size(record) -> int:
+    """Size of a file record including any multi-extent continuations."""
+    size = 0
+    while record is not None:
+        size += record.data_length
+        record = record.data_continuation
+    return size
+
+
+def _is_boot_catalog(iso: pycdlib.PyCdlib, record) -> bool:
+    catalog = iso.eltorito_boot_catalog
+    if catalog is None:
+        return False
+    return any(
+        getattr(rec, "file_ident", None) == record.file_ident
+        and rec.parent == record.parent
+        for rec in catalog.dirrecords
+    )
+
+
+def _data_offset(iso: pycdlib.PyCdlib, record) -> int | None:
+    """Byte offset of the file data on the ISO if it is stored verbatim.
+
+    Multi-extent files, the El Torito boot catalog and files carrying a
+    boot info table are generated or stitched together by pycdlib so
+    they have to be read through it.
+    """
+    ino = record.inode
+    if ino is None or record.data_continuation is not None:
+        return None
+    if ino.boot_info_table is not None or _is_boot_catalog(iso, record):
+        return None
+    if ino.original_data_location != ino.DATA_ON_ORIGINAL_ISO:
+        return None
+    return ino.orig_extent_loc * iso.logical_block_size
+
+
+def list_tree(iso: pycdlib.PyCdlib) -> tuple[list[PurePosixPath], list[IsoFile]]:
+    """List every directory and file on an opened ISO.
+
+    Args:
+        iso: an opened pycdlib ISO
+
+    Returns:
+        the relative paths of all directories and the files on the ISO
+        in the order they were walked
+    """
+    dirs = []
+    files = []
+    for dirname, _dirlist, filelist in iso.walk(iso_path="/"):
+        rel = PurePosixPath(dirname).relative_to("/")
+        if dirname != "/":
+            dirs.append(rel)
+        for file in filelist:
+            iso_path = posixpath.join(dirname, file)
+            record = iso.get_record(iso_path=iso_path)
+            files.append(
+                IsoFile(
+                    iso_path,
+                    rel / file.rsplit(";", 1)[0],
+                    _record_size(record),
+                    _data_offset(iso, record),
+                )
+            )
+    return dirs, files
+
+
+def _copy_extent(iso_fd: int, file: IsoFile, dest: Path) -> int:
+    """Copy the data of a file on the ISO without reading it into Python."""
+    with dest.open("wb") as f:
+        try:
+            fscopy.copy_range(iso_fd, f.fileno(), file.offset, file.size)
+        except OSError as e:
+            raise OSError(f"failed to copy {file.iso_path}: {e}") from e
+    return file.size
+
+
+@contextlib.contextmanager
+def mapped(iso_path: str | Path) -> Iterator[mmap.mmap]:
+    """Map an ISO read-only into memory."""
+    with (
+        open(iso_path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as iso_map,
+    ):
+        yield iso_map
+
+
+def extent_writer(
+    iso_map: mmap.mmap,
+    file: IsoFile,
+    observe: Callable[[int, memoryview], None] | None = None,
+) -> Callable[[BinaryIO], None]:
+    """A callable writing a file's data from the mapped ISO to a file object.
+
+    The data is handed to the file object as views of the mapping and the
+    pages are dropped from the mapping once written, they stay in the page
+    cache but don't add up in the resident size of the process. observe
+    is called with the ISO offset and the view of every chunk written.
+    """
+    if file.offset is None:
+        raise ValueError(f"{file.iso_path} is not stored verbatim on the ISO")
+
+    def _write(fp: BinaryIO) -> None:
+        offset = file.offset
+        end = file.offset + file.size
+        with memoryview(iso_map) as view:
+            while offset < end:
+                count = min(fscopy.ZERO_COPY_CHUNK, end - offset)
+                with view[offset : offset + count] as chunk:
+                    fp.write(chunk)
+                    if observe:
+                        observe(offset, chunk)
+                start = offset - offset % mmap.PAGESIZE
+                iso_map.madvise(mmap.MADV_DONTNEED, start, offset + count - start)
+                offset += count
+
+    return _write
+
+
+def copy_extents(
+    iso_path: str,
+    files: list[IsoFile],
+    output_dir: Path,
+    workers: int | None = None,
+    progress: Callable[[int, int], None] | None = None,
+) -> None:
+    """Copy files out of the ISO concurrently.
+
+    Every worker copies its file's extent from a single shared descriptor
+    for the ISO using explicit offsets so no seeking state is shared.
+
+    Args:
+        iso_path: Path to the ISO file
+        files: files to copy, each must have an offset
+        output_dir: Directory the files are copied into, the parent
+                    directories must already exist
+        workers: maximum number of concurrent copies, defaults to the
+                 executor's default based on the CPU count
+        progress: called with the files and bytes copied so far each time
+                  a file completes
+    """
+    iso_fd = os.open(iso_path, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_copy_extent, iso_fd, file, output_dir / file.path)
+                for file in files
+            ]
+            done_files = 0
+            done_bytes = 0
+            for future in as_completed(futures):
+                done_bytes += future.result()
+                done_files += 1
+                if progress:
+                    progress(done_files, done_bytes)
+    finally:
+        os.close(iso_fd)
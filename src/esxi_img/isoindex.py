@@ -0,0 +1,213 @@
+"""A compact index of the files on an ESXi installer ISO.
+
+Walking the ISO9660 directory records with pycdlib means parsing every
+record of the ISO. The index is built once per ISO and holds what later
+operations need to go straight to the bytes they want: for every file its
+path, size, the offset of its extent on the ISO and the SHA-256 of its
+contents, along with the ESXi version and build from BOOT.CFG.
+
+The ISO cache persists the index of every ISO it has seen next to the
+extracted trees, see IsoCache.index().
+"""
+
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import replace
+from pathlib import Path
+from pathlib import PurePosixPath
+
+import pycdlib
+
+from esxi_img import isofs
+
+# bumped whenever the layout of the index changes
+FORMAT_VERSION = 1
+
+# e.g. build=8.0.3-0.0.24022510
+_BUILD_RE = re.compile(r"^build=(?P<version>[\d.]+)-(?:[\d.]*\.)?(?P<build>\d+)\s*$")
+
+
+class _HashWriter:
+    """A file-like object hashing what is written to it."""
+
+    def __init__(self) -> None:
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.digest.update(data)
+        return len(data)
+
+
+def parse_build(boot_cfg: str) -> tuple[str | None, str | None]:
+    """The ESXi version and build number a BOOT.CFG names."""
+    for line in boot_cfg.splitlines():
+        match = _BUILD_RE.match(line)
+        if match:
+            return match["version"], match["build"]
+    return None, None
+
+
+@dataclass(frozen=True)
+class IndexedFile:
+    # absolute ISO9660 path including the ";1" version suffix
+    iso_path: str
+    # path relative to the root of the ISO without the version suffix
+    path: str
+    size: int
+    # byte offset of the data on the ISO when it can be read directly
+    offset: int | None
+    sha256: str
+
+    def iso_file(self) -> isofs.IsoFile:
+        return isofs.IsoFile(
+            self.iso_path, PurePosixPath(self.path), self.size, self.offset
+        )
+
+
+@dataclass(frozen=True)
+class IsoIndex:
+    """The directories and files of an ISO and the ESXi release on it."""
+
+    # SHA-256 and size of the ISO
+    sha256: str
+    size: int
+    version: str | None
+    build: str | None
+    dirs: list[str]
+    files: list[IndexedFile]
+
+    @classmethod
+    def from_iso(
+        cls,
+        iso_path: str | Path,
+        iso_sha256: str | None = None,
+        workers: int | None = None,
+    ) -> "IsoIndex":
+        """Index an ISO, hashing its files concurrently.
+
+        Args:
+            iso_path: the ISO
+            iso_sha256: its digest, when not known yet it is computed along
+                        with the digests of the files so the ISO is only
+                        read once
+            workers: maximum number of files hashed at once
+        """
+        iso = pycdlib.PyCdlib()
+        iso.open(str(iso_path))
+        try:
+            dirs, files = isofs.list_tree(iso)
+            digests = {}
+            # anything pycdlib has to assemble itself is read through it
+            for file in files:
+                if file.offset is None:
+                    writer = _HashWriter()
+                    iso.get_file_from_iso_fp(writer, iso_path=file.iso_path)
+                    digests[file.path] = writer.digest.hexdigest()
+        finally:
+            iso.close()
+
+        direct = [file for file in files if file.offset is not None]
+        with (
+            isofs.mapped(str(iso_path)) as iso_map,
+            memoryview(iso_map) as view,
+            ThreadPoolExecutor(max_workers=workers) as pool,
+        ):
+            whole = None
+            if iso_sha256 is None:
+                whole = pool.submit(lambda: hashlib.sha256(view).hexdigest())
+            # hashlib releases the GIL so the files are hashed in parallel
+            hashed = pool.map(
+                lambda file: hashlib.sha256(
+                    view[file.offset : file.offset + file.size]
+                ).hexdigest(),
+                direct,
+            )
+            digests.update(zip((file.path for file in direct), hashed, strict=True))
+            if whole is not None:
+                iso_sha256 = whole.result()
+
+        index = cls(
+            sha256=iso_sha256,
+            size=os.stat(iso_path).st_size,
+            version=None,
+            build=None,
+            dirs=[str(dirname) for dirname in dirs],
+            files=[
+                IndexedFile(
+                    file.iso_path,
+                    str(file.path),
+                    file.size,
+                    file.offset,
+                    digests[file.path],
+                )
+                for file in files
+            ],
+        )
+        boot_cfg = index.lookup("BOOT.CFG")
+        if boot_cfg is None:
+            return index
+        version, build = parse_build(index.read(iso_path, boot_cfg).decode())
+        return replace(index, version=version, build=build)
+
+    def to_json(self) -> str:
+        return json.dumps({"format": FORMAT_VERSION, **asdict(self)})
+
+    @classmethod
+    def from_json(cls, text: str) -> "IsoIndex":
+        """Load an index written by to_json().
+
+        Raises:
+            ValueError: If it is malformed or of another format version
+        """
+        data = json.loads(text)
+        if not isinstance(data, dict) or data.pop("format", None) != FORMAT_VERSION:
+            raise ValueError("unsupported ISO index format")
+        try:
+            files = [IndexedFile(**file) for file in data.pop("files")]
+            return cls(**data, files=files)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"invalid ISO index: {e}") from None
+
+    @functools.cached_property
+    def _by_path(self) -> dict[str, IndexedFile]:
+        return {file.path: file for file in self.files}
+
+    def lookup(self, path: str | PurePosixPath) -> IndexedFile | None:
+        """Find a file by its path relative to the root of the ISO."""
+        return self._by_path.get(str(PurePosixPath(path)))
+
+    def tree(self) -> tuple[list[PurePosixPath], list[isofs.IsoFile]]:
+        """The directories and files as isofs.list_tree() lists them."""
+        return (
+            [PurePosixPath(dirname) for dirname in self.dirs],
+            [file.iso_file() for file in self.files],
+        )
+
+    def read(self, iso_path: str | Path, file: IndexedFile) -> bytes:
+        """Read a file's contents from the ISO."""
+        if file.offset is not None:
+            data = bytearray()
+            with open(iso_path, "rb") as f:
+                while len(data) < file.size:
+                    chunk = os.pread(
+                        f.fileno(), file.size - len(data), file.offset + len(data)
+                    )
+                    if not chunk:
+                        raise OSError(f"unexpected end of file reading {file.path}")
+                    data += chunk
+            return bytes(data)
+        iso = pycdlib.PyCdlib()
+        iso.open(str(iso_path))
+        try:
+            with io.BytesIO() as buf:
+                iso.get_file_from_iso_fp(buf, iso_path=file.iso_path)
+                return buf.getvalue()
+        finally:
+            iso.close()
@@ -0,0 +1,147 @@
+"""Describe an ESXi installer ISO without extracting it.
+
+Only the boot configs and the image database are read off the ISO. The
+image database, IMGDB.TGZ, is a small tarball holding the descriptors of
+the VIBs on the media and the image profile they make up.
+"""
+
+import io
+import os
+import tarfile
+from pathlib import Path
+from pathlib import PurePosixPath
+from xml.etree import ElementTree
+
+import pycdlib
+
+from esxi_img import isofs
+from esxi_img import isoindex
+
+BOOT_CFG = PurePosixPath("BOOT.CFG")
+EFI_BOOT_CFG = PurePosixPath("EFI/BOOT/BOOT.CFG")
+IMGDB = PurePosixPath("IMGDB.TGZ")
+
+_VIBS_DIR = "var/db/esximg/vibs/"
+_PROFILES_DIR = "var/db/esximg/profiles/"
+
+
+def parse_boot_cfg(text: str) -> dict[str, str]:
+    """The settings of a BOOT.CFG, modules stay a single string."""
+    settings = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition("=")
+        if sep and not key.startswith("#"):
+            settings[key.strip()] = value.strip()
+    return settings
+
+
+def boot_modules(settings: dict[str, str]) -> list[str]:
+    """The kernel and modules a BOOT.CFG loads, in order."""
+    names = [settings["kernel"]] if settings.get("kernel") else []
+    names += settings.get("modules", "").split("---")
+    return [name.strip().lstrip("/") for name in names if name.strip()]
+
+
+def _text(element: ElementTree.Element, tag: str) -> str | None:
+    found = element.find(tag)
+    return None if found is None or found.text is None else found.text.strip()
+
+
+def vib_inventory(imgdb: bytes) -> tuple[str | None, list[dict]]:
+    """The image profile and the VIBs listed in an image database.
+
+    Returns:
+        the name of the image profile and name, version, vendor, type and
+        acceptance level of each VIB sorted by name
+
+    Raises:
+        ValueError: If the image database can't be read
+    """
+    profile = None
+    vibs = []
+    try:
+        with tarfile.open(fileobj=io.BytesIO(imgdb), mode="r:*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = member.name.removeprefix("./")
+                if not name.startswith((_VIBS_DIR, _PROFILES_DIR)):
+                    continue
+                # written by VMware's tooling onto the installer media
+                root = ElementTree.fromstring(tar.extractfile(member).read())  # noqa: S314
+                if name.startswith(_PROFILES_DIR):
+                    profile = _text(root, "name") or profile
+                    continue
+                vibs.append(
+                    {
+                        "name": _text(root, "name"),
+                        "version": _text(root, "version"),
+                        "vendor": _text(root, "vendor"),
+                        "type": _text(root, "type"),
+                        "acceptance_level": _text(root, "acceptance-level"),
+                    }
+                )
+    except (tarfile.TarError, ElementTree.ParseError) as e:
+        raise ValueError(f"invalid image database: {e}") from None
+    return profile, sorted(vibs, key=lambda vib: vib["name"] or "")
+
+
+def _iso_name(module: str) -> PurePosixPath:
+    # BOOT.CFG names modules in lower case, ISO9660 stores them upper case
+    return PurePosixPath(module.upper())
+
+
+def inspect_iso(iso_path: str | Path) -> dict:
+    """Describe the ESXi release on an installer ISO.
+
+    Raises:
+        ValueError: If the ISO has no BOOT.CFG or its image database can't
+                    be read
+    """
+    iso = pycdlib.PyCdlib()
+    iso.open(str(iso_path))
+    try:
+        _dirs, files = isofs.list_tree(iso)
+        by_path = {file.path: file for file in files}
+
+        def read(path: PurePosixPath) -> bytes | None:
+            file = by_path.get(path)
+            if file is None:
+                return None
+            with io.BytesIO() as buf:
+                iso.get_file_from_iso_fp(buf, iso_path=file.iso_path)
+                return buf.getvalue()
+
+        boot_cfg = read(BOOT_CFG)
+        if boot_cfg is None:
+            raise ValueError(f"{iso_path} has no {BOOT_CFG}, not an ESXi installer")
+        efi_boot_cfg = read(EFI_BOOT_CFG)
+        imgdb = read(IMGDB)
+    finally:
+        iso.close()
+
+    settings = parse_boot_cfg(boot_cfg.decode())
+    version, build = isoindex.parse_build(boot_cfg.decode())
+    profile, vibs = vib_inventory(imgdb) if imgdb is not None else (None, [])
+    modules = boot_modules(settings)
+    return {
+        "iso": {"name": Path(iso_path).name, "size": os.stat(iso_path).st_size},
+        "version": version,
+        "build": build,
+        "title": settings.get("title"),
+        "kernelopt": settings.get("kernelopt"),
+        "modules": [
+            {
+                "name": name,
+                "size": file.size if (file := by_path.get(_iso_name(name))) else None,
+            }
+            for name in modules
+        ],
+        "efi_boot_cfg_matches": (
+            None
+            if efi_boot_cfg is None
+            else boot_modules(parse_boot_cfg(efi_boot_cfg.decode())) == modules
+        ),
+        "image_profile": profile,
+        "vibs": vibs,
+    }
@@ -0,0 +1,193 @@
+"""Record the time and resources each stage of an image build takes.
+
+CPU time of child processes such as qemu-img and mkfs.vfat is counted
+once they have been waited for. On Linux the bytes read and written
+come from /proc/self/io which also accumulates the I/O of waited for
+children, and the peak RSS of each stage is measured by resetting the
+process' high water mark when the stage starts.
+
+Stages may run on different threads at the same time: the installer
+helper is generated on a background thread while the ISO is indexed and
+extracted and the disk image is laid out. The resources are those of the
+whole process so the figures of overlapping stages include each other's.
+The high water mark is only reset by a stage starting while no other one
+runs, a reset would lose the peak of the running stage, so the peak RSS
+of overlapping stages is that of all of them since the first started.
+"""
+
+import contextlib
+import json
+import platform
+import resource
+import threading
+import time
+from collections.abc import Iterator
+from dataclasses import asdict
+from dataclasses import dataclass
+from pathlib import Path
+
+# ru_maxrss is in KiB on Linux and bytes on macOS
+_MAXRSS_SCALE = 1 if platform.system() == "Darwin" else 1024
+
+
+@dataclass
+class StageProfile:
+    name: str
+    wall_seconds: float
+    user_seconds: float
+    system_seconds: float
+    children_user_seconds: float
+    children_system_seconds: float
+    # bytes fetched from and sent to storage, None when not available
+    read_bytes: int | None
+    write_bytes: int | None
+    # bytes passed through read(2)/write(2) and similar calls
+    read_chars: int | None
+    write_chars: int | None
+    peak_rss_bytes: int
+    # largest child process waited for so far
+    children_peak_rss_bytes: int
+
+
+def _proc_io() -> dict[str, int]:
+    try:
+        with open("/proc/self/io") as f:
+            return {
+                key: int(value)
+                for key, value in (line.split(":", 1) for line in f if ":" in line)
+            }
+    except OSError:
+        return {}
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            # resets the peak resident set size
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> int | None:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _delta(after: dict[str, int], before: dict[str, int], key: str) -> int | None:
+    if key not in after or key not in before:
+        return None
+    return after[key] - before[key]
+
+
+class Profiler:
+    """Collect a profile for each stage of a build.
+
+    Args:
+        enabled: when False stages are not measured at all
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.stages: list[StageProfile] = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        # stages running and whether the first of them reset the peak RSS
+        self._active = 0
+        self._peak_reset = False
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Measure the code run inside the context as the named stage."""
+        if not self.enabled:
+            yield
+            return
+
+        with self._lock:
+            if not self._active:
+                self._peak_reset = _reset_peak_rss()
+            self._active += 1
+            reset = self._peak_reset
+        io_before = _proc_io()
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            with self._lock:
+                self._active -= 1
+            self_after = resource.getrusage(resource.RUSAGE_SELF)
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            io_after = _proc_io()
+            peak = _peak_rss() if reset else None
+            if peak is None:
+                # only the peak for the whole process is known
+                peak = self_after.ru_maxrss * _MAXRSS_SCALE
+
+            self.stages.append(
+                StageProfile(
+                    name=name,
+                    wall_seconds=wall,
+                    user_seconds=self_after.ru_utime - self_before.ru_utime,
+                    system_seconds=self_after.ru_stime - self_before.ru_stime,
+                    children_user_seconds=children_after.ru_utime
+                    - children_before.ru_utime,
+                    children_system_seconds=children_after.ru_stime
+                    - children_before.ru_stime,
+                    read_bytes=_delta(io_after, io_before, "read_bytes"),
+                    write_bytes=_delta(io_after, io_before, "write_bytes"),
+                    read_chars=_delta(io_after, io_before, "rchar"),
+                    write_chars=_delta(io_after, io_before, "wchar"),
+                    peak_rss_bytes=peak,
+                    children_peak_rss_bytes=children_after.ru_maxrss * _MAXRSS_SCALE,
+                )
+            )
+
+    def report(self, **details) -> dict:
+        """The profile of every stage along with totals.
+
+        Args:
+            details: extra information about the build to include
+        """
+        stages = [asdict(stage) for stage in self.stages]
+
+        def total(key: str):
+            values = [stage[key] for stage in stages]
+            if any(value is None for value in values):
+                return None
+            return sum(values)
+
+        totals = {
+            key: total(key)
+            for key in (
+                "user_seconds",
+                "system_seconds",
+                "children_user_seconds",
+                "children_system_seconds",
+                "read_bytes",
+                "write_bytes",
+                "read_chars",
+                "write_chars",
+            )
+        }
+        totals["wall_seconds"] = time.perf_counter() - self._start
+        totals["peak_rss_bytes"] = max(
+            (stage["peak_rss_bytes"] for stage in stages), default=0
+        )
+        totals["children_peak_rss_bytes"] = max(
+            (stage["children_peak_rss_bytes"] for stage in stages), default=0
+        )
+        return {**details, "total": totals, "stages": stages}
+
+    def write(self, path: str | Path, **details) -> None:
+        """Write the report as JSON."""
+        Path(path).write_text(json.dumps(self.report(**details), indent=2) + "\n")
@@ -0,0 +1,626 @@
+"""Streaming qcow2 (version 3) writer.
+
+The writer behaves like a seekable file for the guest disk so the GPT
+and FAT32 writers can lay the filesystem out straight into it. Guest
+clusters are appended to the image as they are completed and clusters
+which are never written or only hold zeros are not allocated at all.
+The L1/L2 tables and the refcount structures are written at the end.
+
+Images can also be layered: overlay() stores only the clusters of a disk
+which differ from a base image and records the base as its backing file.
+"""
+
+import io
+import math
+import os
+import struct
+import zlib
+from collections.abc import Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+from esxi_img import sparse
+
+MAGIC = b"QFI\xfb"
+VERSION = 3
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+HEADER_LENGTH = 104
+# 16 bit refcounts
+REFCOUNT_ORDER = 4
+
+L2_ENTRIES = CLUSTER_SIZE // 8
+REFCOUNT_BLOCK_ENTRIES = CLUSTER_SIZE * 8 // (1 << REFCOUNT_ORDER)
+
+OFLAG_COPIED = 1 << 63
+OFLAG_COMPRESSED = 1 << 62
+OFFSET_MASK = 0x00FFFFFFFFFFFE00
+# compressed cluster descriptors split the remaining bits into offset and size
+CSIZE_SHIFT = 62 - (CLUSTER_BITS - 8)
+CSIZE_MASK = (1 << (CLUSTER_BITS - 8)) - 1
+COFFSET_MASK = (1 << CSIZE_SHIFT) - 1
+
+_HEADER = struct.Struct(">4sIQIIQIIQQIIQQQQII")
+ZERO_CLUSTER = bytes(CLUSTER_SIZE)
+
+
+def _compress(data: bytes, level: int) -> bytes:
+    # qcow2 stores compressed clusters as raw deflate streams
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -12)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Qcow2Writer(io.RawIOBase):
+    """Write a qcow2 image as if it were a raw disk.
+
+    Args:
+        path: the qcow2 file to create
+        size: virtual size of the disk in bytes
+        compress: store guest clusters deflate compressed when smaller
+        compress_level: zlib compression level
+        backing_file: optional backing file name recorded in the header,
+                      clusters which are not written read from it
+        backing_format: format of the backing file
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        size: int,
+        compress: bool = False,
+        compress_level: int = 6,
+        backing_file: str | None = None,
+        backing_format: str | None = None,
+    ) -> None:
+        super().__init__()
+        self.size = size
+        self.compress = compress
+        self.compress_level = compress_level
+        self.backing_file = backing_file
+        self.backing_format = backing_format
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._pos = 0
+        # guest cluster index -> L2 entry
+        self._map: dict[int, int] = {}
+        # guest clusters currently being filled
+        self._pending: dict[int, bytearray] = {}
+        # host cluster index -> refcount of the data clusters
+        self._refcounts: dict[int, int] = {}
+        # the header lives in host cluster 0
+        self._host_end = CLUSTER_SIZE
+        self._refcounts[0] = 1
+
+    # file object interface
+
+    def readable(self) -> bool:
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        return self._pos
+
+    def truncate(self, size: int | None = None) -> int:
+        """Set the virtual size of the disk."""
+        if size is not None:
+            self.size = size
+        return self.size
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        length = len(data)
+        if self._pos + length > self.size:
+            raise OSError(f"write beyond the end of the {self.size} byte disk")
+
+        done = 0
+        while done < length:
+            index, within = divmod(self._pos, CLUSTER_SIZE)
+            # clusters are stored in the order the writer passes them, however
+            # the writes are chunked
+            self._store_passed(index)
+            count = min(CLUSTER_SIZE - within, length - done)
+            chunk = data[done : done + count]
+            if count == CLUSTER_SIZE and index not in self._pending:
+                self._store(index, chunk)
+            else:
+                buf = self._pending.get(index)
+                if buf is None:
+                    buf = self._load(index)
+                    self._pending[index] = buf
+                buf[within : within + count] = chunk
+            self._pos += count
+            done += count
+
+        self._store_passed(self._pos // CLUSTER_SIZE)
+        return length
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            for index in sorted(self._pending):
+                self._store(index, self._pending.pop(index))
+            self._write_metadata()
+        finally:
+            os.close(self._fd)
+            super().close()
+
+    # cluster handling
+    def _store_passed(self, current: int) -> None:
+        # the writers only move forward, anything behind is complete
+        for index in sorted(i for i in self._pending if i < current):
+            self._store(index, self._pending.pop(index))
+
+    def _load(self, index: int) -> bytearray:
+        """Current contents of a guest cluster."""
+        entry = self._map.get(index)
+        if entry is None:
+            return bytearray(CLUSTER_SIZE)
+        if entry & OFLAG_COMPRESSED:
+            offset, length = self._compressed_range(entry)
+            raw = os.pread(self._fd, length, offset)
+            self._release(entry)
+            del self._map[index]
+            return bytearray(zlib.decompressobj(-12).decompress(raw, CLUSTER_SIZE))
+        return bytearray(os.pread(self._fd, CLUSTER_SIZE, entry & OFFSET_MASK))
+
+    @staticmethod
+    def _compressed_range(entry: int) -> tuple[int, int]:
+        offset = entry & COFFSET_MASK
+        sectors = ((entry >> CSIZE_SHIFT) & CSIZE_MASK) + 1
+        start = offset & ~511
+        return offset, start + sectors * 512 - offset
+
+    def _compressed_clusters(self, entry: int) -> range:
+        offset, length = self._compressed_range(entry)
+        start = offset & ~511
+        return range(start // CLUSTER_SIZE, (offset + length - 1) // CLUSTER_SIZE + 1)
+
+    def _release(self, entry: int) -> None:
+        for host in self._compressed_clusters(entry):
+            self._refcounts[host] -= 1
+
+    def _store(self, index: int, data) -> None:
+        entry = self._map.get(index)
+        if entry is not None:
+            if not entry & OFLAG_COMPRESSED:
+                # already allocated, update it in place
+                os.pwrite(self._fd, data, entry & OFFSET_MASK)
+                return
+            # compressed data can't be updated in place, store it anew
+            self._release(entry)
+            del self._map[index]
+        if data == ZERO_CLUSTER and self.backing_file is None:
+            return
+
+        if self.compress:
+            packed = _compress(bytes(data), self.compress_level)
+            if len(packed) < CLUSTER_SIZE - 512:
+                # qemu packs compressed clusters back to back but not every
+                # reader copes with unaligned ones, sector alignment is cheap
+                offset = math.ceil(self._host_end / 512) * 512
+                os.pwrite(self._fd, packed, offset)
+                self._host_end = offset + len(packed)
+                sectors = (offset + len(packed) - 1) // 512 - offset // 512
+                entry = OFLAG_COMPRESSED | (sectors << CSIZE_SHIFT) | offset
+                for host in self._compressed_clusters(entry):
+                    self._refcounts[host] = self._refcounts.get(host, 0) + 1
+                self._map[index] = entry
+                return
+
+        offset = self._align_host_end()
+        os.pwrite(self._fd, data, offset)
+        self._host_end = offset + CLUSTER_SIZE
+        self._refcounts[offset // CLUSTER_SIZE] = 1
+        self._map[index] = offset | OFLAG_COPIED
+
+    def _align_host_end(self) -> int:
+        return math.ceil(self._host_end / CLUSTER_SIZE) * CLUSTER_SIZE
+
+    # metadata
+
+    def _allocate_clusters(self, count: int) -> int:
+        offset = self._align_host_end()
+        self._host_end = offset + count * CLUSTER_SIZE
+        for n in range(count):
+            self._refcounts[offset // CLUSTER_SIZE + n] = 1
+        return offset
+
+    def _write_metadata(self) -> None:
+        l1_size = max(1, math.ceil(self.size / (CLUSTER_SIZE * L2_ENTRIES)))
+
+        # L2 tables for the parts of the disk which hold data
+        tables: dict[int, list[int]] = {}
+        for index, entry in self._map.items():
+            l1_index, l2_index = divmod(index, L2_ENTRIES)
+            tables.setdefault(l1_index, [0] * L2_ENTRIES)[l2_index] = entry
+
+        l1 = [0] * l1_size
+        for l1_index in sorted(tables):
+            offset = self._allocate_clusters(1)
+            os.pwrite(
+                self._fd, struct.pack(f">{L2_ENTRIES}Q", *tables[l1_index]), offset
+            )
+            l1[l1_index] = offset | OFLAG_COPIED
+
+        l1_offset = self._allocate_clusters(math.ceil(l1_size * 8 / CLUSTER_SIZE))
+        os.pwrite(self._fd, struct.pack(f">{l1_size}Q", *l1), l1_offset)
+
+        # the refcount structures have to count themselves too
+        used = self._align_host_end() // CLUSTER_SIZE
+        table_clusters = 1
+        block_count = 1
+        while True:
+            blocks = math.ceil(
+                (used + table_clusters + block_count) / REFCOUNT_BLOCK_ENTRIES
+            )
+            table = math.ceil(blocks * 8 / CLUSTER_SIZE)
+            if blocks == block_count and table == table_clusters:
+                break
+            block_count = max(blocks, block_count)
+            table_clusters = max(table, table_clusters)
+
+        table_offset = self._allocate_clusters(table_clusters)
+        blocks_offset = self._allocate_clusters(block_count)
+        total_clusters = self._host_end // CLUSTER_SIZE
+
+        refcount_table = [blocks_offset + n * CLUSTER_SIZE for n in range(block_count)]
+        os.pwrite(
+            self._fd, struct.pack(f">{block_count}Q", *refcount_table), table_offset
+        )
+        for n in range(block_count):
+            first = n * REFCOUNT_BLOCK_ENTRIES
+            counts = [
+                self._refcounts.get(host, 0)
+                for host in range(
+                    first, min(first + REFCOUNT_BLOCK_ENTRIES, total_clusters)
+                )
+            ]
+            os.pwrite(
+                self._fd,
+                struct.pack(f">{len(counts)}H", *counts),
+                blocks_offset + n * CLUSTER_SIZE,
+            )
+
+        header = self._header(l1_size, l1_offset, table_offset, table_clusters)
+        os.pwrite(self._fd, header, 0)
+        os.ftruncate(self._fd, self._host_end)
+
+    def _header(
+        self, l1_size: int, l1_offset: int, table_offset: int, table_clusters: int
+    ) -> bytes:
+        extensions = b""
+        if self.backing_format:
+            fmt = self.backing_format.encode()
+            padded = fmt.ljust(math.ceil(len(fmt) / 8) * 8, b"\x00")
+            # backing file format name extension
+            extensions += struct.pack(">II", 0xE2792ACA, len(fmt)) + padded
+        # end of the header extensions
+        extensions += struct.pack(">II", 0, 0)
+
+        backing_offset = 0
+        backing = b""
+        if self.backing_file:
+            backing = self.backing_file.encode()
+            backing_offset = HEADER_LENGTH + len(extensions)
+
+        header = _HEADER.pack(
+            MAGIC,
+            VERSION,
+            backing_offset,
+            len(backing),
+            CLUSTER_BITS,
+            self.size,
+            0,
+            l1_size,
+            l1_offset,
+            table_offset,
+            table_clusters,
+            0,
+            0,
+            0,
+            0,
+            0,
+            REFCOUNT_ORDER,
+            HEADER_LENGTH,
+        )
+        return header + extensions + backing
+
+
+def convert(raw_path: str | Path, path: str | Path, compress: bool = False) -> None:
+    """Convert a raw disk image, only its data regions are read."""
+    with open(raw_path, "rb") as src:
+        fd = src.fileno()
+        size = os.fstat(fd).st_size
+        with Qcow2Writer(path, size, compress) as dst:
+            for start, length in sparse.data_segments(fd, size):
+                offset = start
+                end = start + length
+                while offset < end:
+                    chunk = os.pread(fd, min(sparse.COPY_BUFSIZE, end - offset), offset)
+                    if not chunk:
+                        break
+                    dst.seek(offset)
+                    dst.write(chunk)
+                    offset += len(chunk)
+
+
+class Qcow2Reader(io.RawIOBase):
+    """Read the guest disk of a qcow2 image as if it were a raw disk.
+
+    Clusters the image doesn't hold are read from its backing file, whose
+    relative name is taken from the directory of the image, or as zeros
+    when it has none.
+
+    Args:
+        path: the qcow2 image
+
+    Raises:
+        ValueError: If the file isn't a qcow2 image
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        super().__init__()
+        self.path = Path(path)
+        self._fd = os.open(path, os.O_RDONLY)
+        self._pos = 0
+        self.backing: BinaryIO | None = None
+        # L1 index -> L2 table, read when first needed
+        self._l2: dict[int, tuple[int, ...]] = {}
+        # the last compressed cluster, read piecewise by the FAT reader
+        self._inflated: tuple[int, bytes] | None = None
+        try:
+            header = os.pread(self._fd, _HEADER.size, 0).ljust(_HEADER.size, b"\0")
+            fields = _HEADER.unpack(header)
+            magic, _version, backing_offset, backing_size, cluster_bits = fields[:5]
+            self.size = fields[5]
+            l1_size, l1_offset = fields[7:9]
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a qcow2 image")
+            self.cluster_size = 1 << cluster_bits
+            self._l2_entries = self.cluster_size // 8
+            self._csize_shift = 62 - (cluster_bits - 8)
+            self._csize_mask = (1 << (cluster_bits - 8)) - 1
+            self._l1 = struct.unpack(
+                f">{l1_size}Q", os.pread(self._fd, l1_size * 8, l1_offset)
+            )
+            self.backing_file = None
+            self.backing_path = None
+            if backing_offset:
+                self.backing_file = os.pread(
+                    self._fd, backing_size, backing_offset
+                ).decode()
+                self.backing_path = self.path.parent / self.backing_file
+                self.backing = open_image(self.backing_path)
+        except BaseException:
+            self.close()
+            raise
+
+    # file object interface
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        length = max(0, min(len(view), self.size - self._pos))
+        done = 0
+        while done < length:
+            index, within = divmod(self._pos, self.cluster_size)
+            count = min(self.cluster_size - within, length - done)
+            view[done : done + count] = self._read(index, within, count)
+            self._pos += count
+            done += count
+        return done
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self.backing is not None:
+                self.backing.close()
+        finally:
+            os.close(self._fd)
+            super().close()
+
+    # cluster handling
+
+    def _entry(self, index: int) -> int:
+        """The L2 entry of a guest cluster, 0 when it isn't allocated."""
+        l1_index, l2_index = divmod(index, self._l2_entries)
+        if l1_index >= len(self._l1):
+            return 0
+        table = self._l2.get(l1_index)
+        if table is None:
+            l2_offset = self._l1[l1_index] & OFFSET_MASK
+            if not l2_offset:
+                return 0
+            table = struct.unpack(
+                f">{self._l2_entries}Q",
+                os.pread(self._fd, self.cluster_size, l2_offset),
+            )
+            self._l2[l1_index] = table
+        return table[l2_index]
+
+    def _cluster(self, entry: int) -> bytes | None:
+        """Contents of a cluster stored in the image, None if it isn't.
+
+        Clusters flagged as reading zeros have to be handled by the caller.
+        """
+        if entry & OFLAG_COMPRESSED:
+            if self._inflated is None or self._inflated[0] != entry:
+                offset = entry & ((1 << self._csize_shift) - 1)
+                sectors = ((entry >> self._csize_shift) & self._csize_mask) + 1
+                length = (offset & ~511) + sectors * 512 - offset
+                data = zlib.decompressobj(-12).decompress(
+                    os.pread(self._fd, length, offset), self.cluster_size
+                )
+                self._inflated = (entry, data.ljust(self.cluster_size, b"\0"))
+            return self._inflated[1]
+        if entry & OFFSET_MASK:
+            data = os.pread(self._fd, self.cluster_size, entry & OFFSET_MASK)
+            return data.ljust(self.cluster_size, b"\0")
+        return None
+
+    def _read(self, index: int, within: int, count: int) -> bytes:
+        entry = self._entry(index)
+        if entry & 1 and not entry & OFLAG_COMPRESSED:
+            # explicitly zero, even over a backing file
+            return bytes(count)
+        data = self._cluster(entry)
+        if data is not None:
+            return data[within : within + count]
+        if self.backing is None:
+            return bytes(count)
+        self.backing.seek(index * self.cluster_size + within)
+        # a backing file smaller than the image reads as zeros past its end
+        return self.backing.read(count).ljust(count, b"\0")
+
+    def holds(self, offset: int, length: int) -> bool:
+        """Whether the image itself holds any of a range of the guest disk.
+
+        A range it doesn't hold reads from the backing file or as zeros.
+        """
+        if length <= 0:
+            return False
+        first = offset // self.cluster_size
+        last = (offset + length - 1) // self.cluster_size
+        return any(self._entry(index) for index in range(first, last + 1))
+
+    def clusters(self) -> Iterator[tuple[int, bytes]]:
+        """The guest offset and contents of each cluster the image holds.
+
+        Clusters read from the backing file or as zeros are skipped.
+        """
+        for l1_index in range(len(self._l1)):
+            for l2_index in range(self._l2_entries):
+                index = l1_index * self._l2_entries + l2_index
+                entry = self._entry(index)
+                if entry & 1 and not entry & OFLAG_COMPRESSED:
+                    continue
+                data = self._cluster(entry)
+                if data is None:
+                    continue
+                guest = index * self.cluster_size
+                if guest >= self.size:
+                    return
+                yield guest, data[: self.size - guest]
+
+
+def open_image(path: str | Path) -> BinaryIO:
+    """Open a raw or qcow2 disk image to read the guest disk from it."""
+    with open(path, "rb") as f:
+        is_qcow2 = f.read(len(MAGIC)) == MAGIC
+    return Qcow2Reader(path) if is_qcow2 else open(path, "rb")
+
+
+def expand(path: str | Path, raw_path: str | Path) -> None:
+    """Write the guest contents of a qcow2 image as a sparse raw image.
+
+    Raises:
+        ValueError: If the file isn't a qcow2 image or has a backing file
+    """
+    with Qcow2Reader(path) as image, open(raw_path, "wb") as dst:
+        if image.backing_file:
+            raise ValueError(f"{path} has a backing file")
+        for guest, data in image.clusters():
+            if data.strip(b"\x00"):
+                os.pwrite(dst.fileno(), data, guest)
+        dst.truncate(image.size)
+
+
+def _cluster_ranges(segments) -> list[list[int]]:
+    """Merge byte ranges into sorted ranges of the clusters they touch."""
+    merged: list[list[int]] = []
+    for first, last in sorted(
+        (start // CLUSTER_SIZE, math.ceil((start + length) / CLUSTER_SIZE))
+        for start, length in segments
+    ):
+        if merged and first <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def overlay(
+    raw_path: str | Path,
+    base_raw_path: str | Path,
+    path: str | Path,
+    backing_file: str,
+    compress: bool = False,
+) -> int:
+    """Write a raw disk image as a qcow2 overlay of a base image.
+
+    Only the clusters which differ from the base are stored, everything
+    else is read from the backing file by the hypervisor.
+
+    Args:
+        raw_path: the raw disk image to write
+        base_raw_path: the raw contents of the backing image
+        path: the qcow2 overlay to create
+        backing_file: name of the backing qcow2 image recorded in the
+                      overlay, relative names are taken from its directory
+        compress: store the clusters deflate compressed
+
+    Returns:
+        int: the number of clusters stored in the overlay
+    """
+    with open(raw_path, "rb") as image, open(base_raw_path, "rb") as base:
+        fd = image.fileno()
+        base_fd = base.fileno()
+        size = os.fstat(fd).st_size
+        if os.fstat(base_fd).st_size != size:
+            raise ValueError(f"{raw_path} and {base_raw_path} differ in size")
+
+        # holes in both images read the same, only data regions are compared
+        segments = [
+            *sparse.data_segments(fd, size),
+            *sparse.data_segments(base_fd, size),
+        ]
+        stored = 0
+        with Qcow2Writer(
+            path, size, compress, backing_file=backing_file, backing_format="qcow2"
+        ) as dst:
+            for first, last in _cluster_ranges(segments):
+                for index in range(first, last):
+                    offset = index * CLUSTER_SIZE
+                    data = os.pread(fd, CLUSTER_SIZE, offset)
+                    if data == os.pread(base_fd, CLUSTER_SIZE, offset):
+                        continue
+                    dst.seek(offset)
+                    dst.write(data)
+                    stored += 1
+    return stored
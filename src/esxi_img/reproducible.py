@@ -0,0 +1,62 @@
+"""Timestamps and identifiers for reproducible images.
+
+Following the SOURCE_DATE_EPOCH convention, when a fixed time is given
+everything a build would otherwise take from the clock or from random
+numbers is fixed: the tar and gzip headers of the installer helper, the
+timestamps and volume ID of the FAT filesystem and the GUIDs of the GPT.
+The same inputs then produce byte-identical raw and qcow2 images.
+
+The identifiers are derived from the time and the build inputs so
+different images still get different GUIDs.
+"""
+
+import hashlib
+import os
+import uuid
+from dataclasses import dataclass
+
+ENV_VAR = "SOURCE_DATE_EPOCH"
+
+
+def source_date_epoch(value: int | str | None = None) -> int | None:
+    """The fixed build time, from value or else the environment.
+
+    Raises:
+        ValueError: If the time isn't a non-negative integer
+    """
+    if value is None:
+        value = os.environ.get(ENV_VAR) or None
+        if value is None:
+            return None
+    try:
+        epoch = int(value)
+    except ValueError:
+        raise ValueError(f"{ENV_VAR} must be an integer, not {value!r}") from None
+    if epoch < 0:
+        raise ValueError(f"{ENV_VAR} must not be negative")
+    return epoch
+
+
+@dataclass(frozen=True)
+class Identity:
+    """The time and identifiers a build stamps into an image."""
+
+    timestamp: int
+    volume_id: int
+    disk_guid: uuid.UUID
+    part_guid: uuid.UUID
+
+    @classmethod
+    def derive(cls, epoch: int, *inputs: bytes | str | int) -> "Identity":
+        """Derive the identifiers from the build time and its inputs."""
+        seed = hashlib.sha256(str(epoch).encode())
+        for value in inputs:
+            data = value if isinstance(value, bytes) else str(value).encode()
+            seed.update(len(data).to_bytes(8, "little") + data)
+        digest = seed.digest()
+        return cls(
+            timestamp=epoch,
+            volume_id=int.from_bytes(digest[:4], "little"),
+            disk_guid=uuid.UUID(bytes=digest[4:20], version=4),
+            part_guid=uuid.UUID(bytes=hashlib.sha256(digest).digest()[:16], version=4),
+        )
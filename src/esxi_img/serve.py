@@ -0,0 +1,374 @@
+r"""A local build service which keeps its caches warm between builds.
+
+``esxi-img serve`` listens on a UNIX socket for build jobs, queues them
+and runs at most --workers of them at once on long-lived worker
+processes. Across jobs the service keeps:
+
+- the worker processes with everything imported,
+- the extracted ISOs, their digests and indexes in the ISO cache,
+- the indexes of the ISOs in the memory of every worker process,
+- the installer helpers, generated once per kickstart template.
+
+Jobs aren't authenticated: whoever can connect can have the service read
+and write any file it can. The socket is only accessible to the user and
+group of the service. With --listen the service listens on a localhost
+TCP port instead, where every local user and process can submit jobs.
+
+Jobs take the options of a build in a ``gen-img-batch`` manifest, as
+JSON. Relative paths are taken relative to the directory the service
+was started in::
+
+    curl --unix-socket $XDG_RUNTIME_DIR/esxi-img.sock http://localhost/jobs \
+        -d '{"iso": "/srv/esxi.iso", "output": "/srv/esxi.qcow2"}'
+
+The service speaks HTTP:
+
+    POST /jobs       queue a build, replies with the job
+    GET  /jobs       list the jobs
+    GET  /jobs/<id>  a job with its state: queued, running, succeeded or
+                     failed
+"""
+
+import functools
+import http.server
+import importlib.resources
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import esxi_netinit
+
+import esxi_img
+from esxi_img import batch
+from esxi_img import cache
+from esxi_img import checksums
+from esxi_img import cmd
+from esxi_img import reproducible
+
+logger = logging.getLogger(__name__)
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+# finished jobs remembered for their clients
+MAX_FINISHED_JOBS = 1000
+MAX_REQUEST_SIZE = 1024 * 1024
+SOCKET_NAME = "esxi-img.sock"
+
+
+def default_socket_path(cache_dir: Path) -> Path:
+    """The socket in the user's runtime directory, or else the cache."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    return Path(runtime_dir or cache_dir) / SOCKET_NAME
+
+
+@functools.cache
+def _packaged_digests() -> dict:
+    # the packaged sources can't change under a running worker
+    return {
+        "data": checksums.resources_digest(
+            importlib.resources.files(esxi_img).joinpath("data")
+        ),
+        "netinit": checksums.resources_digest(importlib.resources.files(esxi_netinit)),
+    }
+
+
+def warm_helper(helpers_dir: Path, ks_template: str | None) -> Path:
+    """The installer helper for a kickstart template, generated once.
+
+    Helpers are kept in helpers_dir by a digest of everything they are
+    generated from, so an edited template gets a new helper.
+    """
+    epoch = reproducible.source_date_epoch()
+    key = checksums.fingerprint(
+        {
+            **_packaged_digests(),
+            "kickstart": cache.file_digest(ks_template) if ks_template else None,
+            "source_date_epoch": epoch,
+        }
+    )
+    path = helpers_dir / f"{key}.tgz"
+    if not path.exists():
+        tmp = helpers_dir / f"{key}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            if cmd.generate_installer_helper(ks_template, tmp, epoch) != 0:
+                raise RuntimeError(f"failed to generate installer helper {path}")
+            tmp.replace(path)
+        finally:
+            tmp.unlink(missing_ok=True)
+    return path
+
+
+def _run(
+    spec: batch.BuildSpec, helpers_dir: Path, cache_dir: str, cache_max_size: int
+) -> int:
+    """Run a build on a worker process."""
+    helper = spec.esxiimg or str(warm_helper(helpers_dir, spec.ks_template))
+    return cmd.generate_image(
+        spec.iso,
+        spec.outputs,
+        spec.formats,
+        spec.options(
+            esxiimg_path=helper,
+            cache_dir=cache_dir,
+            cache_max_size=cache_max_size,
+        ),
+    )
+
+
+@dataclass
+class Job:
+    id: int
+    spec: batch.BuildSpec
+    state: str = "queued"
+    submitted: float = 0.0
+    started: float | None = None
+    finished: float | None = None
+    error: str | None = None
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.spec.name,
+            "state": self.state,
+            "outputs": self.spec.outputs,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+        }
+
+
+class BuildService:
+    """Queue builds and run a limited number of them at once.
+
+    Args:
+        cache_dir: the ISO cache, installer helpers are kept below it too
+        cache_max_size: size in bytes the ISO cache is trimmed down to
+        workers: number of builds to run at once, defaults to the CPU count
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        cache_max_size: int = cache.DEFAULT_MAX_SIZE,
+        workers: int | None = None,
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_max_size = cache_max_size
+        self.helpers_dir = self.cache_dir / "helpers"
+        self.helpers_dir.mkdir(parents=True, exist_ok=True)
+        workers = max(1, workers or os.cpu_count() or 1)
+        self._processes = ProcessPoolExecutor(max_workers=workers)
+        # one thread per worker process waits for the job it runs, so a
+        # job is only handed to the processes once one of them is free
+        self._scheduler = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="job"
+        )
+        self._jobs: dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, spec: batch.BuildSpec) -> Job:
+        with self._lock:
+            job = Job(next(self._ids), spec, submitted=time.time())
+            self._jobs[job.id] = job
+            self._forget_finished()
+        logger.info("Queued job %d (%s)", job.id, spec.name)
+        self._scheduler.submit(self._execute, job)
+        return job
+
+    def _execute(self, job: Job) -> None:
+        job.state = "running"
+        job.started = time.time()
+        logger.info("Running job %d (%s)", job.id, job.spec.name)
+        try:
+            rc = self._processes.submit(
+                _run,
+                job.spec,
+                self.helpers_dir,
+                str(self.cache_dir),
+                self.cache_max_size,
+            ).result()
+            if rc != 0:
+                job.error = f"gen-img exited with {rc}"
+        except Exception as e:
+            job.error = str(e)
+        job.finished = time.time()
+        job.state = "failed" if job.error else "succeeded"
+        logger.info(
+            "Job %d (%s) %s after %.1fs",
+            job.id,
+            job.spec.name,
+            job.state,
+            job.finished - job.started,
+        )
+
+    def _forget_finished(self) -> None:
+        finished = [job.id for job in self._jobs.values() if job.finished]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: int) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def shutdown(self) -> None:
+        """Let the running jobs finish and drop the queued ones."""
+        self._scheduler.shutdown(wait=True, cancel_futures=True)
+        self._processes.shutdown(wait=True)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = f"esxi-img/{esxi_img.__version__}"
+
+    @property
+    def service(self) -> BuildService:
+        return self.server.service
+
+    def address_string(self) -> str:
+        # clients of a UNIX socket have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _reply(self, status: int, body: dict | list) -> None:
+        data = json.dumps(body, indent=2).encode() + b"\n"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/jobs":
+            self._reply(200, [job.as_dict() for job in self.service.jobs()])
+            return
+        prefix, _sep, job_id = self.path.rpartition("/")
+        job = None
+        if prefix == "/jobs" and job_id.isdigit():
+            job = self.service.get(int(job_id))
+        if job is None:
+            self._reply(404, {"error": f"no such job {self.path}"})
+            return
+        self._reply(200, job.as_dict())
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": f"can't post to {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_REQUEST_SIZE:
+                raise ValueError("job is too large")
+            options = json.loads(self.rfile.read(length))
+            if not isinstance(options, dict):
+                raise ValueError("a job is a JSON object")
+            spec = batch.build_spec(options, Path.cwd(), "job")
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        self._reply(202, self.service.submit(spec).as_dict())
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _unix_server(path: Path) -> _UnixHTTPServer:
+    if path.is_socket():
+        with socket.socket(socket.AF_UNIX) as probe:
+            try:
+                probe.connect(str(path))
+            except OSError:
+                # left behind by a service which didn't shut down
+                path.unlink()
+            else:
+                raise ValueError(f"another service is listening on {path}")
+    server = _UnixHTTPServer(str(path), _Handler)
+    os.chmod(path, 0o660)
+    return server
+
+
+def _tcp_server(listen: str) -> http.server.ThreadingHTTPServer:
+    host, _sep, port = listen.rpartition(":")
+    host = host.strip("[]") or "localhost"
+    if host not in LOCAL_HOSTS:
+        raise ValueError(f"only listening on localhost is supported, not {host}")
+    server_class = http.server.ThreadingHTTPServer
+    if ":" in host:
+        server_class = type(
+            "_IPv6HTTPServer", (server_class,), {"address_family": socket.AF_INET6}
+        )
+    return server_class((host, int(port)), _Handler)
+
+
+def serve(
+    socket_path: str | None = None,
+    listen: str | None = None,
+    workers: int | None = None,
+    cache_dir: str | None = None,
+    cache_max_size: int = cache.DEFAULT_MAX_SIZE,
+) -> int:
+    """Run the build service until interrupted or terminated.
+
+    Args:
+        socket_path: UNIX socket to listen on, defaults to esxi-img.sock in
+                     the user's runtime directory or else in cache_dir
+        listen: [HOST:]PORT on localhost to listen on instead, anyone on
+                the host can submit jobs there
+        workers: number of builds to run at once
+        cache_dir: ISO and installer helper cache, defaults to the user's
+        cache_max_size: size in bytes the ISO cache is trimmed down to
+
+    Returns:
+        int: Exit code (0 for success, non-zero for failure)
+    """
+    cache_path = Path(cache_dir) if cache_dir else cache.default_cache_dir()
+    if not listen and not socket_path:
+        socket_path = str(default_socket_path(cache_path))
+    try:
+        if listen:
+            server = _tcp_server(listen)
+        else:
+            Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+            server = _unix_server(Path(socket_path))
+    except (OSError, ValueError) as e:
+        logger.error("Can't listen for jobs: %s", e)
+        return 1
+    if listen:
+        logger.warning(
+            "Jobs on %s aren't authenticated, any local user can submit them",
+            listen,
+        )
+
+    service = BuildService(cache_path, cache_max_size, workers)
+    server.service = service
+
+    def _terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _terminate)
+    logger.info("Listening for jobs on %s", socket_path or server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down, waiting for running jobs")
+    finally:
+        server.server_close()
+        if not listen:
+            Path(socket_path).unlink(missing_ok=True)
+        service.shutdown()
+    return 0
@@ -0,0 +1,138 @@
+"""Work out how big the disk image has to be for a set of files."""
+
+import math
+import re
+from dataclasses import asdict
+from dataclasses import dataclass
+
+from esxi_img import fat32
+from esxi_img import gpt
+from esxi_img.fat32 import Fat32Builder
+
+MiB = 1024 * 1024
+
+_UNITS = {"": MiB, "K": 1024, "M": MiB, "G": 1024 * MiB}
+
+
+@dataclass(frozen=True)
+class Slack:
+    """Free space to leave in the ESP on top of the minimum.
+
+    Either an absolute number of bytes or a percentage of the minimal
+    partition size.
+    """
+
+    absolute: int = 0
+    percent: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Slack":
+        """Parse "10%" or a size such as "64M", plain numbers are MiB."""
+        spec = spec.strip()
+        if spec.endswith("%"):
+            return cls(percent=float(spec[:-1]))
+        match = re.fullmatch(r"(\d+)\s*([KMG]?)(?:i?B)?", spec, re.IGNORECASE)
+        if not match:
+            raise ValueError(f"invalid slack: {spec}")
+        return cls(absolute=int(match.group(1)) * _UNITS[match.group(2).upper()])
+
+    def bytes_for(self, size: int) -> int:
+        return self.absolute + math.ceil(size * self.percent / 100)
+
+
+DEFAULT_SLACK = "10%"
+
+
+@dataclass(frozen=True)
+class EspSize:
+    """Breakdown of the disk image size."""
+
+    # bytes of file content
+    data_bytes: int
+    sectors_per_cluster: int
+    # clusters used by files and directories
+    used_clusters: int
+    # file content rounded up to whole clusters plus directories
+    cluster_bytes: int
+    reserved_bytes: int
+    fat_bytes: int
+    # smallest partition that holds everything
+    min_partition_bytes: int
+    slack_bytes: int
+    partition_bytes: int
+    # partition alignment, GPT and its backup
+    gpt_bytes: int
+    disk_size: int
+
+    @property
+    def cluster_size(self) -> int:
+        return self.sectors_per_cluster * fat32.SECTOR_SIZE
+
+    @property
+    def size_mb(self) -> int:
+        return self.disk_size // MiB
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def _min_volume_sectors(clusters: int, sectors_per_cluster: int) -> int:
+    clusters = max(clusters, fat32.MIN_CLUSTERS)
+    fat_size = math.ceil((clusters + 2) * 4 / fat32.SECTOR_SIZE)
+    return (
+        fat32.RESERVED_SECTORS
+        + fat32.NUM_FATS * fat_size
+        + clusters * sectors_per_cluster
+    )
+
+
+def _pick_cluster_sectors(fs: Fat32Builder) -> int:
+    """Settle on the cluster size the Microsoft defaults give the volume."""
+    spc = fat32.cluster_sectors(fs.data_size() // fat32.SECTOR_SIZE)
+    # the cluster size changes how much space is needed which can in turn
+    # change the cluster size, give up flip flopping after a few rounds
+    for _ in range(4):
+        needed = fs.clusters_needed(spc * fat32.SECTOR_SIZE)
+        next_spc = fat32.cluster_sectors(_min_volume_sectors(needed, spc))
+        if next_spc == spc:
+            break
+        spc = next_spc
+    return spc
+
+
+def compute(fs: Fat32Builder, slack: Slack | None = None) -> EspSize:
+    """Compute the disk image size needed for the files in fs.
+
+    Args:
+        fs: the filesystem with all of its files added
+        slack: free space to add to the minimal partition size
+
+    Returns:
+        EspSize: the breakdown, the disk size is rounded up to a whole MiB
+    """
+    slack = slack or Slack()
+    spc = _pick_cluster_sectors(fs)
+    used = fs.clusters_needed(spc * fat32.SECTOR_SIZE)
+    min_sectors = _min_volume_sectors(used, spc)
+    min_bytes = min_sectors * fat32.SECTOR_SIZE
+    slack_bytes = slack.bytes_for(min_bytes)
+
+    gpt_sectors = gpt.PARTITION_ALIGNMENT + gpt.ENTRIES_SECTORS + 1
+    wanted = min_bytes + slack_bytes + gpt_sectors * gpt.SECTOR_SIZE
+    disk_size = math.ceil(wanted / MiB) * MiB
+
+    partition_sectors = disk_size // gpt.SECTOR_SIZE - gpt_sectors
+    geometry = fat32.Geometry.for_volume(partition_sectors, spc)
+    return EspSize(
+        data_bytes=fs.data_size(),
+        sectors_per_cluster=spc,
+        used_clusters=used,
+        cluster_bytes=used * spc * fat32.SECTOR_SIZE,
+        reserved_bytes=fat32.RESERVED_SECTORS * fat32.SECTOR_SIZE,
+        fat_bytes=fat32.NUM_FATS * geometry.fat_sectors * fat32.SECTOR_SIZE,
+        min_partition_bytes=min_bytes,
+        slack_bytes=partition_sectors * gpt.SECTOR_SIZE - min_bytes,
+        partition_bytes=partition_sectors * gpt.SECTOR_SIZE,
+        gpt_bytes=gpt_sectors * gpt.SECTOR_SIZE,
+        disk_size=disk_size,
+    )
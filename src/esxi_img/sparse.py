@@ -0,0 +1,157 @@
+"""Keep disk images sparse while they are built, moved and converted."""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+from pathlib import Path
+
+BLOCK_SIZE = 64 * 1024
+COPY_BUFSIZE = 1024 * 1024
+
+# fallocate(2) mode to deallocate a range without changing the file size
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+# ioctl to share the extents of one file with another on btrfs/xfs
+FICLONE = 0x40049409
+
+_libc = None
+
+
+def libc_fallocate():
+    """The C library's fallocate(2), None when there is none."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    func = getattr(_libc, "fallocate", None)
+    if func is not None:
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return func
+
+
+def allocated_size(path: str | Path) -> int:
+    """Bytes actually allocated on disk for a file."""
+    return os.stat(path).st_blocks * 512
+
+
+def apparent_size(path: str | Path) -> int:
+    return os.stat(path).st_size
+
+
+def data_segments(fd: int, size: int):
+    """Yield (offset, length) of the data regions of a file.
+
+    Falls back to a single segment covering the file when the filesystem
+    can't report holes.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole remains
+                return
+            if e.errno == errno.EINVAL:
+                yield offset, size - offset
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+def _is_zero(chunk: bytes) -> bool:
+    return not chunk.strip(b"\x00")
+
+
+def punch_zero_holes(path: str | Path) -> int:
+    """Deallocate blocks of the file that only contain zeros.
+
+    Returns:
+        int: the number of bytes deallocated, 0 when the platform or
+        filesystem does not support punching holes
+    """
+    fallocate = libc_fallocate()
+    if fallocate is None:
+        return 0
+
+    punched = 0
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        for start, length in list(data_segments(fd, size)):
+            # only whole aligned blocks can be deallocated
+            offset = start - start % BLOCK_SIZE
+            end = start + length
+            while offset < end:
+                chunk = os.pread(fd, BLOCK_SIZE, offset)
+                if chunk and _is_zero(chunk):
+                    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+                    if fallocate(fd, mode, offset, len(chunk)) != 0:
+                        err = ctypes.get_errno()
+                        if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+                            return punched
+                        raise OSError(err, os.strerror(err), str(path))
+                    punched += len(chunk)
+                offset += BLOCK_SIZE
+    finally:
+        os.close(fd)
+    return punched
+
+
+def _write_nonzero(fd: int, chunk: bytes, offset: int) -> None:
+    """Write the blocks of chunk which are not entirely zeros."""
+    run_start = None
+    for pos in range(0, len(chunk) + BLOCK_SIZE, BLOCK_SIZE):
+        block = chunk[pos : pos + BLOCK_SIZE]
+        if block and not _is_zero(block):
+            if run_start is None:
+                run_start = pos
+        elif run_start is not None:
+            os.pwrite(fd, chunk[run_start:pos], offset + run_start)
+            run_start = None
+
+
+def copy(src: str | Path, dst: str | Path) -> None:
+    """Copy a file reading only its data regions and never writing zeros."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        in_fd = fsrc.fileno()
+        out_fd = fdst.fileno()
+        size = os.fstat(in_fd).st_size
+        for start, length in data_segments(in_fd, size):
+            offset = start
+            end = start + length
+            while offset < end:
+                chunk = os.pread(in_fd, min(COPY_BUFSIZE, end - offset), offset)
+                if not chunk:
+                    break
+                _write_nonzero(out_fd, chunk, offset)
+                offset += len(chunk)
+        fdst.truncate(size)
+    shutil.copymode(src, dst)
+
+
+def clone(src: str | Path, dst: str | Path) -> None:
+    """Make a copy-on-write clone of a file, copying sparsely if unsupported."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copymode(src, dst)
+            return
+        except OSError:
+            pass
+    copy(src, dst)
+
+
+def move(src: str | Path, dst: str | Path) -> None:
+    """Rename a file, copying it sparsely when crossing filesystems."""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy(src, dst)
+        os.unlink(src)
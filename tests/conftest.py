@@ -0,0 +1,87 @@
+import io
+import struct
+import zlib
+from pathlib import Path
+
+import pycdlib
+import pytest
+
+BOOT_CFG = """bootstate=0
+title=Loading ESXi installer
+kernel=/b.b00
+kernelopt=runweasel cdromBoot
+modules=/jumpstrt.gz --- /useropts.gz --- /s.v00
+"""
+
+
+def _add(iso: pycdlib.PyCdlib, iso_path: str, data: bytes) -> None:
+    iso.add_fp(io.BytesIO(data), len(data), iso_path)
+
+
+@pytest.fixture(scope="session")
+def esxi_iso(tmp_path_factory) -> Path:
+    """A tiny ISO laid out like the ESXi installer media."""
+    path = tmp_path_factory.mktemp("iso") / "esxi.iso"
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=3)
+    iso.add_directory("/EFI")
+    iso.add_directory("/EFI/BOOT")
+    _add(iso, "/BOOT.CFG;1", BOOT_CFG.encode())
+    _add(iso, "/EFI/BOOT/BOOT.CFG;1", BOOT_CFG.encode())
+    _add(iso, "/EFI/BOOT/BOOTX64.EFI;1", b"\x4d\x5a" + bytes(4094))
+    _add(iso, "/B.B00;1", bytes(range(256)) * 300)
+    _add(iso, "/JUMPSTRT.GZ;1", b"jumpstrt" * 10)
+    _add(iso, "/USEROPTS.GZ;1", b"")
+    _add(iso, "/S.V00;1", bytes(range(255, -1, -1)) * 9000)
+    iso.write(str(path))
+    iso.close()
+    return path
+
+
+def _read_qcow2(path: Path) -> bytes:
+    """Read back the guest contents of a qcow2 image and its backing files."""
+    with path.open("rb") as f:
+        header = f.read(104)
+        assert header[:4] == b"QFI\xfb"
+        cluster_bits = struct.unpack_from(">I", header, 20)[0]
+        size = struct.unpack_from(">Q", header, 24)[0]
+        l1_size, l1_offset = struct.unpack_from(">IQ", header, 36)
+        cluster_size = 1 << cluster_bits
+        l2_entries = cluster_size // 8
+        csize_shift = 62 - (cluster_bits - 8)
+        backing_offset, backing_size = struct.unpack_from(">QI", header, 8)
+        if backing_offset:
+            f.seek(backing_offset)
+            backing = path.parent / f.read(backing_size).decode()
+            out = bytearray(_read_qcow2(backing))
+        else:
+            out = bytearray(size)
+
+        f.seek(l1_offset)
+        l1 = struct.unpack(f">{l1_size}Q", f.read(l1_size * 8))
+        for l1_index, l2_offset in enumerate(l1):
+            l2_offset &= 0x00FFFFFFFFFFFE00
+            if not l2_offset:
+                continue
+            f.seek(l2_offset)
+            l2 = struct.unpack(f">{l2_entries}Q", f.read(cluster_size))
+            for l2_index, entry in enumerate(l2):
+                guest = (l1_index * l2_entries + l2_index) * cluster_size
+                if entry & (1 << 62):
+                    offset = entry & ((1 << csize_shift) - 1)
+                    sectors = (entry >> csize_shift) & ((1 << (cluster_bits - 8)) - 1)
+                    f.seek(offset)
+                    raw = f.read((offset & ~511) + (sectors + 1) * 512 - offset)
+                    data = zlib.decompressobj(-12).decompress(raw, cluster_size)
+                elif entry & 0x00FFFFFFFFFFFE00:
+                    f.seek(entry & 0x00FFFFFFFFFFFE00)
+                    data = f.read(cluster_size)
+                else:
+                    continue
+                out[guest : guest + cluster_size] = data[: size - guest]
+        return bytes(out)
+
+
+@pytest.fixture
+def read_qcow2():
+    return _read_qcow2
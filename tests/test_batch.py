@@ -0,0 +1,111 @@
+import json
+import tarfile
+
+import pytest
+
+from esxi_img import batch
+
+
+def test_load_manifest_toml(tmp_path):
+    """Defaults apply to every build and paths are relative to the manifest."""
+    manifest = tmp_path / "builds.toml"
+    manifest.write_text(
+        """
+[defaults]
+iso = "esxi.iso"
+format = "qcow2"
+
+[[build]]
+name = "plain"
+output = "out/plain.qcow2"
+
+[[build]]
+output = ["out/dell.img", "out/dell.qcow2"]
+format = ["raw", "qcow2"]
+ks_template = "dell.cfg"
+compress = true
+"""
+    )
+
+    plain, dell = batch.load_manifest(manifest)
+
+    assert plain.name == "plain"
+    assert plain.iso == str(tmp_path / "esxi.iso")
+    assert plain.outputs == [str(tmp_path / "out" / "plain.qcow2")]
+    assert plain.formats == ["qcow2"]
+    assert plain.ks_template is None
+    assert dell.name == "dell"
+    assert dell.formats == ["raw", "qcow2"]
+    assert dell.ks_template == str(tmp_path / "dell.cfg")
+    assert dell.compress
+
+
+@pytest.mark.parametrize(
+    "manifest",
+    [
+        {},
+        {"build": [{"iso": "a.iso"}]},
+        {"build": [{"iso": "a.iso", "output": "a.img", "colour": "red"}]},
+        {"build": [{"iso": "a.iso", "output": "a.img", "format": "iso"}]},
+        {
+            "build": [
+                {"iso": "a.iso", "output": "x/a.img"},
+                {"iso": "b.iso", "output": "y/a.img"},
+            ]
+        },
+    ],
+)
+def test_load_manifest_invalid(tmp_path, manifest):
+    path = tmp_path / "builds.json"
+    path.write_text(json.dumps(manifest))
+
+    with pytest.raises(ValueError):
+        batch.load_manifest(path)
+
+
+def test_run_batch(esxi_iso, tmp_path):
+    """Builds sharing an ISO and kickstart share the prepared inputs."""
+    manifest = tmp_path / "builds.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "defaults": {"iso": str(esxi_iso)},
+                "build": [
+                    {"name": "one", "output": "one.img"},
+                    {"name": "two", "output": "two.qcow2", "format": "qcow2"},
+                    {"name": "bad", "output": "bad.img", "iso": "missing.iso"},
+                ],
+            }
+        )
+    )
+
+    results = batch.run_batch(batch.load_manifest(manifest), workers=2)
+
+    assert [(result.name, result.ok) for result in results] == [
+        ("one", True),
+        ("two", True),
+        ("bad", False),
+    ]
+    assert (tmp_path / "one.img").exists()
+    assert (tmp_path / "two.qcow2").exists()
+    assert not (tmp_path / "bad.img").exists()
+
+    summary = batch.format_summary(results)
+    assert "FAILED" in summary.splitlines()[3]
+    assert json.loads(batch.summary_json(results))[0]["name"] == "one"
+
+
+def test_run_batch_helper(esxi_iso, tmp_path):
+    """A prebuilt installer helper is used as is."""
+    helper = tmp_path / "helper.tgz"
+    with tarfile.open(helper, "w:gz"):
+        pass
+    spec = batch.BuildSpec(
+        "one", str(esxi_iso), [str(tmp_path / "one.img")], ["raw"], esxiimg=str(helper)
+    )
+
+    (result,) = batch.run_batch([spec], cache_dir=str(tmp_path / "cache"))
+
+    assert result.ok
+    # the extracted ISO is kept in the given cache
+    assert list((tmp_path / "cache" / "isos").glob("*/tree"))
@@ -0,0 +1,31 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+BENCH = Path(__file__).parents[1] / "benchmarks" / "bench.py"
+
+
+def test_bench_tiny(tmp_path):
+    """The benchmark runs every stage against a tiny ISO."""
+    results = tmp_path / "results.json"
+
+    subprocess.run(  # noqa: S603
+        [
+            sys.executable,
+            str(BENCH),
+            "--scale",
+            "tiny",
+            "--repeat",
+            "1",
+            "--baseline",
+            str(tmp_path / "baseline.json"),
+            "--json",
+            str(results),
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+    stages = json.loads(results.read_text())["results"]["tiny"]["stages"]
+    assert {"extract_iso", "create_disk_img", "stream_disk_img"} <= stages.keys()
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from dataclasses import replace
+
+from esxi_img import cache
+from esxi_img import isoindex
+from esxi_img.cmd import update_esxi_config
+
+
+def _extractor(calls: list, content: bytes):
+    def extract(tree):
+        calls.append(tree)
+        (tree / "EFI").mkdir()
+        (tree / "BOOT.CFG").write_bytes(b"modules=/b.b00\n")
+        (tree / "EFI" / "S.V00").write_bytes(content)
+
+    return extract
+
+
+def test_cache_hit(tmp_path):
+    """The ISO is only extracted the first time it is seen."""
+    iso = tmp_path / "esxi.iso"
+    iso.write_bytes(b"iso")
+    iso_cache = cache.IsoCache(tmp_path / "cache")
+    calls = []
+
+    for _ in range(2):
+        with iso_cache.tree(iso, _extractor(calls, b"payload")) as tree:
+            assert (tree / "EFI" / "S.V00").read_bytes() == b"payload"
+
+    assert len(calls) == 1
+    assert [entry[0] for entry in iso_cache.entries()] == [cache.file_digest(iso)]
+
+
+def test_materialize_links(tmp_path):
+    """Materialized trees share data with the cache but never modify it."""
+    iso = tmp_path / "esxi.iso"
+    iso.write_bytes(b"iso")
+    iso_cache = cache.IsoCache(tmp_path / "cache")
+    dest = tmp_path / "dest"
+
+    with iso_cache.tree(iso, _extractor([], b"payload")) as tree:
+        cache.materialize(tree, dest)
+        assert (dest / "EFI" / "S.V00").stat().st_ino == (
+            (tree / "EFI" / "S.V00").stat().st_ino
+        )
+        update_esxi_config(dest / "BOOT.CFG")
+        assert (tree / "BOOT.CFG").read_bytes() == b"modules=/b.b00\n"
+        assert b"esxiimg.tgz" in (dest / "BOOT.CFG").read_bytes()
+
+
+def test_evict_lru(tmp_path):
+    """The least recently used ISOs are dropped to stay under the cap."""
+    # each extracted tree takes up 65 bytes
+    iso_cache = cache.IsoCache(tmp_path / "cache", max_size=200)
+    isos = []
+    for n in range(4):
+        iso = tmp_path / f"{n}.iso"
+        iso.write_bytes(str(n).encode())
+        isos.append(iso)
+
+    for iso in isos[:3]:
+        with iso_cache.tree(iso, _extractor([], bytes(50))):
+            pass
+    assert len(iso_cache.entries()) == 3
+
+    # use the first one again so the second is the least recently used
+    with iso_cache.tree(isos[0], _extractor([], bytes(50))):
+        pass
+    with iso_cache.tree(isos[3], _extractor([], bytes(50))):
+        pass
+
+    cached = {entry[0] for entry in iso_cache.entries()}
+    assert cached == {cache.file_digest(isos[n]) for n in (0, 2, 3)}
+
+
+def test_index_persisted(esxi_iso, tmp_path, monkeypatch):
+    """An ISO is only indexed the first time it is seen."""
+    index = cache.IsoCache(tmp_path / "cache").index(esxi_iso)
+
+    def fail(*args):
+        raise AssertionError("indexed again")
+
+    monkeypatch.setattr(isoindex.IsoIndex, "from_iso", fail)
+    # a new process only has the index on disk
+    monkeypatch.setattr(cache, "_indexes", OrderedDict())
+    assert cache.IsoCache(tmp_path / "cache").index(esxi_iso) == index
+    assert index.sha256 == cache.file_digest(esxi_iso)
+
+
+def test_index_in_memory(esxi_iso, tmp_path, monkeypatch):
+    """A process reads the index of an ISO from the cache only once."""
+    monkeypatch.setattr(cache, "_indexes", OrderedDict())
+    monkeypatch.setattr(cache, "MEMORY_INDEXES", 1)
+    index = cache.IsoCache(tmp_path / "cache").index(esxi_iso)
+
+    def fail(*args):
+        raise AssertionError("read again")
+
+    monkeypatch.setattr(isoindex.IsoIndex, "from_json", fail)
+    assert cache.IsoCache(tmp_path / "cache").index(esxi_iso) is index
+
+    other = replace(index, sha256="0" * 64)
+    cache._keep_index(other)
+    assert list(cache._indexes.values()) == [other]
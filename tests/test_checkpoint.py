@@ -0,0 +1,102 @@
+import hashlib
+import os
+
+import pytest
+
+from esxi_img import checkpoint
+
+
+def test_work_dir_resume(tmp_path):
+    root = tmp_path / "work"
+    work = checkpoint.WorkDir(root, "build")
+    assert work.done("helper") is None
+    (root / "ESXIIMG.TGZ").write_bytes(b"helper")
+    work.complete("helper", [root / "ESXIIMG.TGZ"])
+    (root / "disk.raw").write_bytes(b"image")
+    work.complete("image", [root / "disk.raw"], {"size": 5})
+    work.close()
+
+    work = checkpoint.WorkDir(root, "build")
+    assert work.done("helper") == {}
+    assert work.done("image") == {"size": 5}
+    work.close()
+
+
+def test_work_dir_changed(tmp_path):
+    """A stage whose outputs changed runs again along with its dependents."""
+    root = tmp_path / "work"
+    work = checkpoint.WorkDir(root, "build")
+    (root / "tree").mkdir()
+    (root / "tree" / "BOOT.CFG").write_text("kernel=/b.b00\n")
+    work.complete("extract", [root / "tree"])
+    work.complete("helper", [])
+    work.complete("image", [])
+    work.complete("convert", [])
+
+    (root / "tree" / "BOOT.CFG").write_text("kernel=/b.b01\n")
+
+    assert work.done("extract") is None
+    assert work.done("image") is None
+    assert work.done("convert") is None
+    assert work.done("helper") == {}
+    work.close()
+
+
+def test_work_dir_known_digests(tmp_path, monkeypatch):
+    """Outputs hashed by their stage or stamped aren't read to record them."""
+    root = tmp_path / "work"
+    work = checkpoint.WorkDir(root, "build")
+    (root / "disk.raw").write_bytes(b"image")
+    (root / "out.img").write_bytes(b"image")
+
+    def fail(path):
+        raise AssertionError(f"{path} hashed again")
+
+    monkeypatch.setattr(checkpoint, "_digest", fail)
+    work.complete("image", [root / "disk.raw"], stamp=True)
+    work.complete(
+        "convert",
+        [root / "out.img"],
+        digests={root / "out.img": hashlib.sha256(b"image").hexdigest()},
+    )
+    assert work.done("image") == {}
+    monkeypatch.undo()
+    assert work.done("convert") == {}
+
+    os.utime(root / "disk.raw", ns=(0, 0))
+    assert work.done("image") is None
+    assert work.done("convert") is None
+    work.close()
+
+
+def test_work_dir_other_build(tmp_path):
+    root = tmp_path / "work"
+    work = checkpoint.WorkDir(root, "build")
+    (root / "disk.raw").write_bytes(b"image")
+    work.complete("image", [root / "disk.raw"])
+    work.close()
+
+    work = checkpoint.WorkDir(root, "other")
+    assert work.done("image") is None
+    assert not (root / "disk.raw").exists()
+    work.close()
+
+
+def test_work_dir_in_use(tmp_path):
+    work = checkpoint.WorkDir(tmp_path, "build")
+    with pytest.raises(BlockingIOError):
+        checkpoint.WorkDir(tmp_path, "build")
+    work.close()
+
+
+def test_work_dir_not_empty(tmp_path):
+    (tmp_path / "precious").write_text("data")
+    with pytest.raises(ValueError, match="not a work directory"):
+        checkpoint.WorkDir(tmp_path, "build")
+
+
+def test_scratch_dir(tmp_path):
+    work = checkpoint.WorkDir(tmp_path)
+    work.complete("image", [])
+    assert work.done("image") is None
+    assert not any(tmp_path.iterdir())
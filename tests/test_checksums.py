@@ -0,0 +1,90 @@
+import gzip
+import hashlib
+import json
+import os
+
+from esxi_img import checksums
+
+MiB = 1024 * 1024
+
+
+def test_file_checksums(tmp_path):
+    """Holes hash as the zeros they read as."""
+    path = tmp_path / "disk.img"
+    with path.open("wb") as f:
+        f.truncate(20 * MiB)
+        f.seek(5 * MiB + 123)
+        f.write(b"esxi" * 300_000)
+    data = path.read_bytes()
+
+    assert checksums.file_checksums(path) == {
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "md5": hashlib.md5(data).hexdigest(),  # noqa: S324
+    }
+
+
+def test_ordered_hasher(tmp_path):
+    """Data fed in order isn't read again, anything else still is."""
+    path = tmp_path / "esxi.iso"
+    data = os.urandom(10_000)
+    path.write_bytes(data)
+
+    hasher = checksums.OrderedHasher(path)
+    hasher.feed(100, data[100:3000])
+    hasher.feed(3000, data[3000:5000])
+    # behind what is hashed already and overlapping it
+    hasher.feed(200, data[200:300])
+    hasher.feed(4000, data[4000:6000])
+    hasher.feed(9000, data[9000:9500])
+
+    assert hasher.finish() == hashlib.sha256(data).hexdigest()
+    assert hasher.fed == 6000 - 100 + 500
+
+
+def test_write_manifest(tmp_path):
+    iso = tmp_path / "esxi.iso"
+    iso.write_bytes(b"iso")
+    image = tmp_path / "out.qcow2"
+
+    path = checksums.write_manifest(
+        image, "qcow2", {"size": 1, "sha256": "a", "md5": "b"}, iso, "c"
+    )
+
+    assert path == tmp_path / "out.qcow2.manifest.json"
+    manifest = json.loads(path.read_text())
+    assert manifest["iso"] == {"name": "esxi.iso", "size": 3, "sha256": "c"}
+    assert manifest["image"]["format"] == "qcow2"
+    assert checksums.read_manifest(image) == manifest
+
+
+def test_read_manifest_missing(tmp_path):
+    image = tmp_path / "out.img"
+    assert checksums.read_manifest(image) is None
+    checksums.manifest_path(image).write_text("{")
+    assert checksums.read_manifest(image) is None
+
+
+def test_helper_digest(tmp_path):
+    """The gzip header doesn't change the digest of a helper."""
+    first = tmp_path / "first.tgz"
+    second = tmp_path / "second.tgz"
+    first.write_bytes(gzip.compress(b"tar", mtime=1))
+    second.write_bytes(gzip.compress(b"tar", mtime=2))
+
+    assert checksums.helper_digest(first) == checksums.helper_digest(second)
+    assert checksums.helper_digest(first) == hashlib.sha256(b"tar").hexdigest()
+
+
+def test_resources_digest(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "ks.cfg").write_text("vmaccepteula\n")
+    (tmp_path / "__pycache__").mkdir()
+    (tmp_path / "__pycache__" / "mod.pyc").write_bytes(b"compiled")
+    digest = checksums.resources_digest(tmp_path)
+
+    (tmp_path / "__pycache__" / "mod.pyc").write_bytes(b"recompiled")
+    assert checksums.resources_digest(tmp_path) == digest
+
+    (tmp_path / "sub" / "ks.cfg").write_text("vmaccepteula\nreboot\n")
+    assert checksums.resources_digest(tmp_path) != digest
@@ -0,0 +1,544 @@
+import functools
+import hashlib
+import json
+import os
+import struct
+import tarfile
+from pathlib import Path
+from pathlib import PurePosixPath
+
+import pytest
+
+from esxi_img import checksums
+from esxi_img import cmd
+from esxi_img import fat32
+from esxi_img import gpt
+
+
+def _read_esp_file(image: Path, path: str) -> bytes:
+    """Look a file up by its 8.3 name in the ESP of a disk image."""
+    with image.open("rb") as f:
+
+        def read(offset: int, size: int) -> bytes:
+            f.seek(offset)
+            return f.read(size)
+
+        entries = read(2 * gpt.SECTOR_SIZE, gpt.ENTRY_SIZE)
+        part = struct.unpack_from("<Q", entries, 32)[0] * gpt.SECTOR_SIZE
+        boot = read(part, fat32.SECTOR_SIZE)
+        geometry = fat32.Geometry(
+            struct.unpack_from("<I", boot, 32)[0],
+            boot[13],
+            struct.unpack_from("<I", boot, 36)[0],
+        )
+        fat_start = part + fat32.RESERVED_SECTORS * fat32.SECTOR_SIZE
+
+        def chain(cluster: int, size: int | None) -> bytes:
+            out = b""
+            while cluster and cluster < 0x0FFFFFF8:
+                offset = part + geometry.cluster_offset(cluster)
+                out += read(offset, geometry.cluster_size)
+                cluster = struct.unpack("<I", read(fat_start + cluster * 4, 4))[0]
+            return out if size is None else out[:size]
+
+        parts = PurePosixPath(path).parts
+        content = chain(fat32.ROOT_CLUSTER, None)
+        for n, name in enumerate(parts):
+            base, _, ext = name.upper().partition(".")
+            short = (base.ljust(8) + ext.ljust(3)).encode()
+            for i in range(0, len(content), 32):
+                entry = content[i : i + 32]
+                if entry[0:11] == short:
+                    break
+            else:
+                raise FileNotFoundError(path)
+            hi, lo = struct.unpack_from("<HxxxxH", entry, 20)
+            size = struct.unpack_from("<I", entry, 28)[0]
+            content = chain(hi << 16 | lo, size if n == len(parts) - 1 else None)
+        return content
+
+
+def test_patch_esxi_config():
+    """The boot config loads our helper and points at our kickstart."""
+    text = "kernelopt=runweasel ks=cdrom:/KS.CFG\nmodules=/b.b00 --- /s.v00\n"
+    patched = cmd._patch_esxi_config(text)
+    assert patched.splitlines() == [
+        "kernelopt=runweasel  ks=file:///esxiimg/KS.CFG",
+        "modules=/b.b00 --- /s.v00 --- /esxiimg.tgz",
+    ]
+    assert "/esxiimg.tgz --- /esxiimg.tgz" not in cmd._patch_esxi_config(patched)
+
+
+def test_stream_disk_img(esxi_iso, tmp_path):
+    """Files go straight from the ISO into the ESP with BOOT.CFG patched."""
+    helper = tmp_path / "helper.tgz"
+    helper.write_bytes(b"helper")
+    image = tmp_path / "disk.img"
+
+    cmd._stream_disk_img(str(esxi_iso), helper, {"raw": image})
+
+    assert _read_esp_file(image, "S.V00") == bytes(range(255, -1, -1)) * 9000
+    assert _read_esp_file(image, "USEROPTS.GZ") == b""
+    assert _read_esp_file(image, "ESXIIMG.TGZ") == b"helper"
+    for boot_cfg in ("BOOT.CFG", "EFI/BOOT/BOOT.CFG"):
+        text = _read_esp_file(image, boot_cfg).decode()
+        assert "--- /s.v00 --- /esxiimg.tgz" in text
+        assert "ks=file:///esxiimg/KS.CFG" in text
+
+
+def test_stream_disk_img_qcow2(esxi_iso, tmp_path, read_qcow2):
+    """A raw and a compressed qcow2 image of the same disk in one pass."""
+    helper = tmp_path / "helper.tgz"
+    helper.write_bytes(b"helper")
+    raw = tmp_path / "disk.img"
+    image = tmp_path / "disk.qcow2"
+
+    cmd._stream_disk_img(
+        str(esxi_iso), helper, {"raw": raw, "qcow2": image}, compress=True
+    )
+
+    assert read_qcow2(image) == raw.read_bytes()
+    assert _read_esp_file(raw, "ESXIIMG.TGZ") == b"helper"
+    assert image.stat().st_size < raw.stat().st_size // 10
+
+
+def test_extract_iso(esxi_iso, tmp_path):
+    """Extraction with a pool of workers reproduces every file."""
+    cmd.extract_iso(str(esxi_iso), tmp_path, workers=4)
+
+    assert (tmp_path / "S.V00").read_bytes() == bytes(range(255, -1, -1)) * 9000
+    assert (tmp_path / "B.B00").read_bytes() == bytes(range(256)) * 300
+    assert (tmp_path / "USEROPTS.GZ").read_bytes() == b""
+    assert (tmp_path / "EFI" / "BOOT" / "BOOTX64.EFI").stat().st_size == 4096
+
+
+def test_generate_image_cached(esxi_iso, tmp_path):
+    """A cached extraction is reused without touching the cached files."""
+    cache_dir = tmp_path / "cache"
+    for n in range(2):
+        out = tmp_path / f"out{n}.img"
+        assert (
+            cmd.generate_image(
+                str(esxi_iso), str(out), "raw", cmd.BuildOptions(cache_dir=cache_dir)
+            )
+            == 0
+        )
+        assert b"esxiimg.tgz" in _read_esp_file(out, "BOOT.CFG")
+
+    (entry,) = (cache_dir / "isos").glob("*/tree")
+    assert b"esxiimg.tgz" not in (entry / "BOOT.CFG").read_bytes()
+
+
+def test_generate_image_formats(esxi_iso, tmp_path, read_qcow2):
+    """Several formats come out of a single build."""
+    raw = tmp_path / "out.img"
+    copy = tmp_path / "copy.img"
+    image = tmp_path / "out.qcow2"
+
+    assert (
+        cmd.generate_image(
+            str(esxi_iso), [str(raw), str(image), str(copy)], ["raw", "qcow2", "raw"]
+        )
+        == 0
+    )
+
+    assert read_qcow2(image) == raw.read_bytes() == copy.read_bytes()
+
+
+def test_output_formats():
+    assert cmd.output_formats(["a.qcow2"], None) == ["qcow2"]
+    assert cmd.output_formats(["a.VMDK"], None) == ["vmdk"]
+    assert cmd.output_formats(["a.img"], None) == ["raw"]
+    assert cmd.output_formats(["a"], None) == ["raw"]
+    assert cmd.output_formats(["a.img", "b.qcow2", "c.vmdk"], None) == [
+        "raw",
+        "qcow2",
+        "vmdk",
+    ]
+    assert cmd.output_formats(["a", "b"], ["qcow2,vmdk"]) == ["qcow2", "vmdk"]
+    assert cmd.output_formats(["a", "b"], ["qcow2"]) == ["qcow2", "qcow2"]
+    with pytest.raises(ValueError):
+        cmd.output_formats(["a", "b", "c"], ["raw", "qcow2"])
+    assert cmd.output_formats(["a.iso", "b.img"], None) == ["raw", "raw"]
+    with pytest.raises(ValueError):
+        cmd.output_formats(["a"], ["iso"])
+
+
+@pytest.mark.parametrize(
+    ("argv", "fmt"),
+    [
+        (["out.img"], "raw"),
+        (["out.qcow2"], "qcow2"),
+        (["out.vmdk"], "vmdk"),
+        (["--format", "raw", "out.qcow2"], "raw"),
+    ],
+)
+def test_gen_img_single_format(monkeypatch, caplog, argv, fmt):
+    """A single DISKIMG takes its format from its extension, not always raw."""
+    built = []
+    monkeypatch.setattr(
+        cmd, "generate_image", lambda iso, paths, fmts, options: built.append(fmts)
+    )
+    monkeypatch.setattr("sys.argv", ["esxi-img", "gen-img", "esxi.iso", *argv])
+
+    cmd.main()
+
+    assert built == [[fmt]]
+    assert ("--format raw" in caplog.text) == (fmt != "raw")
+
+
+def test_generate_image_profile(esxi_iso, tmp_path):
+    """A profile of the build stages is written alongside the image."""
+    report = tmp_path / "profile.json"
+    out = tmp_path / "out.img"
+
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            str(out),
+            "raw",
+            cmd.BuildOptions(
+                cache_dir=str(tmp_path / "cache"), profile_path=str(report)
+            ),
+        )
+        == 0
+    )
+
+    stages = [stage["name"] for stage in json.loads(report.read_text())["stages"]]
+    # the helper is generated alongside the extraction
+    stages.remove("generate_installer_helper")
+    assert stages == [
+        "index_iso",
+        "extract_iso",
+        "update_esxi_config",
+        "size_esp",
+        "create_disk_img",
+        "punch_zero_holes",
+        "convert_img",
+        "write_manifest",
+    ]
+
+
+def test_generate_image_helper_fails(esxi_iso, tmp_path, monkeypatch):
+    """A helper failing on its thread fails the build."""
+    monkeypatch.setattr(cmd, "generate_installer_helper", lambda *args: 1)
+    out = tmp_path / "out.img"
+
+    rc = cmd.generate_image(
+        str(esxi_iso),
+        str(out),
+        "raw",
+        cmd.BuildOptions(cache_dir=str(tmp_path / "cache")),
+    )
+
+    assert rc == 1
+    assert not out.exists()
+
+
+def test_generate_image_resume(esxi_iso, tmp_path, monkeypatch):
+    """A failed build resumes from its first incomplete stage."""
+    work_dir = tmp_path / "work"
+    out = tmp_path / "out.qcow2"
+    publish = cmd._publish_images
+    streamed = []
+
+    def fail(*args):
+        raise OSError("preempted")
+
+    def stream(*args):
+        streamed.append(args)
+        return stream_disk_img(*args)
+
+    stream_disk_img = cmd._stream_disk_img
+    monkeypatch.setattr(cmd, "_stream_disk_img", stream)
+    monkeypatch.setattr(cmd, "_publish_images", fail)
+    build = functools.partial(
+        cmd.generate_image,
+        str(esxi_iso),
+        str(out),
+        "qcow2",
+        cmd.BuildOptions(work_dir=str(work_dir)),
+    )
+    assert build() == 1
+    assert len(streamed) == 1
+    assert (work_dir / "stages" / "image.json").exists()
+
+    monkeypatch.setattr(cmd, "_publish_images", publish)
+    assert build() == 0
+    assert len(streamed) == 1
+    assert out.exists()
+    assert [entry.name for entry in work_dir.iterdir()] == ["lock"]
+
+
+def test_generate_image_manifest(esxi_iso, tmp_path):
+    """Each output gets a manifest of its checksums and the ISO's."""
+    raw = tmp_path / "out.img"
+    copy = tmp_path / "copy.img"
+    image = tmp_path / "out.qcow2"
+
+    assert (
+        cmd.generate_image(
+            str(esxi_iso), [str(raw), str(copy), str(image)], ["raw", "raw", "qcow2"]
+        )
+        == 0
+    )
+
+    iso_sha256 = hashlib.sha256(esxi_iso.read_bytes()).hexdigest()
+    for path, fmt in ((raw, "raw"), (copy, "raw"), (image, "qcow2")):
+        manifest = json.loads(Path(f"{path}.manifest.json").read_text())
+        data = path.read_bytes()
+        assert manifest["iso"]["sha256"] == iso_sha256
+        assert manifest["image"] == {
+            "name": path.name,
+            "format": fmt,
+            "size": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "md5": hashlib.md5(data).hexdigest(),  # noqa: S324
+        }
+
+
+def test_generate_image_iso_hashed_while_streamed(esxi_iso, tmp_path, monkeypatch):
+    """The ISO digest comes from the data the build streams off the ISO."""
+    hashers = []
+    original = checksums.OrderedHasher
+
+    def hasher(path):
+        hashers.append(original(path))
+        return hashers[-1]
+
+    monkeypatch.setattr(checksums, "OrderedHasher", hasher)
+
+    assert cmd.generate_image(str(esxi_iso), str(tmp_path / "out.img"), "raw") == 0
+
+    # the modules make up most of the ISO and are only read once
+    (iso_hasher,) = hashers
+    assert iso_hasher.fed > esxi_iso.stat().st_size // 2
+    manifest = json.loads((tmp_path / "out.img.manifest.json").read_text())
+    assert (
+        manifest["iso"]["sha256"] == hashlib.sha256(esxi_iso.read_bytes()).hexdigest()
+    )
+
+
+def test_generate_image_up_to_date(esxi_iso, tmp_path):
+    """Outputs are only rebuilt when an input changed or when forced."""
+    ks_template = tmp_path / "ks.cfg"
+    ks_template.write_text("vmaccepteula\n")
+    image = tmp_path / "out.img"
+
+    def build(**kwargs) -> int:
+        mtime_ns = image.stat().st_mtime_ns if image.exists() else None
+        assert (
+            cmd.generate_image(
+                str(esxi_iso),
+                str(image),
+                "raw",
+                cmd.BuildOptions(ks_template_path=str(ks_template), **kwargs),
+            )
+            == 0
+        )
+        return image.stat().st_mtime_ns != mtime_ns
+
+    assert build()
+    assert not build()
+    assert build(force=True)
+    ks_template.write_text("vmaccepteula\nreboot\n")
+    assert build()
+    assert not build()
+
+
+def test_generate_image_exists(esxi_iso, tmp_path):
+    """Outputs without a manifest are never overwritten unless forced."""
+    image = tmp_path / "out.img"
+    image.write_bytes(b"precious")
+
+    assert cmd.generate_image(str(esxi_iso), str(image), "raw") == 1
+    assert image.read_bytes() == b"precious"
+    assert (
+        cmd.generate_image(
+            str(esxi_iso), str(image), "raw", cmd.BuildOptions(force=True)
+        )
+        == 0
+    )
+    assert image.read_bytes() != b"precious"
+
+
+def test_generate_image_base(esxi_iso, tmp_path, read_qcow2):
+    """A new kickstart only rewrites the helper and boot configs of a base."""
+    base = tmp_path / "base.img"
+    assert cmd.generate_image(str(esxi_iso), str(base), "raw") == 0
+    ks_template = tmp_path / "ks.cfg"
+    ks_template.write_text("vmaccepteula\nrootpw changed\n")
+    raw = tmp_path / "patched.img"
+    image = tmp_path / "patched.qcow2"
+
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            [str(raw), str(image)],
+            ["raw", "qcow2"],
+            cmd.BuildOptions(ks_template_path=str(ks_template), base_path=str(base)),
+        )
+        == 0
+    )
+
+    assert read_qcow2(image) == raw.read_bytes()
+    assert _read_esp_file(raw, "ESXIIMG.TGZ") != _read_esp_file(base, "ESXIIMG.TGZ")
+    for path in ("BOOT.CFG", "EFI/BOOT/BOOT.CFG", "B.B00", "S.V00"):
+        assert _read_esp_file(raw, path) == _read_esp_file(base, path)
+    # the partition table and file system are left as they were
+    assert raw.read_bytes()[: 1024 * 1024] == base.read_bytes()[: 1024 * 1024]
+
+
+def test_generate_image_base_mismatch(esxi_iso, tmp_path):
+    """A base built from other media is rejected."""
+    base = tmp_path / "base.img"
+    assert cmd.generate_image(str(esxi_iso), str(base), "raw") == 0
+    volume_image = tmp_path / "other.img"
+    volume_image.write_bytes(base.read_bytes())
+    with volume_image.open("r+b") as f:
+        volume = fat32.Fat32Volume(f, gpt.find_esp(f).offset)
+        volume.replace("S.V00", b"other")
+        volume.flush()
+
+    out = tmp_path / "out.img"
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            str(out),
+            "raw",
+            cmd.BuildOptions(base_path=str(volume_image)),
+        )
+        == 1
+    )
+    assert not out.exists()
+
+
+def test_generate_image_backing(esxi_iso, tmp_path, read_qcow2):
+    """Variants of one ISO are thin overlays of a shared backing image."""
+    backing = tmp_path / "esxi.qcow2"
+    images = tmp_path / "images"
+    images.mkdir()
+    ks_template = tmp_path / "ks.cfg"
+    ks_template.write_text("vmaccepteula\nrootpw changed\n")
+
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            str(images / "one.qcow2"),
+            "qcow2",
+            cmd.BuildOptions(backing_path=str(backing)),
+        )
+        == 0
+    )
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            [str(images / "two.qcow2"), str(images / "two.img")],
+            ["qcow2", "raw"],
+            cmd.BuildOptions(
+                ks_template_path=str(ks_template), backing_path=str(backing)
+            ),
+        )
+        == 0
+    )
+
+    assert backing.exists()
+    assert read_qcow2(images / "two.qcow2") == (images / "two.img").read_bytes()
+    assert read_qcow2(images / "one.qcow2") != read_qcow2(images / "two.qcow2")
+    header = (images / "two.qcow2").read_bytes()
+    backing_offset, backing_size = struct.unpack_from(">QI", header, 8)
+    assert header[backing_offset : backing_offset + backing_size] == b"../esxi.qcow2"
+    assert (images / "two.qcow2").stat().st_size < backing.stat().st_size
+
+
+def test_generate_image_backing_lost(esxi_iso, tmp_path):
+    """An overlay is rebuilt when its backing image is removed or rebuilt."""
+    backing = tmp_path / "esxi.qcow2"
+    image = tmp_path / "one.qcow2"
+
+    def build() -> bool:
+        mtime_ns = image.stat().st_mtime_ns if image.exists() else None
+        assert (
+            cmd.generate_image(
+                str(esxi_iso),
+                str(image),
+                "qcow2",
+                cmd.BuildOptions(backing_path=str(backing)),
+            )
+            == 0
+        )
+        return image.stat().st_mtime_ns != mtime_ns
+
+    assert build()
+    assert not build()
+    backing.unlink()
+    assert build()
+    assert backing.exists()
+    assert not build()
+    os.utime(backing, ns=(0, 0))
+    assert build()
+
+
+def test_installer_helper_reproducible(tmp_path):
+    """A fixed time gives the same tarball whatever it is called."""
+    one = tmp_path / "ESXIIMG.TGZ"
+    two = tmp_path / "helper-0.tgz"
+
+    assert cmd.generate_installer_helper(None, str(one), 1700000000) == 0
+    assert cmd.generate_installer_helper(None, str(two), 1700000000) == 0
+
+    assert one.read_bytes() == two.read_bytes()
+    with tarfile.open(one) as tar:
+        assert {member.mtime for member in tar.getmembers()} == {1700000000}
+
+
+def test_generate_image_reproducible(esxi_iso, tmp_path, monkeypatch):
+    """Builds with the same inputs and time are byte-identical."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    one = tmp_path / "one.qcow2"
+    two = tmp_path / "two.qcow2"
+    raw = tmp_path / "one.img"
+    cached = tmp_path / "cached.img"
+    cached_qcow2 = tmp_path / "cached.qcow2"
+
+    assert (
+        cmd.generate_image(str(esxi_iso), [str(raw), str(one)], ["raw", "qcow2"]) == 0
+    )
+    assert cmd.generate_image(str(esxi_iso), str(two), "qcow2") == 0
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            [str(cached), str(cached_qcow2)],
+            ["raw", "qcow2"],
+            cmd.BuildOptions(cache_dir=str(tmp_path / "cache")),
+        )
+        == 0
+    )
+
+    assert one.read_bytes() == two.read_bytes()
+    assert raw.read_bytes() == cached.read_bytes()
+    # the files are laid out from the cache the way they are streamed
+    assert cached_qcow2.read_bytes() == one.read_bytes()
+    manifests = [
+        json.loads(Path(f"{path}.manifest.json").read_text()) for path in (one, two)
+    ]
+    assert manifests[0]["image"]["sha256"] == manifests[1]["image"]["sha256"]
+
+
+def test_generate_image_identity_from_iso(esxi_iso, tmp_path, monkeypatch):
+    """ISOs of the same size give images with different identifiers."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    data = bytearray(esxi_iso.read_bytes())
+    module = bytes(range(255, -1, -1)) * 4
+    data[data.index(module)] ^= 0xFF
+    other_iso = tmp_path / "other.iso"
+    other_iso.write_bytes(data)
+    one = tmp_path / "one.img"
+    other = tmp_path / "other.img"
+
+    assert cmd.generate_image(str(esxi_iso), str(one), "raw") == 0
+    assert cmd.generate_image(str(other_iso), str(other), "raw") == 0
+
+    # the disk GUID in the primary GPT header
+    guids = [path.read_bytes()[512 + 56 : 512 + 72] for path in (one, other)]
+    assert guids[0] != guids[1]
@@ -0,0 +1,156 @@
+import io
+import tarfile
+
+import pycdlib
+
+from esxi_img import cache
+from esxi_img import cmd
+from esxi_img import diff
+from esxi_img import isoindex
+
+VIB = "<vib><name>{}</name><version>{}</version></vib>"
+
+
+def _iso(path, files, vibs):
+    imgdb = io.BytesIO()
+    with tarfile.open(fileobj=imgdb, mode="w:gz") as tar:
+        for name, version in vibs.items():
+            data = VIB.format(name, version).encode()
+            info = tarfile.TarInfo(f"var/db/esximg/vibs/{name}.xml")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=3)
+    for name, data in {**files, "IMGDB.TGZ": imgdb.getvalue()}.items():
+        iso.add_fp(io.BytesIO(data), len(data), f"/{name};1")
+    iso.write(str(path))
+    iso.close()
+    return path
+
+
+def test_diff_isos(tmp_path, monkeypatch):
+    old = _iso(
+        tmp_path / "old.iso",
+        {"BOOT.CFG": b"build=8.0.3-0.0.1\n", "A.V00": b"a" * 100, "B.V00": b"b"},
+        {"esx-base": "8.0.3-0.0.1", "bmcal": "8.0.3-0.0.1", "tools": "1"},
+    )
+    new = _iso(
+        tmp_path / "new.iso",
+        {"BOOT.CFG": b"build=8.0.3-0.0.2\n", "A.V00": b"c" * 100, "C.V00": b"cc"},
+        {"esx-base": "8.0.3-0.0.2", "bmcal": "8.0.3-0.0.1", "vsan": "1"},
+    )
+
+    def fail(*args):
+        raise AssertionError("ISO hashed on its own")
+
+    # new ISOs are digested while they are indexed
+    monkeypatch.setattr(cache, "file_digest", fail)
+    iso_cache = cache.IsoCache(tmp_path / "cache")
+
+    differences = diff.diff(old, new, iso_cache)
+
+    assert differences["old"]["build"] == "1"
+    assert differences["new"]["build"] == "2"
+    assert differences["added"] == [{"path": "C.V00", "size": 2}]
+    assert differences["removed"] == [{"path": "B.V00", "size": 1}]
+    assert [change["path"] for change in differences["changed"]] == [
+        "A.V00",
+        "BOOT.CFG",
+        "IMGDB.TGZ",
+    ]
+    assert differences["vibs"] == {
+        "added": [{"name": "vsan", "version": "1"}],
+        "removed": [{"name": "tools", "version": "1"}],
+        "changed": [
+            {
+                "name": "esx-base",
+                "old_version": "8.0.3-0.0.1",
+                "new_version": "8.0.3-0.0.2",
+            }
+        ],
+    }
+
+    # compared again from the cached indexes
+    monkeypatch.setattr(isoindex.IsoIndex, "from_iso", fail)
+    assert diff.diff(old, new, iso_cache) == differences
+
+
+def test_diff_overlays(esxi_iso, tmp_path, monkeypatch):
+    """Files overlays leave to their shared backing file aren't read."""
+    backing = tmp_path / "esxi.qcow2"
+    one = tmp_path / "one.qcow2"
+    two = tmp_path / "two.qcow2"
+    ks_template = tmp_path / "ks.cfg"
+    ks_template.write_text("vmaccepteula\nrootpw changed\n")
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            str(one),
+            "qcow2",
+            cmd.BuildOptions(backing_path=str(backing)),
+        )
+        == 0
+    )
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            str(two),
+            "qcow2",
+            cmd.BuildOptions(
+                ks_template_path=str(ks_template), backing_path=str(backing)
+            ),
+        )
+        == 0
+    )
+    read = []
+    digest = diff._extents_digest
+
+    def record(fp, extents):
+        read.append(sum(length for _offset, length in extents))
+        return digest(fp, extents)
+
+    monkeypatch.setattr(diff, "_extents_digest", record)
+
+    differences = diff.diff(one, two, cache.IsoCache(tmp_path / "cache"))
+
+    assert differences["added"] == differences["removed"] == []
+    assert [change["path"] for change in differences["changed"]] == ["ESXIIMG.TGZ"]
+    # only files sharing qcow2 clusters with the rewritten ones are read,
+    # the large modules are left to the backing file
+    assert read
+    assert max(read) < 100_000
+
+
+def test_diff_cmd(esxi_iso, tmp_path, capsys):
+    image = tmp_path / "esxi.img"
+    assert cmd.generate_image(str(esxi_iso), str(image), "raw") == 0
+    capsys.readouterr()
+
+    assert cmd.diff(str(image), str(image), str(tmp_path / "cache")) == 0
+    assert '"changed": []' in capsys.readouterr().out
+    assert cmd.diff(str(esxi_iso), str(image), str(tmp_path / "cache")) == 2
+
+
+def test_diff_cmd_cache_max_size(esxi_iso, tmp_path, monkeypatch, capsys):
+    """Diff trims the ISO cache to --cache-max-size like the builds."""
+    cache_dir = tmp_path / "cache"
+    iso_cache = cache.IsoCache(cache_dir)
+    with iso_cache.tree(esxi_iso, lambda tree: (tree / "S.V00").write_bytes(b"x")):
+        pass
+    assert iso_cache.entries()
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "esxi-img",
+            "diff",
+            str(esxi_iso),
+            str(esxi_iso),
+            "--cache-dir",
+            str(cache_dir),
+            "--cache-max-size",
+            "0",
+        ],
+    )
+
+    assert cmd.main() == 0
+    assert iso_cache.entries() == []
@@ -0,0 +1,149 @@
+import io
+import struct
+from pathlib import PurePosixPath
+
+import pytest
+
+from esxi_img import fat32
+from esxi_img.fat32 import Fat32Builder
+
+VOLUME_SECTORS = 70000
+
+
+def _build(builder: Fat32Builder) -> tuple[bytes, fat32.Geometry]:
+    buf = io.BytesIO(bytes(VOLUME_SECTORS * fat32.SECTOR_SIZE))
+    geometry = builder.write(buf, 0, VOLUME_SECTORS)
+    return buf.getvalue(), geometry
+
+
+def _entries(data: bytes, geometry: fat32.Geometry, cluster: int) -> list[bytes]:
+    start = geometry.cluster_offset(cluster)
+    chunk = data[start : start + geometry.cluster_size]
+    entries = [chunk[i : i + 32] for i in range(0, len(chunk), 32)]
+    return [e for e in entries if e[0] != 0 and e[11] != fat32.ATTR_LFN]
+
+
+def test_short_form():
+    """Names that fit 8.3 do not get a long file name."""
+    assert fat32._short_form("BOOT.CFG") == (b"BOOT    CFG", 0)
+    assert fat32._short_form("esxiimg.tgz") == (b"ESXIIMG TGZ", 0x18)
+    assert fat32._short_form("Boot.cfg") is None
+    assert fat32._short_form("metadata.zip.sig") is None
+
+
+def test_short_alias():
+    """Long names get a unique numeric tail alias."""
+    taken = {b"LONGNA~1TXT"}
+    assert fat32._short_alias("long name.txt", taken) == b"LONGNA~2TXT"
+
+
+def test_write_volume():
+    """Files land in contiguous clusters listed in the directories."""
+    builder = Fat32Builder(volume_id=0x1234ABCD)
+    builder.add_bytes(PurePosixPath("BOOT.CFG"), b"kernel=/b.b00\n")
+    builder.add_bytes(PurePosixPath("EFI/BOOT/BOOTX64.EFI"), b"x" * 1500)
+    builder.add_bytes(PurePosixPath("a long name.txt"), b"")
+    data, geometry = _build(builder)
+
+    assert data[510:512] == b"\x55\xaa"
+    assert data[82:90] == b"FAT32   "
+    assert struct.unpack_from("<I", data, 67)[0] == 0x1234ABCD
+    # backup boot sector
+    assert data[6 * 512 : 7 * 512] == data[0:512]
+    assert geometry.cluster_count >= fat32.MIN_CLUSTERS
+
+    root = {e[0:11]: e for e in _entries(data, geometry, fat32.ROOT_CLUSTER)}
+    assert set(root) == {b"EFI        ", b"BOOT    CFG", b"ALONGN~1TXT"}
+
+    boot_cfg = root[b"BOOT    CFG"]
+    cluster = struct.unpack_from("<H", boot_cfg, 26)[0]
+    size = struct.unpack_from("<I", boot_cfg, 28)[0]
+    offset = geometry.cluster_offset(cluster)
+    assert data[offset : offset + size] == b"kernel=/b.b00\n"
+
+    efi = struct.unpack_from("<H", root[b"EFI        "], 26)[0]
+    efi_entries = [e[0:11] for e in _entries(data, geometry, efi)]
+    assert efi_entries == [b".          ", b"..         ", b"BOOT       "]
+
+    fat_start = fat32.RESERVED_SECTORS * fat32.SECTOR_SIZE
+    boot = struct.unpack_from("<H", _entries(data, geometry, efi)[2], 26)[0]
+    bootx64 = _entries(data, geometry, boot)[2]
+    first = struct.unpack_from("<H", bootx64, 26)[0]
+    chain = struct.unpack_from("<3I", data, fat_start + first * 4)
+    assert chain == (first + 1, first + 2, fat32.EOC)
+
+
+def test_duplicate_names():
+    """FAT is case insensitive so names differing in case collide."""
+    builder = Fat32Builder()
+    builder.add_bytes(PurePosixPath("BOOT.CFG"), b"")
+    with pytest.raises(ValueError):
+        builder.add_bytes(PurePosixPath("boot.cfg"), b"")
+
+
+def test_volume_too_small():
+    builder = Fat32Builder()
+    buf = io.BytesIO()
+    with pytest.raises(ValueError):
+        builder.write(buf, 0, 2048)
+
+
+def _volume() -> tuple[io.BytesIO, fat32.Fat32Volume]:
+    builder = Fat32Builder()
+    builder.add_bytes(PurePosixPath("BOOT.CFG"), b"kernel=/b.b00\n")
+    builder.add_bytes(PurePosixPath("ESXIIMG.TGZ"), b"h" * 1500)
+    builder.add_bytes(PurePosixPath("EFI/BOOT/a long name.txt"), b"long")
+    builder.add_bytes(PurePosixPath("S.V00"), b"s" * 3000)
+    data, _geometry = _build(builder)
+    buf = io.BytesIO(data)
+    return buf, fat32.Fat32Volume(buf)
+
+
+def _free_count(volume: fat32.Fat32Volume) -> int:
+    data = volume._read(fat32.FSINFO_SECTOR * fat32.SECTOR_SIZE, fat32.SECTOR_SIZE)
+    return struct.unpack_from("<I", data, 488)[0]
+
+
+def test_volume_read():
+    """Files are found by their long or short names ignoring case."""
+    _buf, volume = _volume()
+
+    assert volume.read("boot.cfg") == b"kernel=/b.b00\n"
+    assert volume.read("EFI/BOOT/a long name.txt") == b"long"
+    assert volume.read("EFI/BOOT/ALONGN~1.TXT") == b"long"
+    assert [entry.name for entry in volume.listdir("EFI/BOOT")] == ["a long name.txt"]
+    with pytest.raises(FileNotFoundError):
+        volume.read("missing")
+
+
+@pytest.mark.parametrize("size", [10, 1500, 5000])
+def test_volume_replace(size):
+    """Files can shrink or grow in place without touching other files."""
+    buf, volume = _volume()
+    free = _free_count(volume)
+    old_clusters = len(volume.chain(volume.lookup("ESXIIMG.TGZ").cluster))
+
+    volume.replace("ESXIIMG.TGZ", b"n" * size)
+    volume.flush()
+
+    reopened = fat32.Fat32Volume(buf)
+    assert reopened.read("ESXIIMG.TGZ") == b"n" * size
+    assert reopened.read("S.V00") == b"s" * 3000
+    assert reopened.read("BOOT.CFG") == b"kernel=/b.b00\n"
+    new_clusters = len(reopened.chain(reopened.lookup("ESXIIMG.TGZ").cluster))
+    assert _free_count(reopened) == free + old_clusters - new_clusters
+    # both FATs are kept the same
+    fat_bytes = reopened.geometry.fat_sectors * fat32.SECTOR_SIZE
+    data = buf.getvalue()
+    first = fat32.RESERVED_SECTORS * fat32.SECTOR_SIZE
+    assert (
+        data[first : first + fat_bytes]
+        == data[first + fat_bytes : first + 2 * fat_bytes]
+    )
+
+
+def test_volume_replace_unchanged():
+    """Rewriting a file with the same contents only touches its entry."""
+    _buf, volume = _volume()
+
+    assert volume.replace("S.V00", b"s" * 3000) <= fat32.DIR_ENTRY_SIZE
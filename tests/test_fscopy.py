@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from esxi_img import fscopy
+from esxi_img import sparse
+
+
+def _make_tree(root):
+    (root / "EFI" / "BOOT").mkdir(parents=True)
+    (root / "EFI" / "BOOT" / "BOOTX64.EFI").write_bytes(b"\x4d\x5a" * 5000)
+    (root / "B.B00").write_bytes(os.urandom(3 * 1024 * 1024))
+    (root / "BOOT.CFG").write_text("kernel=/b.b00\n")
+    (root / "EMPTY").write_bytes(b"")
+
+
+@pytest.mark.parametrize("reserve", [True, False])
+def test_copy_tree(tmp_path, monkeypatch, reserve):
+    """Trees are copied whether or not space can be reserved up front."""
+    if not reserve:
+        monkeypatch.setattr(sparse, "libc_fallocate", lambda: None)
+    source = tmp_path / "source"
+    dest = tmp_path / "dest"
+    _make_tree(source)
+    dest.mkdir()
+    progress = []
+
+    copied = fscopy.copy_tree(
+        source, dest, progress=lambda *done: progress.append(done)
+    )
+
+    for path in source.rglob("*"):
+        copy = dest / path.relative_to(source)
+        if path.is_dir():
+            assert copy.is_dir()
+        else:
+            assert copy.read_bytes() == path.read_bytes()
+    assert copied == sum(p.stat().st_size for p in source.rglob("*") if p.is_file())
+    assert progress[-1] == (4, copied)
+
+
+def test_copy_tree_keeps_size(tmp_path, monkeypatch):
+    """Space is reserved past the end of the files, not filled with zeros."""
+    source = tmp_path / "source"
+    dest = tmp_path / "dest"
+    _make_tree(source)
+    dest.mkdir()
+    calls = []
+    fallocate = sparse.libc_fallocate()
+
+    def record(fd, mode, offset, length):
+        calls.append((mode, offset, length, os.fstat(fd).st_size))
+        result = fallocate(fd, mode, offset, length)
+        # the file stays empty until its data is copied
+        assert os.fstat(fd).st_size == 0
+        return result
+
+    monkeypatch.setattr(sparse, "libc_fallocate", lambda: record)
+
+    fscopy.copy_tree(source, dest)
+
+    assert {mode for mode, *_rest in calls} == {sparse.FALLOC_FL_KEEP_SIZE}
+    assert all(offset == 0 and size == 0 for _mode, offset, _length, size in calls)
+    for path in source.rglob("*"):
+        if path.is_file():
+            copy = dest / path.relative_to(source)
+            assert copy.stat().st_size == path.stat().st_size
+            assert copy.read_bytes() == path.read_bytes()
+
+
+def test_copy_range_mmap(tmp_path, monkeypatch):
+    """Without kernel copies the data is written from a memory map."""
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.delattr(os, "sendfile", raising=False)
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.write_bytes(bytes(range(256)) * 100)
+
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        fscopy.copy_range(fsrc.fileno(), fdst.fileno(), 256, 512)
+        with pytest.raises(OSError):
+            fscopy.copy_range(fsrc.fileno(), fdst.fileno(), 25_000, 1000)
+
+    assert dst.read_bytes() == bytes(range(256)) * 2
@@ -0,0 +1,65 @@
+import io
+import struct
+import zlib
+
+import pytest
+
+from esxi_img import gpt
+
+
+def _header(data: bytes, lba: int) -> tuple:
+    raw = bytearray(data[lba * 512 : lba * 512 + 92])
+    crc = struct.unpack_from("<I", raw, 16)[0]
+    raw[16:20] = b"\x00" * 4
+    assert zlib.crc32(raw) == crc
+    return struct.unpack("<8sIIIIQQQQ16sQIII", raw)
+
+
+def test_partition_bounds():
+    """The ESP starts at 1MiB and fills up to the last usable LBA."""
+    first, last = gpt.partition_bounds(64 * 1024 * 1024)
+    assert first == 2048
+    assert last == 64 * 2048 - 34
+
+
+def test_write_gpt():
+    """Primary and backup headers point at each other and the entries."""
+    size = 8 * 1024 * 1024
+    first, last = gpt.partition_bounds(size)
+    buf = io.BytesIO(bytes(size))
+    gpt.write_gpt(buf, size, first, last)
+    data = buf.getvalue()
+
+    assert data[510:512] == b"\x55\xaa"
+    assert data[446 + 4] == 0xEE
+
+    primary = _header(data, 1)
+    backup = _header(data, size // 512 - 1)
+    assert primary[0] == b"EFI PART"
+    assert primary[5:7] == (1, size // 512 - 1)
+    assert backup[5:7] == (size // 512 - 1, 1)
+    assert primary[13] == backup[13]
+
+    entry = data[primary[10] * 512 : primary[10] * 512 + 128]
+    assert entry[0:16] == gpt.ESP_TYPE_GUID.bytes_le
+    assert struct.unpack_from("<QQ", entry, 32) == (first, last)
+    assert zlib.crc32(data[1024 : 1024 + 128 * 128]) == primary[13]
+
+
+def test_read_partitions():
+    """The partition written is read back and found as the ESP."""
+    size = 8 * 1024 * 1024
+    first, last = gpt.partition_bounds(size)
+    buf = io.BytesIO(bytes(size))
+    gpt.write_gpt(buf, size, first, last)
+
+    (partition,) = gpt.read_partitions(buf)
+
+    assert (partition.first_lba, partition.last_lba) == (first, last)
+    assert partition.offset == first * 512
+    assert gpt.find_esp(buf) == partition
+
+
+def test_read_partitions_invalid():
+    with pytest.raises(ValueError):
+        gpt.read_partitions(io.BytesIO(bytes(64 * 1024)))
@@ -0,0 +1,77 @@
+import pytest
+
+from esxi_img import cmd
+from esxi_img import fat32
+from esxi_img import gpt
+from esxi_img import imginfo
+
+
+@pytest.fixture(scope="module")
+def images(esxi_iso, tmp_path_factory):
+    out = tmp_path_factory.mktemp("images")
+    raw = out / "esxi.img"
+    image = out / "esxi.qcow2"
+    assert (
+        cmd.generate_image(
+            str(esxi_iso),
+            [str(raw), str(image)],
+            ["raw", "qcow2"],
+            cmd.BuildOptions(compress=True),
+        )
+        == 0
+    )
+    return raw, image
+
+
+def test_inspect_image(images, tmp_path):
+    raw, image = images
+
+    info = imginfo.inspect_image(image, tmp_path / "out")
+
+    assert info["problems"] == []
+    assert info["image"]["format"] == "qcow2"
+    assert {file["path"] for file in info["files"]} == {
+        "BOOT.CFG",
+        "EFI/BOOT/BOOT.CFG",
+        "EFI/BOOT/BOOTX64.EFI",
+        "B.B00",
+        "JUMPSTRT.GZ",
+        "USEROPTS.GZ",
+        "S.V00",
+        "ESXIIMG.TGZ",
+    }
+    boot_cfg = info["boot_cfgs"]["BOOT.CFG"]
+    assert boot_cfg["modules"][-1] == "esxiimg.tgz"
+    assert boot_cfg["kickstart"] == "ks=file:///esxiimg/KS.CFG"
+    assert (tmp_path / "out" / "KS.CFG").read_bytes().startswith(b"vmaccepteula")
+    assert (tmp_path / "out" / "EFI/BOOT/BOOT.CFG").exists()
+    # the raw image holds the same
+    raw_info = imginfo.inspect_image(raw)
+    assert raw_info["image"]["format"] == "raw"
+    assert raw_info["files"] == info["files"]
+    assert raw_info["helper"] == info["helper"]
+
+
+def test_inspect_image_unpatched(images, tmp_path):
+    """A boot config which doesn't load the helper fails the check."""
+    raw = tmp_path / "esxi.img"
+    raw.write_bytes(images[0].read_bytes())
+    with raw.open("r+b") as f:
+        volume = fat32.Fat32Volume(f, gpt.find_esp(f).offset)
+        volume.replace("EFI/BOOT/BOOT.CFG", b"kernel=/b.b00\nmodules=/s.v00\n")
+        volume.flush()
+
+    info = imginfo.inspect_image(raw)
+
+    assert info["problems"] == [
+        "EFI/BOOT/BOOT.CFG doesn't load /esxiimg.tgz",
+        "EFI/BOOT/BOOT.CFG doesn't boot with ks=file:///esxiimg/KS.CFG",
+    ]
+    assert cmd.inspect_img(str(raw)) == 1
+
+
+def test_inspect_img_not_an_image(tmp_path, capsys):
+    path = tmp_path / "empty.img"
+    path.write_bytes(bytes(4096))
+    assert cmd.inspect_img(str(path)) == 1
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,63 @@
+import io
+import os
+from pathlib import PurePosixPath
+
+import pycdlib
+import pytest
+
+from esxi_img import isofs
+
+
+def _file(esxi_iso, path: str) -> isofs.IsoFile:
+    iso = pycdlib.PyCdlib()
+    iso.open(str(esxi_iso))
+    try:
+        _dirs, files = isofs.list_tree(iso)
+    finally:
+        iso.close()
+    return next(file for file in files if file.path == PurePosixPath(path))
+
+
+def test_list_tree(esxi_iso):
+    """Every file is listed with its size and where its data lives."""
+    iso = pycdlib.PyCdlib()
+    iso.open(str(esxi_iso))
+    try:
+        dirs, files = isofs.list_tree(iso)
+    finally:
+        iso.close()
+
+    assert dirs == [PurePosixPath("EFI"), PurePosixPath("EFI/BOOT")]
+    by_path = {file.path: file for file in files}
+    assert by_path[PurePosixPath("EFI/BOOT/BOOTX64.EFI")].size == 4096
+    assert by_path[PurePosixPath("EFI/BOOT/BOOTX64.EFI")].iso_path == (
+        "/EFI/BOOT/BOOTX64.EFI;1"
+    )
+
+    s_v00 = by_path[PurePosixPath("S.V00")]
+    with esxi_iso.open("rb") as f:
+        f.seek(s_v00.offset)
+        assert f.read(s_v00.size) == bytes(range(255, -1, -1)) * 9000
+
+
+@pytest.mark.parametrize("kernel", [True, False])
+def test_copy_extents(esxi_iso, tmp_path, monkeypatch, kernel):
+    """Extents are copied by the kernel or written from a memory map."""
+    if not kernel:
+        monkeypatch.delattr(os, "copy_file_range", raising=False)
+        monkeypatch.delattr(os, "sendfile", raising=False)
+    s_v00 = _file(esxi_iso, "S.V00")
+
+    isofs.copy_extents(str(esxi_iso), [s_v00], tmp_path)
+
+    assert (tmp_path / "S.V00").read_bytes() == bytes(range(255, -1, -1)) * 9000
+
+
+def test_extent_writer(esxi_iso):
+    b_b00 = _file(esxi_iso, "B.B00")
+    buf = io.BytesIO()
+
+    with isofs.mapped(esxi_iso) as iso_map:
+        isofs.extent_writer(iso_map, b_b00)(buf)
+
+    assert buf.getvalue() == bytes(range(256)) * 300
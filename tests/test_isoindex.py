@@ -0,0 +1,65 @@
+import hashlib
+from pathlib import PurePosixPath
+
+import pycdlib
+import pytest
+
+from esxi_img import cache
+from esxi_img import cmd
+from esxi_img import isofs
+from esxi_img import isoindex
+
+
+def test_parse_build():
+    boot_cfg = "title=Loading ESXi installer\nbuild=8.0.3-0.35.24280767\nupdated=0\n"
+    assert isoindex.parse_build(boot_cfg) == ("8.0.3", "24280767")
+    assert isoindex.parse_build("build=7.0.3-0.0.00000000\n") == ("7.0.3", "00000000")
+    assert isoindex.parse_build("kernel=/b.b00\n") == (None, None)
+
+
+def test_index(esxi_iso):
+    index = isoindex.IsoIndex.from_iso(esxi_iso, cache.file_digest(esxi_iso))
+
+    iso = pycdlib.PyCdlib()
+    iso.open(str(esxi_iso))
+    try:
+        _dirs, files = isofs.list_tree(iso)
+    finally:
+        iso.close()
+    assert index.tree()[1] == files
+    assert index.dirs == ["EFI", "EFI/BOOT"]
+    assert index.size == esxi_iso.stat().st_size
+
+    file = index.lookup("S.V00")
+    data = bytes(range(255, -1, -1)) * 9000
+    assert file.sha256 == hashlib.sha256(data).hexdigest()
+    assert index.read(esxi_iso, file) == data
+    assert index.lookup("MISSING.V00") is None
+
+
+def test_index_json(esxi_iso):
+    index = isoindex.IsoIndex.from_iso(esxi_iso, "digest")
+
+    loaded = isoindex.IsoIndex.from_json(index.to_json())
+    assert loaded == index
+    # looking files up doesn't change what is stored
+    assert loaded.lookup(PurePosixPath("EFI/BOOT")) is None
+    assert loaded.lookup("S.V00") == index.lookup("S.V00")
+    assert loaded.to_json() == index.to_json()
+    with pytest.raises(ValueError, match="format"):
+        isoindex.IsoIndex.from_json('{"format": 0}')
+
+
+def test_extract_with_index(esxi_iso, tmp_path):
+    """Extracting with an index gives the same tree as walking the ISO."""
+    index = isoindex.IsoIndex.from_iso(esxi_iso, "digest")
+    walked = tmp_path / "walked"
+    indexed = tmp_path / "indexed"
+    walked.mkdir()
+    indexed.mkdir()
+
+    cmd.extract_iso(str(esxi_iso), walked)
+    cmd.extract_iso(str(esxi_iso), indexed, index=index)
+
+    for file in index.files:
+        assert (indexed / file.path).read_bytes() == (walked / file.path).read_bytes()
@@ -0,0 +1,99 @@
+import io
+import json
+import tarfile
+
+import pycdlib
+import pytest
+
+from esxi_img import cmd
+from esxi_img import isoinfo
+
+BOOT_CFG = """bootstate=0
+title=Loading ESXi installer
+kernel=/b.b00
+kernelopt=runweasel cdromBoot
+modules=/jumpstrt.gz --- /s.v00
+build=8.0.3-0.35.24280767
+updated=0
+"""
+
+VIB = """<vib version="5.0">
+  <type>bootbank</type>
+  <name>{name}</name>
+  <version>8.0.3-0.35.24280767</version>
+  <vendor>VMware</vendor>
+  <acceptance-level>vmware_certified</acceptance-level>
+</vib>
+"""
+
+PROFILE = """<imageprofile>
+  <name>ESXi-8.0U3b-24280767-standard</name>
+</imageprofile>
+"""
+
+
+def _imgdb() -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, text in (
+            ("var/db/esximg/vibs/esx-base-1.xml", VIB.format(name="esx-base")),
+            ("var/db/esximg/vibs/bmcal-2.xml", VIB.format(name="bmcal")),
+            ("var/db/esximg/profiles/standard-3", PROFILE),
+        ):
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+@pytest.fixture
+def release_iso(tmp_path):
+    path = tmp_path / "esxi.iso"
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=3)
+    for iso_path, data in (
+        ("/BOOT.CFG;1", BOOT_CFG.encode()),
+        ("/B.B00;1", b"kernel"),
+        ("/S.V00;1", bytes(1000)),
+        ("/IMGDB.TGZ;1", _imgdb()),
+    ):
+        iso.add_fp(io.BytesIO(data), len(data), iso_path)
+    iso.write(str(path))
+    iso.close()
+    return path
+
+
+def test_inspect_iso(release_iso):
+    info = isoinfo.inspect_iso(release_iso)
+
+    assert info["version"] == "8.0.3"
+    assert info["build"] == "24280767"
+    assert info["modules"] == [
+        {"name": "b.b00", "size": 6},
+        {"name": "jumpstrt.gz", "size": None},
+        {"name": "s.v00", "size": 1000},
+    ]
+    assert info["efi_boot_cfg_matches"] is None
+    assert info["image_profile"] == "ESXi-8.0U3b-24280767-standard"
+    assert [vib["name"] for vib in info["vibs"]] == ["bmcal", "esx-base"]
+    assert info["vibs"][0]["acceptance_level"] == "vmware_certified"
+
+
+def test_inspect_iso_cmd(esxi_iso, capsys):
+    assert cmd.inspect_iso(str(esxi_iso)) == 0
+
+    info = json.loads(capsys.readouterr().out)
+    assert info["efi_boot_cfg_matches"] is True
+    assert info["vibs"] == []
+
+
+def test_inspect_iso_invalid(tmp_path):
+    path = tmp_path / "empty.iso"
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=3)
+    iso.write(str(path))
+    iso.close()
+
+    assert cmd.inspect_iso(str(path)) == 1
+    assert cmd.inspect_iso(str(tmp_path / "missing.iso")) == 1
@@ -0,0 +1,77 @@
+import json
+import subprocess
+import sys
+import threading
+
+from esxi_img import profiling
+
+
+def test_stage(tmp_path):
+    """Each stage records its own time, I/O and memory."""
+    profiler = profiling.Profiler()
+    with profiler.stage("write"):
+        (tmp_path / "data").write_bytes(b"x" * 1_000_000)
+    with profiler.stage("child"):
+        subprocess.run([sys.executable, "-c", "sum(range(3_000_000))"], check=True)  # noqa: S603
+
+    write, child = profiler.stages
+    assert write.name == "write"
+    assert write.wall_seconds > 0
+    if write.write_chars is not None:
+        assert write.write_chars >= 1_000_000
+    assert write.peak_rss_bytes > 0
+    assert child.children_user_seconds + child.children_system_seconds > 0
+    assert child.children_peak_rss_bytes > 0
+
+
+def test_overlapping_stages(monkeypatch):
+    """A stage starting while another runs on a thread keeps its peak RSS."""
+    resets = []
+    monkeypatch.setattr(profiling, "_reset_peak_rss", lambda: resets.append(1) or True)
+    profiler = profiling.Profiler()
+    started = threading.Event()
+    release = threading.Event()
+
+    def helper():
+        with profiler.stage("helper"):
+            started.set()
+            release.wait()
+
+    thread = threading.Thread(target=helper)
+    thread.start()
+    started.wait()
+    with profiler.stage("extract"):
+        pass
+    release.set()
+    thread.join()
+    assert len(resets) == 1
+
+    with profiler.stage("after"):
+        pass
+    assert len(resets) == 2
+    assert [stage.name for stage in profiler.stages] == ["extract", "helper", "after"]
+
+
+def test_disabled():
+    profiler = profiling.Profiler(enabled=False)
+    with profiler.stage("nothing"):
+        pass
+    assert profiler.stages == []
+
+
+def test_write(tmp_path):
+    profiler = profiling.Profiler()
+    with profiler.stage("one"):
+        pass
+    with profiler.stage("two"):
+        pass
+    report_path = tmp_path / "profile.json"
+
+    profiler.write(report_path, iso="esxi.iso")
+
+    report = json.loads(report_path.read_text())
+    assert report["iso"] == "esxi.iso"
+    assert [stage["name"] for stage in report["stages"]] == ["one", "two"]
+    assert report["total"]["wall_seconds"] >= sum(
+        stage["wall_seconds"] for stage in report["stages"]
+    )
@@ -0,0 +1,207 @@
+import os
+import struct
+
+import pytest
+
+from esxi_img import qcow2
+
+MiB = 1024 * 1024
+CLUSTER = qcow2.CLUSTER_SIZE
+
+
+def _refcounts(path):
+    """Refcounts recorded in the image and the ones its tables imply."""
+    data = path.read_bytes()
+    l1_size, l1_offset, table_offset, table_clusters = struct.unpack_from(
+        ">IQQI", data, 36
+    )
+    expected = {0: 1}
+
+    def use(offset, count=1):
+        for n in range(count):
+            cluster = offset // CLUSTER + n
+            expected[cluster] = expected.get(cluster, 0) + 1
+
+    use(l1_offset, -(-l1_size * 8 // CLUSTER))
+    use(table_offset, table_clusters)
+    table = struct.unpack_from(f">{table_clusters * CLUSTER // 8}Q", data, table_offset)
+    blocks = [offset for offset in table if offset]
+    for offset in blocks:
+        use(offset)
+    for l2_offset in struct.unpack_from(f">{l1_size}Q", data, l1_offset):
+        l2_offset &= qcow2.OFFSET_MASK
+        if not l2_offset:
+            continue
+        use(l2_offset)
+        for entry in struct.unpack_from(f">{qcow2.L2_ENTRIES}Q", data, l2_offset):
+            if entry & qcow2.OFLAG_COMPRESSED:
+                offset, length = qcow2.Qcow2Writer._compressed_range(entry)
+                start = offset & ~511
+                for cluster in range(
+                    start // CLUSTER, (offset + length - 1) // CLUSTER + 1
+                ):
+                    expected[cluster] = expected.get(cluster, 0) + 1
+            elif entry & qcow2.OFFSET_MASK:
+                use(entry & qcow2.OFFSET_MASK)
+
+    recorded = {}
+    entries = qcow2.REFCOUNT_BLOCK_ENTRIES
+    for n, offset in enumerate(blocks):
+        counts = struct.unpack_from(f">{entries}H", data, offset)
+        for i, count in enumerate(counts):
+            if count:
+                recorded[n * entries + i] = count
+    return recorded, expected
+
+
+def _write(path, size, writes, **kwargs):
+    guest = bytearray(size)
+    with qcow2.Qcow2Writer(path, size, **kwargs) as f:
+        for offset, data in writes:
+            f.seek(offset)
+            f.write(data)
+            guest[offset : offset + len(data)] = data
+    return bytes(guest)
+
+
+WRITES = [
+    # backup GPT at the end first, like the GPT writer does
+    (16 * MiB - 33 * 512, b"\xee" * 33 * 512),
+    (0, b"\x01" * 512),
+    (MiB + 100, os.urandom(200_000)),
+    (3 * MiB, b"compressible" * 20_000),
+    (MiB + 50_000, b"\x02" * 1000),
+    (8 * MiB, bytes(4 * CLUSTER)),
+]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip(tmp_path, read_qcow2, compress):
+    """Guest data reads back the same whichever order it was written in."""
+    image = tmp_path / "disk.qcow2"
+    guest = _write(image, 16 * MiB, WRITES, compress=compress)
+
+    assert read_qcow2(image) == guest
+    recorded, expected = _refcounts(image)
+    assert recorded == expected
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_layout_independent_of_chunking(tmp_path, compress):
+    """The host layout only depends on what is written where."""
+    data = os.urandom(3 * CLUSTER)
+    images = []
+    for chunk in (3 * CLUSTER, CLUSTER // 3, 1000):
+        image = tmp_path / f"disk-{chunk}.qcow2"
+        with qcow2.Qcow2Writer(image, 16 * MiB, compress=compress) as f:
+            f.seek(MiB + 100)
+            for start in range(0, len(data), chunk):
+                f.write(data[start : start + chunk])
+        images.append(image.read_bytes())
+
+    assert images[0] == images[1] == images[2]
+
+
+def test_zeros_not_allocated(tmp_path):
+    """Only clusters holding data take up space in the image."""
+    image = tmp_path / "disk.qcow2"
+    _write(image, 64 * MiB, [(0, bytes(32 * MiB)), (40 * MiB, b"\x01")])
+
+    # header, one data cluster, L2, L1 and the refcount table and block
+    assert image.stat().st_size == 6 * CLUSTER
+
+
+def test_compress_smaller(tmp_path):
+    plain = tmp_path / "plain.qcow2"
+    packed = tmp_path / "packed.qcow2"
+    writes = [(0, b"esxi" * (2 * MiB))]
+    _write(plain, 16 * MiB, writes)
+    _write(packed, 16 * MiB, writes, compress=True)
+
+    assert packed.stat().st_size < plain.stat().st_size // 4
+
+
+def test_backing_file(tmp_path):
+    image = tmp_path / "overlay.qcow2"
+    _write(image, MiB, [], backing_file="base.qcow2", backing_format="qcow2")
+
+    header = image.read_bytes()
+    backing_offset, backing_size = struct.unpack_from(">QI", header, 8)
+    assert header[backing_offset : backing_offset + backing_size] == b"base.qcow2"
+    assert struct.pack(">II", 0xE2792ACA, 5) + b"qcow2" in header[:backing_offset]
+
+
+def test_write_past_end(tmp_path):
+    with qcow2.Qcow2Writer(tmp_path / "disk.qcow2", MiB) as f:
+        f.seek(MiB - 1)
+        with pytest.raises(OSError):
+            f.write(b"ab")
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_expand(tmp_path, compress):
+    image = tmp_path / "disk.qcow2"
+    raw = tmp_path / "disk.raw"
+    guest = _write(image, 16 * MiB, WRITES, compress=compress)
+
+    qcow2.expand(image, raw)
+
+    assert raw.read_bytes() == guest
+
+
+def test_overlay(tmp_path, read_qcow2):
+    """Overlays only hold the clusters which differ from their base."""
+    base = tmp_path / "base.qcow2"
+    base_raw = tmp_path / "base.raw"
+    raw = tmp_path / "disk.raw"
+    image = tmp_path / "images" / "disk.qcow2"
+    image.parent.mkdir()
+    guest = bytearray(_write(base, 16 * MiB, WRITES))
+    qcow2.expand(base, base_raw)
+    # change a data cluster, clear another and fill a hole
+    guest[MiB + 100 : MiB + 200] = b"\x03" * 100
+    guest[3 * MiB : 3 * MiB + CLUSTER] = bytes(CLUSTER)
+    guest[10 * MiB : 10 * MiB + 10] = b"\x04" * 10
+    raw.write_bytes(guest)
+
+    stored = qcow2.overlay(raw, base_raw, image, "../base.qcow2")
+
+    assert stored == 3
+    assert read_qcow2(image) == guest
+    assert image.stat().st_size < base.stat().st_size
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_reader(tmp_path, compress):
+    """The reader serves reads of any size and alignment."""
+    image = tmp_path / "disk.qcow2"
+    guest = _write(image, 16 * MiB, WRITES, compress=compress)
+
+    with qcow2.Qcow2Reader(image) as f:
+        assert f.read() == guest
+        for offset, length in ((MiB + 90, 3 * CLUSTER), (16 * MiB - 10, 100)):
+            f.seek(offset)
+            assert f.read(length) == guest[offset : offset + length]
+
+
+def test_reader_backing(tmp_path):
+    """Clusters an overlay doesn't hold are read from its backing file."""
+    base = tmp_path / "base.qcow2"
+    base_raw = tmp_path / "base.raw"
+    raw = tmp_path / "disk.raw"
+    image = tmp_path / "images" / "disk.qcow2"
+    image.parent.mkdir()
+    guest = bytearray(_write(base, 16 * MiB, WRITES))
+    qcow2.expand(base, base_raw)
+    guest[MiB + 100 : MiB + 200] = b"\x03" * 100
+    guest[3 * MiB : 3 * MiB + CLUSTER] = bytes(CLUSTER)
+    raw.write_bytes(guest)
+    qcow2.overlay(raw, base_raw, image, "../base.qcow2")
+
+    with qcow2.open_image(image) as f:
+        assert f.backing_file == "../base.qcow2"
+        assert f.read() == guest
+        assert f.holds(MiB + 100, 100)
+        assert not f.holds(5 * MiB, CLUSTER)
+    with qcow2.open_image(raw) as f:
+        assert f.read(CLUSTER) == guest[:CLUSTER]
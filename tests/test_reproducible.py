@@ -0,0 +1,32 @@
+import pytest
+
+from esxi_img import reproducible
+
+
+def test_source_date_epoch(monkeypatch):
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    assert reproducible.source_date_epoch() is None
+    assert reproducible.source_date_epoch("1700000000") == 1700000000
+
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+    assert reproducible.source_date_epoch() == 1600000000
+    assert reproducible.source_date_epoch(5) == 5
+
+
+@pytest.mark.parametrize("value", ["yesterday", "-1"])
+def test_source_date_epoch_invalid(value):
+    with pytest.raises(ValueError):
+        reproducible.source_date_epoch(value)
+
+
+def test_derive():
+    """Identifiers only depend on the time and the inputs."""
+    one = reproducible.Identity.derive(1700000000, b"helper", 1234)
+
+    assert one == reproducible.Identity.derive(1700000000, b"helper", 1234)
+    assert one.timestamp == 1700000000
+    assert one.disk_guid != one.part_guid
+    assert one.disk_guid.version == 4
+    other = reproducible.Identity.derive(1700000000, b"helper", 1235)
+    assert other.volume_id != one.volume_id
+    assert other.disk_guid != one.disk_guid
@@ -0,0 +1,102 @@
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from esxi_img import serve
+
+
+@pytest.fixture
+def service(tmp_path):
+    """A build service listening on a free localhost port."""
+    server = serve._tcp_server("localhost:0")
+    server.service = serve.BuildService(tmp_path / "cache", workers=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    yield f"http://{host}:{port}"
+    server.shutdown()
+    server.server_close()
+    server.service.shutdown()
+
+
+def _request(url: str, job: dict | None = None) -> tuple[int, dict | list]:
+    data = None if job is None else json.dumps(job).encode()
+    try:
+        with urllib.request.urlopen(url, data) as response:  # noqa: S310
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def _wait(url: str) -> dict:
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        _status, job = _request(url)
+        if job["state"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(url)
+
+
+def test_serve_jobs(service, esxi_iso, tmp_path):
+    """Queued jobs are built and share one installer helper."""
+    ks_template = tmp_path / "ks.cfg"
+    ks_template.write_text("vmaccepteula\n")
+    jobs = []
+    for name in ("first", "second"):
+        status, job = _request(
+            f"{service}/jobs",
+            {
+                "iso": str(esxi_iso),
+                "output": str(tmp_path / f"{name}.qcow2"),
+                "ks_template": str(ks_template),
+            },
+        )
+        assert status == 202
+        assert job["state"] in ("queued", "running")
+        jobs.append(job)
+
+    for job in jobs:
+        finished = _wait(f"{service}/jobs/{job['id']}")
+        assert finished["state"] == "succeeded", finished["error"]
+    assert (tmp_path / "first.qcow2").exists()
+    assert (tmp_path / "second.qcow2").exists()
+    assert len(list((tmp_path / "cache" / "helpers").iterdir())) == 1
+
+    status, listed = _request(f"{service}/jobs")
+    assert status == 200
+    assert [job["name"] for job in listed] == ["first", "second"]
+
+
+def test_serve_invalid(service):
+    status, reply = _request(f"{service}/jobs", {"iso": "esxi.iso", "colour": 1})
+    assert status == 400
+    assert "colour" in reply["error"]
+
+    status, _reply = _request(f"{service}/jobs/42")
+    assert status == 404
+
+
+def test_serve_local_only():
+    with pytest.raises(ValueError, match="localhost"):
+        serve._tcp_server("0.0.0.0:8080")
+
+
+def test_serve_socket_by_default(tmp_path, monkeypatch):
+    """Without --listen the service only listens on a UNIX socket."""
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "run"))
+    assert serve.default_socket_path(tmp_path) == tmp_path / "run" / "esxi-img.sock"
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert serve.default_socket_path(tmp_path) == tmp_path / "esxi-img.sock"
+
+    server = serve._unix_server(serve.default_socket_path(tmp_path))
+    try:
+        assert server.socket.family == socket.AF_UNIX
+        assert (tmp_path / "esxi-img.sock").stat().st_mode & 0o007 == 0
+    finally:
+        server.server_close()
@@ -0,0 +1,76 @@
+import io
+from pathlib import PurePosixPath
+
+import pytest
+
+from esxi_img import fat32
+from esxi_img import sizing
+from esxi_img.fat32 import Fat32Builder
+
+
+@pytest.mark.parametrize(
+    "spec,expected",
+    [
+        ("10%", sizing.Slack(percent=10.0)),
+        ("64M", sizing.Slack(absolute=64 * 1024 * 1024)),
+        ("512K", sizing.Slack(absolute=512 * 1024)),
+        ("1GiB", sizing.Slack(absolute=1024 * 1024 * 1024)),
+        ("200", sizing.Slack(absolute=200 * 1024 * 1024)),
+    ],
+)
+def test_slack_parse(spec, expected):
+    assert sizing.Slack.parse(spec) == expected
+
+
+def test_slack_parse_invalid():
+    with pytest.raises(ValueError):
+        sizing.Slack.parse("lots")
+
+
+def _builder(files: int, size: int) -> Fat32Builder:
+    builder = Fat32Builder()
+    for n in range(files):
+        builder.add_stream(
+            PurePosixPath(f"MODS/F{n}.V00"),
+            size,
+            lambda fp, size=size: fp.seek(size, 1),
+        )
+    return builder
+
+
+def test_compute_minimal():
+    """Without slack the files fit and the breakdown adds up."""
+    builder = _builder(300, 1024 * 1024 + 1)
+    esp = sizing.compute(builder)
+
+    assert esp.sectors_per_cluster == 8
+    # every file spills over into one more cluster, the root directory
+    # takes one cluster and the 300 entries in MODS take three
+    assert esp.used_clusters == 300 * 257 + 1 + 3
+    assert esp.disk_size % sizing.MiB == 0
+    assert esp.min_partition_bytes + esp.slack_bytes == esp.partition_bytes
+    assert esp.partition_bytes + esp.gpt_bytes == esp.disk_size
+    assert esp.slack_bytes < sizing.MiB
+
+    geometry = fat32.Geometry.for_volume(
+        esp.partition_bytes // fat32.SECTOR_SIZE, esp.sectors_per_cluster
+    )
+    assert geometry.cluster_count >= esp.used_clusters
+    builder.write(
+        io.BytesIO(),
+        0,
+        esp.partition_bytes // fat32.SECTOR_SIZE,
+        sectors_per_cluster=esp.sectors_per_cluster,
+    )
+
+
+def test_compute_slack():
+    """Slack is added on top of the minimal partition."""
+    builder = _builder(10, 4096)
+    minimal = sizing.compute(builder)
+    padded = sizing.compute(builder, sizing.Slack(percent=50))
+
+    assert minimal.min_partition_bytes == padded.min_partition_bytes
+    assert padded.slack_bytes >= minimal.min_partition_bytes // 2
+    # FAT32 needs at least 65525 clusters no matter how little data there is
+    assert minimal.min_partition_bytes > fat32.MIN_CLUSTERS * fat32.SECTOR_SIZE
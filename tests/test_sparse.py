@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from esxi_img import sparse
+
+MiB = 1024 * 1024
+
+
+def _make_image(path):
+    with path.open("wb") as f:
+        f.truncate(16 * MiB)
+        f.seek(MiB)
+        f.write(b"\x01" * 4096)
+        # a fully allocated run of zeros
+        f.write(bytes(4 * MiB))
+        f.seek(12 * MiB)
+        f.write(b"\x02" * 100)
+
+
+def test_copy_sparse(tmp_path):
+    """Copies have the same contents but no data blocks for zeros."""
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    _make_image(src)
+
+    sparse.copy(src, dst)
+
+    assert dst.read_bytes() == src.read_bytes()
+    assert sparse.allocated_size(dst) <= sparse.allocated_size(src)
+    if sparse.allocated_size(src) >= 4 * MiB:
+        assert sparse.allocated_size(dst) < MiB
+
+
+def test_punch_zero_holes(tmp_path):
+    """Blocks of zeros are deallocated without changing the contents."""
+    image = tmp_path / "disk.img"
+    _make_image(image)
+    before = image.read_bytes()
+
+    punched = sparse.punch_zero_holes(image)
+    if punched == 0:
+        pytest.skip("filesystem does not support punching holes")
+
+    assert punched >= 3 * MiB
+    assert image.read_bytes() == before
+    assert sparse.apparent_size(image) == 16 * MiB
+
+
+def test_data_segments(tmp_path):
+    image = tmp_path / "disk.img"
+    _make_image(image)
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        segments = list(sparse.data_segments(fd, 16 * MiB))
+    finally:
+        os.close(fd)
+
+    covered = bytearray(16 * MiB)
+    for start, length in segments:
+        covered[start : start + length] = b"\x01" * length
+    # the data written must be inside the reported segments
+    assert covered[MiB] == 1
+    assert covered[12 * MiB] == 1
+
+
+def test_clone(tmp_path):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    _make_image(src)
+
+    sparse.clone(src, dst)
+
+    assert dst.read_bytes() == src.read_bytes()